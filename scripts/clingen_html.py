@@ -0,0 +1,298 @@
+"""
+Single-pass extraction of the data gcep_scrape needs from ClinGen gene and disease pages
+Each document is parsed exactly once and all fields are pulled from that parse.
+Two interchangeable backends are available:
+    - "lxml": lxml.html with a single filtered element walk per page (default when lxml is installed)
+    - "bs4": BeautifulSoup with the html.parser backend, matching the original gcep_scrape parsing
+Both backends return plain python structures so gcep_scrape does not depend on the parser used
+"""
+import re
+
+from pandas.io.parsers import TextParser
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+MONDO_PATTERN = re.compile(r"MONDO:\d+")
+CLASSIFICATION_HREF = "https://www.clinicalgenome.org/docs/gene-disease-validity-classification-information/"
+DISEASE_LINK_CLASS = 'btn btn-xs btn-success btn-block btn-report'
+DISEASE_LINK_PREFIX = '/kb/gene-validity/CGGV:assertion'
+GENE_ERROR_HEADER = 'Error retrieving Gene details'
+PROBAND_TABLE_ID = 'geclv'
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _clean_dt_dd(strings):
+    """
+    Format the direct text children of a <dt> or <dd> element into a field name or value
+    """
+    entry = ' '.join(strings).strip()
+    entry = entry.split(':')[0]
+    entry = entry.replace('\n', '')
+    return entry.rstrip()
+
+
+def _expand_table_rows(rows):
+    """
+    Expand rows of cells into rows of text, copying cells with colspan or rowspan
+    into the positions they cover, as done by pandas.read_html
+
+    Args:
+        rows (list): Rows, each a list of (text, colspan, rowspan) tuples
+
+    Returns:
+        list: Rows, each a list of cell text
+    """
+    output = []
+    remainder = []
+    for cells in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for text, colspan, rowspan in cells:
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+                index += 1
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        output.append(texts)
+        remainder = next_remainder
+    return output
+
+
+def _span(value):
+    try:
+        return int(value or 1)
+    except ValueError:
+        return 1
+
+
+# lxml backend
+
+def _lxml_single_string(element):
+    """
+    Return the text of an element that contains a single string, following single
+    child elements, or None. Mirrors BeautifulSoup's Tag.string
+    """
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        return _lxml_single_string(children[0])
+    return None
+
+
+def _lxml_direct_strings(element):
+    """
+    Return the text nodes that are direct children of an element
+    """
+    strings = [element.text] + [child.tail for child in element]
+    return [x for x in strings if x]
+
+
+def _lxml_table_rows(table):
+    """
+    Split a <table> element into header and body rows of (text, colspan, rowspan) cells
+    following the same rules as pandas.read_html
+    """
+    def cells(row):
+        output = []
+        for cell in row.xpath('./td|./th'):
+            # pandas.read_html skips content hidden with display:none
+            for hidden in cell.xpath('.//style|.//*[@style]'):
+                if hidden.tag == 'style' or 'display:none' in hidden.get('style', '').replace(' ', ''):
+                    hidden.drop_tree()
+            text = _WHITESPACE.sub(' ', cell.text_content().strip())
+            output.append((text, _span(cell.get('colspan')), _span(cell.get('rowspan'))))
+        return output
+
+    def is_all_th(row):
+        return all(x.tag == 'th' for x in row.xpath('./td|./th'))
+
+    header_rows = []
+    for thead in table.xpath('.//thead'):
+        header_rows.extend(thead.xpath('./tr'))
+        if thead.xpath('./td|./th'):
+            header_rows.append(thead)
+    body_rows = table.xpath('.//tbody//tr') + table.xpath('./tr')
+    body_rows += table.xpath('.//tfoot//tr')
+    if not header_rows:
+        while body_rows and is_all_th(body_rows[0]):
+            header_rows.append(body_rows.pop(0))
+    return [cells(x) for x in header_rows], [cells(x) for x in body_rows]
+
+
+def _lxml_gene_page(html):
+    root = lxml.html.fromstring(html)
+    error = False
+    disease_links = []
+    for element in root.iter('h1', 'div', 'a'):
+        if element.tag == 'h1':
+            error = error or _lxml_single_string(element) == GENE_ERROR_HEADER
+        elif element.tag == 'div':
+            error = error or 'alert-danger' in element.get('class', '').split()
+        elif ' '.join(element.get('class', '').split()) == DISEASE_LINK_CLASS:
+            disease_links.append(element.get('href'))
+    return {'valid': not error, 'disease_links': disease_links}
+
+
+def _lxml_disease_page(html):
+    root = lxml.html.fromstring(html)
+    mondo = None
+    classification = None
+    table = None
+    dt_output = []
+    dd_output = []
+    # One walk over the document collects every field
+    for element in root.iter('div', 'a', 'dt', 'dd', 'table'):
+        tag = element.tag
+        if tag == 'dt':
+            dt_output.append(_clean_dt_dd(_lxml_direct_strings(element)))
+        elif tag == 'dd':
+            dd_output.append(_clean_dt_dd(_lxml_direct_strings(element)))
+        elif tag == 'div':
+            if mondo is None:
+                string = _lxml_single_string(element)
+                if string is not None and MONDO_PATTERN.search(string):
+                    mondo = element.text_content()
+        elif tag == 'a':
+            if classification is None and element.get('href') == CLASSIFICATION_HREF:
+                classification = ''.join(x.strip() for x in element.itertext())
+        elif table is None and element.get('id') == PROBAND_TABLE_ID:
+            table = element
+    return {
+        'fields': dict(zip(dt_output, dd_output)),
+        'mondo': mondo,
+        'classification': classification,
+        'proband_rows': _lxml_table_rows(table) if table is not None else None
+    }
+
+
+# BeautifulSoup backend
+
+def _bs4_table_rows(table):
+    """
+    Split a BeautifulSoup <table> into header and body rows of (text, colspan, rowspan) cells
+    following the same rules as pandas.read_html
+    """
+    for hidden in table.find_all('style'):
+        hidden.decompose()
+    for hidden in table.find_all(style=re.compile(r"display:\s*none")):
+        hidden.decompose()
+
+    def cells(row):
+        return [
+            (_WHITESPACE.sub(' ', x.text.strip()), _span(x.get('colspan')), _span(x.get('rowspan')))
+            for x in row.find_all(('td', 'th'), recursive=False)
+        ]
+
+    header_rows = table.select('thead tr')
+    body_rows = table.select('tbody tr') + table.find_all('tr', recursive=False)
+    body_rows += table.select('tfoot tr')
+    if not header_rows:
+        while body_rows and all(x.name == 'th' for x in body_rows[0].find_all(('td', 'th'), recursive=False)):
+            header_rows.append(body_rows.pop(0))
+    return [cells(x) for x in header_rows], [cells(x) for x in body_rows]
+
+
+def _bs4_gene_page(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    error_header = soup.find('h1', string=GENE_ERROR_HEADER)
+    error_div = soup.find('div', {'class': 'alert-danger'})
+    links = soup.find_all('a', class_=DISEASE_LINK_CLASS)
+    return {'valid': not (error_header or error_div), 'disease_links': [x.get('href') for x in links]}
+
+
+def _bs4_disease_page(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    mondo_tag = soup.find('div', string=MONDO_PATTERN)
+    classification_tag = soup.find('a', href=CLASSIFICATION_HREF)
+    dt_output = [_clean_dt_dd(x.find_all(string=True, recursive=False)) for x in soup.find_all('dt')]
+    dd_output = [_clean_dt_dd(x.find_all(string=True, recursive=False)) for x in soup.find_all('dd')]
+    table = soup.find('table', {'id': PROBAND_TABLE_ID})
+    return {
+        'fields': dict(zip(dt_output, dd_output)),
+        'mondo': mondo_tag.text if mondo_tag else None,
+        'classification': classification_tag.get_text(strip=True) if classification_tag else None,
+        'proband_rows': _bs4_table_rows(table) if table is not None else None
+    }
+
+
+backends = {
+    'lxml': (_lxml_gene_page, _lxml_disease_page),
+    'bs4': (_bs4_gene_page, _bs4_disease_page)
+}
+default_backend = 'lxml' if lxml is not None else 'bs4'
+
+
+def parse_gene_page(html, backend=None):
+    """
+    Parse a ClinGen gene page
+
+    Args:
+        html (str): Page HTML
+        backend (str): Parser backend, one of backends. Defaults to default_backend
+
+    Returns:
+        dict: "valid", False if the page reports an error, and "disease_links",
+        the hrefs of all gene-disease report buttons
+    """
+    return backends[backend or default_backend][0](html)
+
+
+def parse_disease_page(html, backend=None):
+    """
+    Parse a ClinGen gene-disease validity page
+
+    Args:
+        html (str): Page HTML
+        backend (str): Parser backend, one of backends. Defaults to default_backend
+
+    Returns:
+        dict: "fields", the <dt>/<dd> pairs of the page, "mondo", the MONDO ID text,
+        "classification", the gene-disease classification, and "proband_rows",
+        the (header, body) rows of the proband table or None if it is missing
+    """
+    return backends[backend or default_backend][1](html)
+
+
+def rows_to_frame(proband_rows):
+    """
+    Build a DataFrame from extracted table rows with the same header handling and
+    type inference as pandas.read_html, without re-serializing and re-parsing the table
+
+    Args:
+        proband_rows (tuple): (header, body) rows returned by parse_disease_page
+
+    Returns:
+        pd.DataFrame: Table contents
+    """
+    if proband_rows is None:
+        raise ValueError(f"No table with id '{PROBAND_TABLE_ID}' found")
+    head, body = proband_rows
+    header = None
+    if head:
+        if len(head) == 1:
+            header = 0
+        else:
+            header = [i for i, row in enumerate(head) if any(text for text, _, _ in row)]
+    rows = _expand_table_rows(head + body)
+    # Pad ragged rows to equal length
+    width = max((len(x) for x in rows), default=0)
+    rows = [x + [''] * (width - len(x)) for x in rows]
+    with TextParser(rows, header=header, thousands=',') as parser:
+        return parser.read()
@@ -1,140 +1,231 @@
 import sys
+import os
+import argparse
 from pyprojroot.here import here
-from pyhpo import Ontology, HPOSet, helper
+from pyhpo import Ontology
 import pandas as pd
-import itertools
-from scipy.spatial.distance import squareform
 import h5py
-import numpy as np
 
 # Set basedir with here(), based on presence of .git file
 here()
 # Add script dir to path to import gcep.py and gcep_config.py
 sys.path.insert(0, here('scripts'))
 from gcep import gcep
+from gcep_http import clingen_session, response_cache
+from hpo_distance import create_hpo_distance, update_hpo_distance, tiled_hpo_distance
+from hpo_h5 import write_hpo_h5, read_hpo_h5, DEFAULT_METRIC
+from hpo_similarity import set_similarity_engine, combine_methods
+from hpo_cohort import hpo_cohort
+from hpo_sweep import similarity_sweep, term_similarity_sweep, parse_metric_grid, ic_kinds, term_methods
+from hpo_validation import hpo_term_index, print_validation_report
+from hpo_ontology import ontology_snapshot
+from stage_metrics import stage
+import stage_metrics
 import gcep_config
 
-# Load HPO ontology object from HPO3
-## Needs to occur before defining valid_hpo
-Ontology()
-
-
-def create_hpo_distance(hpo_set_list):
-    """
-    Take a list of HPOSet objects and return a matrix of the distances between each set in the list
-
-    Args:
-        hpo_set_list (_type_): List of HPOSet objects objects 
-
-    Returns:
-        _type_: distance matrix
-    """   
-    
-    # Create list of all tuples representing all pairwise combinations of HPO sets in HPO_set_list 
-    hpoSet_combinations = [
-        (a[0], a[1]) for a in itertools.combinations(hpo_set_list, 2)
-    ]   
-
-    # Get similarities of HPO set pairs from HPO3 
-    # TODO parameterize kind, method, combine
-    mtx_sim = helper.batch_set_similarity(
-        hpoSet_combinations, 
-        kind="omim",
-        method="graphic",
-        combine="funSimAvg"
+
+def main():
+    parser = argparse.ArgumentParser(description="Create HPO and proband distance matrices for a GCEP")
+    parser.add_argument('--gcep', type=str, default='pird', choices=['pird', 'scid'], help='GCEP of interest')
+    parser.add_argument('--start', type=str, default="2020-12-01", help='Start of the approval date window')
+    parser.add_argument('--end', type=str, default="2025-01-30", help='End of the approval date window')
+    parser.add_argument('--window_days', type=int, default=None,
+                        help='Split the approval date window into windows of this many days fetched concurrently')
+    parser.add_argument('--fetch_workers', type=int, default=4, help='Number of windows fetched at once')
+    parser.add_argument('--incremental_fetch', action='store_true',
+                        help='Only fetch snapshots approved since the last successful fetch of the GCEP, kept in data/gcep_snapshots')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Update the existing data/<gcep>_hpo.h5, only computing distances for new or changed probands and HPO terms')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Compute distances in tiles of this many rows, streamed into the HDF5 file so memory is bounded by the tile size')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes computing tiles when --tile_size is set')
+    parser.add_argument('--kind', type=str, default='omim', choices=ic_kinds, help='Information content kind of the distances')
+    parser.add_argument('--method', type=str, default='graphic', choices=term_methods, help='Term similarity method of the distances')
+    parser.add_argument('--combine', type=str, default='funSimAvg', choices=combine_methods, help='Set similarity combine method of the distances')
+    parser.add_argument('--engine', type=str, default='hpo3', choices=['hpo3', 'vectorized'],
+                        help='hpo3 compares every pair of sets with hpo3. vectorized computes the term x term similarity once and derives set similarities with NumPy')
+    parser.add_argument('--format_version', type=int, default=1, choices=[1, 2],
+                        help='HDF5 format. 1 is the original float64 gzip layout, 2 the compact float32/float16 layout with an ID index')
+    parser.add_argument('--dtype', type=str, default='f4', choices=['f4', 'f2'], help='Matrix dtype in format version 2')
+    parser.add_argument('--layout', type=str, default='chunked', choices=['chunked', 'contiguous'],
+                        help='Format version 2 layout. chunked stores lzf compressed row chunks, contiguous can be memory-mapped')
+    parser.add_argument('--sweep_kinds', type=str, nargs='+', default=None,
+                        help='Information content kinds of a metric sweep written to the metrics group, e.g. omim orpha gene')
+    parser.add_argument('--sweep_methods', type=str, nargs='+', default=['graphic'], help='Term similarity methods of the metric sweep')
+    parser.add_argument('--sweep_combines', type=str, nargs='+', default=['funSimAvg'], help='Set combine methods of the metric sweep')
+    parser.add_argument('--ontology_snapshot', type=str, default=None,
+                        help='Ontology snapshot written by hpo_ontology.py, e.g. data/hp_[date].snapshot. Used for HPO ID validation, tile workers, the vectorized engine and the metric sweep instead of the HPO Ontology, which is then only loaded by the hpo3 engine')
+    parser.add_argument('--obo', type=str, default=None,
+                        help='HPO obo file, e.g. data/hp_[date].obo, used to remap alternative HPO IDs')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='JSON lines file that timing, bytes, rows, pairs per second and peak RSS of every stage are appended to')
+    parser.add_argument('--profile_dir', type=str, default=None, help='Directory a cProfile dump of every stage is written to')
+    args = parser.parse_args()
+    stage_metrics.configure(args.metrics, args.profile_dir)
+    if sum([args.incremental, bool(args.tile_size), args.engine == 'vectorized']) > 1:
+        parser.error('--incremental, --tile_size and --engine vectorized can not be combined')
+    sweep_configs = []
+    if args.sweep_kinds:
+        try:
+            sweep_configs = parse_metric_grid(args.sweep_kinds, args.sweep_methods, args.sweep_combines)
+        except ValueError as e:
+            parser.error(str(e))
+    snapshot = None
+    if args.ontology_snapshot:
+        snapshot = ontology_snapshot(args.ontology_snapshot)
+    else:
+        # Load HPO ontology object from HPO3
+        ## Needs to occur before HPO IDs are validated
+        Ontology()
+
+    # Load api information from gcep_config
+    api_dict = {'pird':gcep_config.api_key_pird, 'scid':gcep_config.api_key_scid}
+    affiliation_dict = {'pird':gcep_config.affiliation_pird, 'scid':gcep_config.affiliation_scid}
+
+    # Set gcep of interest (scid or pird)
+    active_gcep = args.gcep
+
+    # Cache API responses on disk so re-running the table and distance steps does not re-query the API
+    ## Cached snapshots are revalidated after a day. Set replay=True to run fully offline from the cache
+    api_cache = response_cache(here('data/http_cache'), ttl=24 * 3600, replay=False)
+
+    # Query GCEP for HPO data using gcep class in gcep.py
+    gcep_query = gcep(
+        api_key = api_dict[active_gcep],
+        gcep_url = gcep_config.gcep_url,
+        status = "approved",
+        affiliation=affiliation_dict[active_gcep],
+        start = args.start,
+        end = args.end,
+        session = clingen_session(cache=api_cache),
+        window_days = args.window_days,
+        workers = args.fetch_workers,
+        snapshot_dir = here('data/gcep_snapshots'),
+        incremental = args.incremental_fetch
     )
-    
-    # Convert similarity matrix to distance matrix
-    mtx_dist = squareform([1 - x for x in mtx_sim])
-    return mtx_dist
-
-
-def valid_hpo(hpo_str):
-    """
-    Simple function returning True/False based on whether and HPO
-    string is in the HPO3 ontology
-
-    Args:
-        hpo_str (_type_): _description_
-
-    Returns:
-        _type_: _description_
-    """    
-    try:
-        HPOSet.from_queries([hpo_str])
-        return True
-    except:
-        return False
-    
-
-
-# Load api information from gcep_config
-api_dict = {'pird':gcep_config.api_key_pird, 'scid':gcep_config.api_key_scid}
-affiliation_dict = {'pird':gcep_config.affiliation_pird, 'scid':gcep_config.affiliation_scid}
-   
-# Set gcep of interest (scid or pird)    
-active_gcep = 'pird'
-
-# Query GCEP for HPO data using gcep class in gcep.py
-gcep_query = gcep(
-    api_key = api_dict[active_gcep], 
-    gcep_url = gcep_config.gcep_url,
-    status = "approved",
-    affiliation=affiliation_dict[active_gcep],
-    start = "2020-12-01", 
-    end = "2025-01-30"
-)
-
-# Generate HPO table from query using hpo_table() method
-df_probands = gcep_query.hpo_table()
-
-# Filter to only valid HPOs
-df_probands['valid'] = df_probands['HPO_ID'].map(valid_hpo) # Create column with validation status
-df_probands = df_probands[df_probands['valid']].drop(columns=['valid']) # Filter to only valid HPOs and drop validation column
-
-# Get all unique HPO terms in df_probands and convert each HPO term to its own HPOset
-## To be used to calculate distance between all individual HPO terms
-all_hpos = [HPOSet.from_queries([x]) for x in set(df_probands['HPO_ID'].to_list())]
-
-# Collapse all HPO terms from a given proband into a list
-df_probands = df_probands.groupby(['Gene', 'Disease', 'label'])['HPO_ID'].apply(list).reset_index()
-df_probands['HPO_ID'] = df_probands['HPO_ID'].map(HPOSet.from_queries)
-# Create a concatenated ID column
-df_probands['ID'] = df_probands['Gene'] + '__' + df_probands['Disease'] + '__' + df_probands['label']
-
-# Create a dataframe of HPO metadata
-df_hpo_meta = pd.DataFrame({
-    'hpo_id': [x.terms()[0].id for x in all_hpos],
-    'hpo_name': [x.terms()[0].name for x in all_hpos]
-})
-
-# Generate distance matrices for HPO terms
-mtx_hpo_dist = create_hpo_distance(all_hpos)
-# Generate distance matrix for probands
-mtx_proband_dist = create_hpo_distance(df_probands['HPO_ID'].to_list())
-
-# Save all data to an HDF5 file
-hf_save_path = here(f'data/{active_gcep}_hpo.h5')
-
-with h5py.File(hf_save_path, 'w') as f:
-    
-    # Save HPO distance matrix and metadata
-    ## HPO distance matrix
-    f.create_dataset('hpo_distance', data=mtx_hpo_dist, compression = 'gzip')
-    ## HPO metadata
-    hpo_metadata_group = f.create_group('hpo_metadata')
-    hpo_metadata_group.create_dataset('hpo_id', data=np.array(df_hpo_meta['hpo_id'].values, dtype='S'))
-    hpo_metadata_group.create_dataset('hpo_name', data=np.array(df_hpo_meta['hpo_name'].values, dtype='S'))
-    hpo_metadata_group.create_dataset('index', data=df_hpo_meta.index.values)
-    hpo_metadata_group.attrs['columns'] = np.array(df_hpo_meta.columns.tolist(), dtype='S')
-    
-    # Save proband distance matrix and metadata
-    ## Proband distance matrix
-    f.create_dataset('proband_distance', data=mtx_proband_dist, compression = 'gzip')
-    ## Proband metadata
-    proband_metadata_group = f.create_group('proband_metadata')
-    proband_metadata_group.create_dataset('gene', data=np.array(df_probands['Gene'].values, dtype='S'))
-    proband_metadata_group.create_dataset('disease', data=np.array(df_probands['Disease'].values, dtype='S'))
-    proband_metadata_group.create_dataset('proband_id', data=np.array(df_probands['label'].values, dtype='S'))
-    proband_metadata_group.create_dataset('index', data=df_probands.index.values)
-    proband_metadata_group.attrs['columns'] = np.array(df_probands.columns.tolist(), dtype='S')
\ No newline at end of file
+
+    # Generate HPO table from query using hpo_table() method
+    df_probands = gcep_query.hpo_table()
+
+    # Validate HPO IDs once per distinct ID against an in-memory index of the Ontology
+    ## Obsolete and alternative IDs are remapped to their current term, unresolvable IDs are dropped
+    with stage('distance.validation') as metrics:
+        term_index = hpo_term_index(obo_path=args.obo, snapshot=snapshot)
+        df_probands, df_validation = term_index.validate(df_probands, column='HPO_ID')
+        metrics.add(rows=len(df_probands), remapped_or_dropped=len(df_validation))
+    print_validation_report(df_validation)
+    df_validation.to_csv(here(f'data/{active_gcep}_hpo_validation.csv'), index=False)
+
+    # Intern HPO IDs and store the terms of every proband as CSR arrays
+    ## Probands are ordered by Gene, Disease and label with a concatenated ID as their key
+    with stage('distance.cohort') as metrics:
+        df_probands['ID'] = df_probands['Gene'] + '__' + df_probands['Disease'] + '__' + df_probands['label']
+        df_terms = df_probands
+        df_probands = df_terms.drop_duplicates(subset=['Gene', 'Disease', 'label']).sort_values(['Gene', 'Disease', 'label'])
+        df_probands = df_probands[['Gene', 'Disease', 'label', 'ID']].reset_index(drop=True)
+        cohort = hpo_cohort.from_table(df_terms, key_column='ID', term_column='HPO_ID', keys=df_probands['ID'])
+        # Keep a sorted string of each proband's HPO IDs to detect changed probands in incremental updates
+        df_probands['hpo_ids'] = cohort.hpo_id_strings()
+        metrics.add(rows=len(cohort), bytes=cohort.nbytes, n_terms=len(cohort.term_codes))
+
+    # All unique HPO terms as single-term sets, used to calculate distance between all individual HPO terms
+    all_hpo_ids = cohort.term_ids
+    term_cohort = cohort.term_cohort()
+
+    # Create a dataframe of HPO metadata
+    df_hpo_meta = pd.DataFrame({
+        'hpo_id': all_hpo_ids,
+        'hpo_name': [term_index.terms[x].name for x in all_hpo_ids]
+    })
+
+    hf_save_path = here(f'data/{active_gcep}_hpo.h5')
+
+    metric = {'kind': args.kind, 'method': args.method, 'combine': args.combine}
+    previous = None
+    if args.incremental:
+        if os.path.exists(hf_save_path):
+            previous = read_hpo_h5(hf_save_path)
+            # Files without a stored metric were written with the original omim, graphic and funSimAvg
+            previous_metric = previous['metric'] or DEFAULT_METRIC
+            if previous_metric != metric:
+                print(f'{hf_save_path} stores {previous_metric} distances, recomputing all distances', file=sys.stderr)
+                previous = None
+            elif previous['proband_hpo_ids'] is None:
+                print(f'{hf_save_path} does not store proband HPO IDs, recomputing all proband distances', file=sys.stderr)
+        else:
+            print(f'{hf_save_path} does not exist, computing all distances', file=sys.stderr)
+
+    if snapshot is not None and not args.tile_size and args.engine == 'hpo3':
+        # hpo3 compares HPOSets, which need the HPO Ontology even with a snapshot
+        Ontology()
+        if snapshot.version != Ontology.version():
+            print(f'Ontology snapshot {snapshot.version} differs from the loaded Ontology {Ontology.version()}', file=sys.stderr)
+
+    if args.tile_size:
+        # Distances are computed tile by tile while the HDF5 file is written. Each matrix records
+        # its own distance.similarity stage with the pairs of its tiles, nested in distance.write
+        mtx_hpo_dist = tiled_hpo_distance(term_cohort, args.tile_size, args.workers, args.ontology_snapshot, **metric)
+        mtx_proband_dist = tiled_hpo_distance(cohort, args.tile_size, args.workers, args.ontology_snapshot, **metric)
+    else:
+        with stage('distance.similarity', engine=args.engine, incremental=previous is not None) as metrics:
+            # Pairs of both matrices
+            n_pairs = (len(term_cohort) * (len(term_cohort) - 1) + len(cohort) * (len(cohort) - 1)) // 2
+            if args.engine == 'vectorized':
+                # Term x term similarities are computed once and reused for both matrices
+                ## With a snapshot they are computed from its arrays instead of the HPO Ontology
+                term_similarity = None
+                if snapshot is not None:
+                    term_similarity = term_similarity_sweep(cohort, snapshot=snapshot).similarity(args.kind, args.method)
+                engine = set_similarity_engine.from_cohort(
+                    cohort, kind=args.kind, method=args.method, term_similarity=term_similarity
+                )
+                mtx_proband_dist = engine.distance_matrix(combine=args.combine)
+                mtx_hpo_dist = engine.term_distance_matrix()
+                # Order HPO metadata like the engine's term matrix
+                df_hpo_meta = df_hpo_meta.set_index('hpo_id').loc[engine.term_ids].reset_index()
+            elif previous is None:
+                # Generate distance matrices for HPO terms
+                mtx_hpo_dist = create_hpo_distance(term_cohort.hpo_sets(), **metric)
+                # Generate distance matrix for probands
+                mtx_proband_dist = create_hpo_distance(cohort.hpo_sets(), **metric)
+            else:
+                # Individual HPO terms never change, so they are keyed by ID only
+                mtx_hpo_dist, hpo_counts = update_hpo_distance(
+                    term_cohort.hpo_sets(), df_hpo_meta['hpo_id'].to_list(),
+                    previous['hpo_id'], previous['hpo_distance'], **metric
+                )
+                print(f'HPO terms: reusing {hpo_counts["reused_rows"]} rows, computing {hpo_counts["computed_rows"]} new rows ({hpo_counts["computed_pairs"]} pairs)', file=sys.stderr)
+                # Probands are keyed by ID and HPO IDs so probands with changed HPO sets are recomputed
+                previous_proband_keys = []
+                if previous['proband_hpo_ids'] is not None:
+                    previous_proband_keys = list(zip(previous['proband_key'], previous['proband_hpo_ids']))
+                mtx_proband_dist, counts = update_hpo_distance(
+                    cohort.hpo_sets(), list(zip(df_probands['ID'], df_probands['hpo_ids'])),
+                    previous_proband_keys, previous['proband_distance'], **metric
+                )
+                print(f'Probands: reusing {counts["reused_rows"]} rows, computing {counts["computed_rows"]} new rows ({counts["computed_pairs"]} pairs)', file=sys.stderr)
+                # Only the pairs of new or changed rows are computed
+                n_pairs = hpo_counts['computed_pairs'] + counts['computed_pairs']
+            metrics.add(pairs=n_pairs)
+
+    # Save all data to an HDF5 file
+    with stage('distance.write') as metrics:
+        write_hpo_h5(
+            hf_save_path, mtx_hpo_dist, df_hpo_meta, mtx_proband_dist, df_probands,
+            format_version=args.format_version, dtype=args.dtype, layout=args.layout, metric=metric
+        )
+        # Keep the compact cohort next to the matrices for later stages
+        cohort.save(hf_save_path)
+        metrics.add(rows=len(cohort), bytes=os.path.getsize(hf_save_path))
+
+    # Proband distances of every metric configuration of the sweep in one pass, one dataset per metric
+    if args.sweep_kinds:
+        with stage('distance.sweep', n_metrics=len(sweep_configs)) as metrics, h5py.File(hf_save_path, 'a') as f:
+            similarity_sweep(cohort, sweep_configs, snapshot=snapshot).write(
+                f, format_version=args.format_version, dtype=args.dtype, layout=args.layout
+            )
+            metrics.add(pairs=len(cohort) * (len(cohort) - 1) // 2 * len(sweep_configs))
+
+
+if __name__ == "__main__":
+    main()
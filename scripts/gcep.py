@@ -1,15 +1,145 @@
+import datetime
+import functools
+import gzip
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import gcep_config
 import pandas as pd
-import re
+from stage_metrics import stage, response_bytes
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+
+def date_windows(start, end, window_days):
+    """
+    Split the inclusive date range start-end into consecutive windows of window_days days
+
+    Args:
+        start (str): First date, YYYY-MM-DD
+        end (str): Last date, YYYY-MM-DD
+        window_days (int): Number of days per window. None returns the whole range as one window
+
+    Returns:
+        list: (start, end) date strings of each window
+    """
+    if not window_days:
+        return [(start, end)]
+    first = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end)
+    windows = []
+    while first <= last:
+        window_end = min(first + datetime.timedelta(days=window_days - 1), last)
+        windows.append((first.isoformat(), window_end.isoformat()))
+        first = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+def decode_snapshots(response):
+    """
+    Decode the JSON array of snapshots of a /snapshots response
+    Responses requested with stream=True are decoded item by item with ijson when it is
+    installed, so the raw body is never held in memory next to the decoded records. A response
+    cache writes the body to disk while it is decoded, see gcep_http.response_cache.stream.
+    Otherwise, or when the body was already read (e.g. a cached response), falls back to response.json()
+    """
+    if ijson is not None and response.raw is not None and not response.raw.closed:
+        response.raw.decode_content = True
+        return list(ijson.items(response.raw, 'item', use_float=True))
+    return response.json()
+
+
+def snapshot_key(record):
+    """
+    Key of a snapshot used to deduplicate the stored and newly fetched records of an incremental fetch
+    """
+    return record.get('Gene'), record.get('Disease')
+
+
+def snapshot_date(record, date_field):
+    """
+    Date of a snapshot as YYYY-MM-DD
+    """
+    return str(record[date_field])[:10]
+
+
+def check_date_field(records, date_field):
+    """
+    Raise ValueError if a snapshot has no date in date_field, the snapshots could not be merged or filtered by date
+    """
+    missing = sum(1 for x in records if not x.get(date_field))
+    if missing:
+        raise ValueError(
+            f'{missing} snapshots have no {date_field!r} field to merge and filter incremental fetches by, '
+            f'pass the date field of the GCEP API snapshots as date_field'
+        )
+
+
+def merge_snapshots(stored, fetched, date_field):
+    """
+    Merge newly fetched snapshots into the stored ones, keeping one snapshot per Gene-Disease
+    The snapshot with the latest date_field wins. On equal dates the fetched snapshot wins
+
+    Args:
+        stored (list): Snapshot records of earlier fetches
+        fetched (list): Snapshot records of this fetch
+        date_field (str): Record field holding the snapshot date
+
+    Returns:
+        list: Merged snapshot records
+    """
+    snapshots = {}
+    for record in itertools.chain(stored, fetched):
+        key = snapshot_key(record)
+        current = snapshots.get(key)
+        if current is not None and snapshot_date(record, date_field) < snapshot_date(current, date_field):
+            continue
+        snapshots[key] = record
+    return list(snapshots.values())
+
+
+def _atomic_write(path, data):
+    """
+    Write data to path through a temporary file so an interrupted run never leaves a partial file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
 
 class gcep:
     """
     Class that takes parameters query to the GCEP API and parses response data
     Includes methods to return data in a variety of formats
     """    
-    def __init__(self, api_key, gcep_url, status, affiliation, start, end):  
+    def __init__(self, api_key, gcep_url, status, affiliation, start, end, session=None,
+                 window_days=None, workers=4, snapshot_dir=None, incremental=False,
+                 date_field='Approval Date'):
+        """
+        Args:
+            window_days (int): Split start-end into windows of this many days fetched concurrently
+            workers (int): Number of windows fetched at once over the shared session
+            snapshot_dir (str): Directory keeping fetched snapshots and the watermark of the
+                last successful fetch of each affiliation. Required for incremental
+            incremental (bool): Only fetch snapshots since the watermark of the last successful
+                fetch and merge them with the stored snapshots
+            date_field (str): Snapshot field holding its date, used to keep the latest snapshot of a
+                Gene-Disease when merging incremental fetches and to filter merged snapshots to start-end.
+                Incremental fetches raise ValueError if a snapshot has no date in this field
+        """
         self.api_key = api_key
+        # Optional gcep_http.clingen_session, e.g. to serve responses from an on-disk cache
+        self.session = session if session is not None else requests
         self.gcep_url = gcep_url
         self.params = {
             "target": "gci",
@@ -18,101 +148,188 @@ class gcep:
             "start": start,
             "end": end
         }
-        self.response = self._api_get()
-        self.json = self.response.json()
-        self.table = pd.DataFrame(self.json)
-        self.genes = [x['Gene'] for x in self.json]
-        self.n_genes = len(self.genes)
-        # self.hpo_table = self._hpo_table()
+        self.window_days = window_days
+        self.workers = workers
+        self.snapshot_dir = snapshot_dir
+        self.incremental = incremental
+        self.date_field = date_field
+        if incremental and snapshot_dir is None:
+            raise ValueError('incremental fetching requires a snapshot_dir')
+        # Snapshots are only fetched when json, table, genes or one of the tables is first accessed
+
+    @functools.cached_property
+    def json(self):
+        return self._fetch_snapshots()
+
+    @functools.cached_property
+    def table(self):
+        return pd.DataFrame(self.json)
+
+    @functools.cached_property
+    def genes(self):
+        return [x['Gene'] for x in self.json]
+
+    @property
+    def n_genes(self):
+        return len(self.genes)
     
-    def _api_get(self):
+    def _api_get(self, params=None):
         """
         Internal method used by __init__ to make a get request to the GCEP API
 
+        Args:
+            params (dict): Query parameters, defaults to self.params
+
         Returns:
             _type_: _description_
         """        
-        response = requests.get(
+        response = self.session.get(
             f"{self.gcep_url}/snapshots",
             headers={"x-api-key": self.api_key},
-            params=self.params)
+            params=params if params is not None else self.params,
+            stream=ijson is not None)
         return response    
-    
-    def _single_gene_proband_table(self, row):
+
+    def _fetch_window(self, window):
         """
-        Internal method used as pandas apply function to format proband data for a single gene
-        Parses the proband sub-json format and joins it with the original Gene and Disease data
+        Internal method fetching and decoding the snapshots of one (start, end) window
+        """
+        params = dict(self.params, start=window[0], end=window[1])
+        with stage('gcep.fetch', window=f'{window[0]}..{window[1]}') as metrics:
+            response = self._api_get(params)
+            response.raise_for_status()
+            try:
+                records = decode_snapshots(response)
+                metrics.add(rows=len(records), bytes=response_bytes(response))
+                return records
+            finally:
+                response.close()
 
-        Args:
-            row (_type_): _description_
+    def _fetch_snapshots(self):
+        """
+        Internal method used by __init__ fetching all windows of the query concurrently
+        In incremental mode the fetch starts at the watermark of the last successful fetch,
+        new snapshots are merged with the stored ones and the watermark only moves forward
+        once every window was fetched
 
         Returns:
-            _type_: _description_
-        """        
-        df = pd.DataFrame(row['probands'])
-        gene = row['Gene']
-        disease = row['Disease']
-        df['Gene'] = gene
-        df['Disease'] = disease
-        df = df[['Gene', 'Disease'] + [col for col in df.columns if col not in ['Gene', 'Disease']]]
-        return df
-    
-    
-    def _format_hpo_string(self, hpo_str):
+            list: Snapshot records. Merged incremental fetches keep the latest snapshot of each
+                Gene-Disease approved between start and end
         """
-        Internal method used to reformat how HPO terms are stored in GCEP json data
-        Intake format from GCEP JSON follows pattern "HPO term (HPO_ID)"
-        Output format is a dictionary with keys "HPO_ID" and "HPO_term"
-        This allows the HPO_ID to be used with HPO3 module for further analysis
-        
-        Args:
-            hpo_str (_type_): _description_
+        start, end = self.params['start'], self.params['end']
+        stored = None
+        watermark = self._read_watermarks().get(self._store_name()) if self.incremental else None
+        # The stored snapshots can only be extended if they cover the requested start
+        if watermark is not None and watermark['start'] <= start and watermark['end'] <= end:
+            stored = self._read_snapshots()
+            # The watermark day is fetched again, snapshots approved later that day were not seen yet
+            fetch_start = max(start, watermark['end'])
+        else:
+            watermark = None
+            fetch_start = start
 
-        Returns:
-            _type_: _description_
-        """        
-        try: 
-            match = re.match(r"(.+?)\s*\((HP:\d+)\)", hpo_str)
-            if match:
-                hpo_dict = {
-                    "HPO_ID": match.group(2),
-                    "HPO_term": match.group(1)
-                }
-                return hpo_dict
-            else:
-                return hpo_str, None
-        except:
-            return hpo_str, None
-        
+        windows = date_windows(fetch_start, end, self.window_days)
+        with ThreadPoolExecutor(max(1, min(self.workers, len(windows)))) as executor:
+            fetched = list(itertools.chain.from_iterable(executor.map(self._fetch_window, windows)))
+        logger.info('Fetched %d snapshots from %s to %s in %d windows', len(fetched), fetch_start, end, len(windows))
+        if self.incremental:
+            # Checked before anything is stored, a later fetch could not merge the stored snapshots
+            check_date_field(itertools.chain(stored or [], fetched), self.date_field)
+
+        if stored is None:
+            records = fetched
+        else:
+            records = merge_snapshots(stored, fetched, self.date_field)
+
+        if self.snapshot_dir is not None:
+            self._write_snapshots(records)
+            self._write_watermark({
+                'start': watermark['start'] if watermark is not None else start,
+                'end': end,
+                'fetched_at': datetime.datetime.now().isoformat(timespec='seconds')
+            })
+
+        if stored is not None:
+            # The store may reach back before the requested start
+            records = [x for x in records if start <= snapshot_date(x, self.date_field) <= end]
+        return records
+
+    def _store_name(self):
+        return f"{self.params['affiliation']}_{self.params['status']}"
+
+    def _watermark_path(self):
+        return os.path.join(self.snapshot_dir, 'watermarks.json')
+
+    def _read_watermarks(self):
+        if not os.path.exists(self._watermark_path()):
+            return {}
+        with open(self._watermark_path()) as f:
+            return json.load(f)
+
+    def _write_watermark(self, watermark):
+        watermarks = self._read_watermarks()
+        watermarks[self._store_name()] = watermark
+        _atomic_write(self._watermark_path(), json.dumps(watermarks, indent=2).encode())
+
+    def _read_snapshots(self):
+        path = os.path.join(self.snapshot_dir, f'{self._store_name()}.json.gz')
+        if not os.path.exists(path):
+            return []
+        with gzip.open(path, 'rt') as f:
+            return json.load(f)
+
+    def _write_snapshots(self, records):
+        path = os.path.join(self.snapshot_dir, f'{self._store_name()}.json.gz')
+        _atomic_write(path, gzip.compress(json.dumps(records).encode()))
     
+    @functools.cached_property
+    def _proband_table(self):
+        records = self.json
+        with stage('gcep.table') as metrics:
+            probands = [x.get('probands') or [] for x in records]
+            counts = [len(x) for x in probands]
+            df = pd.DataFrame([proband for x in probands for proband in x])
+            df = df.drop(columns=[col for col in ['Gene', 'Disease'] if col in df.columns])
+            df.insert(0, 'Gene', [x['Gene'] for x, n in zip(records, counts) for _ in range(n)])
+            df.insert(1, 'Disease', [x['Disease'] for x, n in zip(records, counts) for _ in range(n)])
+            metrics.add(rows=len(df))
+        return df
+
     def proband_table(self):
         """
-        Takes data from self.table and returns a new table with each proband in the dataset.
-        Each entry in self.table['probands'] is a json tree of proband data that is converted to a dataframe
-        The original Gene and Disease from the original row is added to this new dataframe
-        The resulting proband dataframes are concatenated into a single dataframe
+        Takes data from self.json and returns a new table with each proband in the dataset.
+        The proband records of all genes are flattened into a single table in one pass and
+        the Gene and Disease of each proband's snapshot are added as the first columns
+        The table is built once and a copy is returned on each call
         """        
-        df = self.table.apply(self._single_gene_proband_table, axis=1)
-        df = pd.concat(df.to_list(), axis = 0, ignore_index=True)
+        return self._proband_table.copy()
+
+    @functools.cached_property
+    def _hpo_table(self):
+        df_proband = self._proband_table
+        with stage('gcep.hpo_table') as metrics:
+            df = df_proband[['Gene', 'Disease', 'label', 'HPO terms']].explode("HPO terms", ignore_index=True)
+            # HPO terms follow the pattern "HPO term (HPO_ID)", anything else is dropped
+            hpo = df.pop('HPO terms').astype(str).str.extract(r"^(?P<HPO_term>.+?)\s*\((?P<HPO_ID>HP:\d+)\)")
+            df = df.join(hpo[['HPO_ID', 'HPO_term']])
+            df = df.dropna(subset=['HPO_ID'])
+            metrics.add(rows=len(df))
         return df
-    
+
     def hpo_table(self):
         """
-        Takes data from self.table and returns a new table for each HPO term for every 
+        Takes data from self.json and returns a new table for each HPO term for every 
         Gene-Disease-proband combination
-        Includes application of _format_hpo_string to reformat HPO terms
+        HPO terms are split into HPO_ID and HPO_term columns with a single vectorized regex extraction
+        The table is built once and a copy is returned on each call
 
         Returns:
             _type_: _description_
         """        
-        df = self.proband_table()
-        df = df[['Gene', 'Disease', 'label','HPO terms']].explode("HPO terms", ignore_index=True)
-        df['HPO terms'] = df['HPO terms'].apply(self._format_hpo_string) 
-        df = df.join(pd.json_normalize(df.pop('HPO terms')))
-        df = df.dropna(subset=['HPO_ID'])
-        return df
+        return self._hpo_table.copy()
                 
 if __name__ == "__main__":
+    import gcep_config
     # If run as script to test, create a gcep object and print some data 
     gcep_query = gcep(
         api_key = gcep_config.api_key_pird, 
@@ -0,0 +1,461 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class CacheMissError(LookupError):
+    """
+    Raised by response_cache in replay mode when a request has no cached response
+    """
+
+
+class response_cache:
+    """
+    Persistent on-disk cache of HTTP responses
+    Entries are addressed by a hash of the URL and query parameters and stored as a
+    gzip compressed body next to a small JSON metadata file. Stale entries are
+    revalidated with ETag/Last-Modified when the server provided them.
+    In replay mode the cache never touches the network and raises CacheMissError on a miss,
+    which allows the whole pipeline to run offline against recorded responses
+    """
+    # Headers kept with each entry, needed for revalidation and to rebuild the response
+    stored_headers = ['Content-Type', 'ETag', 'Last-Modified']
+    # Besides successful responses only a page that does not exist is cached, gcep_scrape relies on
+    # it for genes and curations without a page. Auth failures and other errors are never replayed
+    cacheable_status = {404}
+
+    def __init__(self, cache_dir, ttl=None, max_bytes=None, replay=False):
+        """
+        Args:
+            cache_dir (str): Directory the cache is stored in. Created if missing
+            ttl (float): Age in seconds after which an entry is revalidated. None keeps entries fresh forever
+            max_bytes (int): Maximum total size of compressed bodies. Least recently used entries
+                are evicted when exceeded. None disables size based eviction
+            replay (bool): Serve only from the cache and raise CacheMissError on a miss
+        """
+        self.cache_dir = str(cache_dir)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def key(self, url, params=None):
+        """
+        Return the cache key of a request, a sha256 hash of the URL and sorted parameters
+        Request headers (e.g. API keys) are not part of the key
+        """
+        params = sorted((str(k), str(v)) for k, v in (params or {}).items() if v is not None)
+        return hashlib.sha256(json.dumps([url, params]).encode()).hexdigest()
+
+    def _paths(self, key):
+        """
+        Internal method returning the body and metadata paths of a key
+        Entries are spread over 256 subdirectories to keep directories small
+        """
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return f'{base}.gz', f'{base}.json'
+
+    def load(self, key):
+        """
+        Load a cached entry
+
+        Returns:
+            tuple: (response, metadata) or None if the key is not cached
+        """
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with gzip.open(body_path, 'rb') as f:
+                body = f.read()
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # Body mtime records the last access and is used for LRU eviction
+        os.utime(body_path)
+        return self._build_response(body, meta), meta
+
+    def _build_response(self, body, meta):
+        """
+        Internal method that rebuilds a requests.Response from a cached body and metadata
+        """
+        response = requests.Response()
+        response._content = body
+        response.status_code = meta['status_code']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.url = meta['url']
+        response.encoding = meta['encoding']
+        return response
+
+    def is_fresh(self, meta):
+        return self.ttl is None or time.time() - meta['stored_at'] < self.ttl
+
+    def validators(self, meta):
+        """
+        Return conditional request headers for revalidating a stale entry
+        """
+        headers = {}
+        if meta['headers'].get('ETag'):
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if meta['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        return headers
+
+    def cacheable(self, response):
+        """
+        Whether a response is stored, only successful responses and cacheable_status
+        """
+        return 200 <= response.status_code < 300 or response.status_code in self.cacheable_status
+
+    def store(self, key, response):
+        """
+        Store a response under key, evicting old entries if the cache is over max_bytes
+        """
+        body_path, _ = self._paths(key)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        tmp_suffix = self._tmp_suffix()
+        with open(body_path + tmp_suffix, 'wb') as f:
+            f.write(gzip.compress(response.content))
+        self._commit(key, response, tmp_suffix)
+
+    def stream(self, key, response):
+        """
+        Store a response requested with stream=True while its body is read, without holding the
+        body in memory. The raw body of the response is wrapped so every read is also written
+        to the entry, which is stored once the body was read to the end
+
+        Returns:
+            requests.Response: response, reading its body through the cache
+        """
+        response.raw = _cache_writer(response.raw, self, key, response)
+        return response
+
+    def _tmp_suffix(self):
+        return f'.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def _commit(self, key, response, tmp_suffix):
+        """
+        Internal method storing the metadata of a response whose compressed body was written
+        to the body path with tmp_suffix, and evicting old entries if the cache is over max_bytes
+        """
+        body_path, meta_path = self._paths(key)
+        meta = {
+            'url': response.url,
+            'status_code': response.status_code,
+            'encoding': response.encoding,
+            'headers': {k: response.headers[k] for k in self.stored_headers if k in response.headers},
+            'stored_at': time.time()
+        }
+        # Write to temporary files and rename so concurrent readers never see partial entries
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump(meta, f)
+        size = os.path.getsize(body_path + tmp_suffix)
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+        os.replace(body_path + tmp_suffix, body_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+
+        if self.max_bytes is not None:
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = sum(os.path.getsize(x) for x, _ in self._entries())
+                else:
+                    self._total_bytes += size - old_size
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+
+    def touch(self, key):
+        """
+        Mark an entry as freshly validated after a 304 Not Modified response
+        """
+        _, meta_path = self._paths(key)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['stored_at'] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def _entries(self):
+        """
+        Internal generator over (body_path, meta_path) of all cached entries
+        """
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.gz'):
+                    yield entry.path, entry.path[:-3] + '.json'
+
+    def items(self):
+        """
+        Generator over (key, metadata) of all cached entries, e.g. to serve recorded responses
+        """
+        for _, meta_path in self._entries():
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            yield os.path.basename(meta_path)[:-len('.json')], meta
+
+    def _evict(self):
+        """
+        Internal method removing least recently used entries until the cache fits in
+        90% of max_bytes. Must be called with self._lock held
+        """
+        entries = sorted(
+            ((os.path.getmtime(body), os.path.getsize(body), body, meta) for body, meta in self._entries()),
+            key=lambda x: x[0]
+        )
+        target = 0.9 * self.max_bytes
+        for _, size, body, meta in entries:
+            if self._total_bytes <= target:
+                break
+            for path in (body, meta):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._total_bytes -= size
+
+    def clear_expired(self):
+        """
+        Remove all entries older than ttl
+
+        Returns:
+            int: Number of removed entries
+        """
+        if self.ttl is None:
+            return 0
+        n_removed = 0
+        for body, meta_path in list(self._entries()):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                meta = None
+            if meta is None or not self.is_fresh(meta):
+                for path in (body, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                n_removed += 1
+        with self._lock:
+            self._total_bytes = None
+        return n_removed
+
+
+class _cache_writer:
+    """
+    File-like wrapper of the raw body of a streamed response, see response_cache.stream
+    The decoded body is compressed to a temporary file of the entry as it is read and the entry
+    is stored at the end of the body. A body closed before its end is not stored
+    """
+    def __init__(self, raw, cache, key, response):
+        raw.decode_content = True
+        self._raw = raw
+        self._cache = cache
+        self._key = key
+        self._response = response
+        self._tmp_suffix = cache._tmp_suffix()
+        body_path, _ = cache._paths(key)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        self._body_path = body_path + self._tmp_suffix
+        self._file = gzip.open(self._body_path, 'wb')
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _write(self, data, end):
+        if self._file is None:
+            return
+        if data:
+            self._file.write(data)
+        if end:
+            self._file.close()
+            self._file = None
+            self._cache._commit(self._key, self._response, self._tmp_suffix)
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self._raw.read(amt, *args, **kwargs)
+        # Only an empty read of a positive amount is the end of the body, ijson probes with read(0)
+        self._write(data, end=amt is None or (not data and amt > 0))
+        return data
+
+    def readinto(self, buffer):
+        n = self._raw.readinto(buffer)
+        self._write(bytes(memoryview(buffer)[:n]), end=n == 0)
+        return n
+
+    def stream(self, amt=2 ** 16, *args, **kwargs):
+        for data in self._raw.stream(amt, *args, **kwargs):
+            self._write(data, end=False)
+            yield data
+        self._write(b'', end=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._body_path)
+        self._raw.close()
+
+
+class clingen_session:
+    """
+    Thread-safe wrapper around a single pooled requests.Session used to query ClinGen
+    Bounds the number of in-flight requests and the request rate for each host and
+    retries failed requests with exponential backoff
+    Exposes a get() method with the same call signature as requests.get so it can be
+    passed anywhere the requests module was previously used
+    """
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_per_host=4, rate_limit=None, retries=3, backoff=1.0, timeout=60, cache=None):
+        """
+        Args:
+            max_per_host (int): Maximum number of concurrent requests to a single host
+            rate_limit (float): Maximum number of requests per second to a single host. None disables the limit
+            retries (int): Number of times a failed request is retried before giving up
+            backoff (float): Base delay in seconds, doubled after every failed attempt
+            timeout (float): Timeout in seconds passed to every request
+            cache (response_cache): Optional on-disk cache consulted before every request
+        """
+        self.max_per_host = max_per_host
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_per_host, pool_maxsize=max_per_host)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._host_next_request = {}
+
+    def _host_semaphore(self, host):
+        """
+        Internal method returning the semaphore bounding concurrency for a host
+        """
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_semaphores[host]
+
+    def _wait_for_rate_limit(self, host):
+        """
+        Internal method that blocks until the next request slot for a host is available
+        Slots are reserved under a lock so concurrent workers are spaced evenly
+        """
+        if not self.rate_limit:
+            return
+        interval = 1.0 / self.rate_limit
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._host_next_request.get(host, now))
+            self._host_next_request[host] = slot + interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _retry_delay(self, attempt, response=None):
+        """
+        Internal method returning the delay before the next attempt
+        Honours a numeric Retry-After header when the server sends one
+        """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    def get(self, url, params=None, **kwargs):
+        """
+        Make a GET request through the cache and the pooled session
+        Fresh cached responses are returned without a request. Stale cached responses are
+        revalidated and reused if the server answers 304 Not Modified
+
+        Args:
+            url (str): URL to request
+            params (dict): Query parameters
+            **kwargs: Additional arguments passed to requests.Session.get
+
+        Returns:
+            requests.Response: Response of the last attempt. Responses with a retryable
+            status code are returned once all retries have been used, matching requests.get
+        """
+        if self.cache is None:
+            return self._get(url, params=params, **kwargs)
+
+        key = self.cache.key(url, params)
+        cached = self.cache.load(key)
+        # Entries written before only successful responses were cached are not used
+        if cached is not None and not self.cache.cacheable(cached[0]):
+            cached = None
+        if self.cache.replay:
+            if cached is None:
+                raise CacheMissError(f'No cached response for {url} {params or ""}')
+            return cached[0]
+        if cached is not None:
+            cached_response, meta = cached
+            if self.cache.is_fresh(meta):
+                return cached_response
+            validators = self.cache.validators(meta)
+            if validators:
+                kwargs['headers'] = {**(kwargs.get('headers') or {}), **validators}
+
+        response = self._get(url, params=params, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(key)
+            return cached_response
+        if self.cache.cacheable(response):
+            if kwargs.get('stream'):
+                self.cache.stream(key, response)
+            else:
+                self.cache.store(key, response)
+        return response
+
+    def _get(self, url, **kwargs):
+        """
+        Internal method making a GET request with concurrency and rate limits and retries
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        semaphore = self._host_semaphore(host)
+
+        for attempt in range(self.retries + 1):
+            self._wait_for_rate_limit(host)
+            try:
+                with semaphore:
+                    response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code not in self.retry_status or attempt == self.retries:
+                return response
+            # Release the connection of streamed responses before retrying
+            response.close()
+            time.sleep(self._retry_delay(attempt, response))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
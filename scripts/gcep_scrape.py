@@ -1,30 +1,78 @@
 import requests
-from bs4 import BeautifulSoup
 import pandas as pd
-import re
-from io import StringIO
+import clingen_html
+import scrape_phenotypes
+from stage_metrics import stage
 
 class gcep_scrape:
     """
     Class that takes parameters scrape the GCEP HTML site and parses response data
     Includes methods to return data in a variety of formats
     """    
-    def __init__(self, hgnc_id):
+    def __init__(self, hgnc_id, session=None, parser=None, base_url=None, clean_phenotypes=False):
+        """
+        Args:
+            hgnc_id (str): HGNC ID of the gene to scrape, e.g. "HGNC:11936"
+            session (gcep_http.clingen_session, optional): Shared session used for all requests.
+                Allows many gcep_scrape objects to reuse pooled connections. Defaults to the
+                requests module.
+            parser (str, optional): clingen_html backend used to parse pages, "lxml" or "bs4".
+                Defaults to clingen_html.default_backend
+            base_url (str, optional): Base URL of the ClinGen website, e.g. a local server replaying
+                recorded pages. Defaults to https://search.clinicalgenome.org
+            clean_phenotypes (bool, optional): Parse phenotypes with scrape_phenotypes clean=True,
+                stripping separators from HPO terms and finding HPO terms after the free text.
+                Defaults to the original parsing
+        """
         self.hgnc_id = hgnc_id
-        self.clingen_base_url = 'https://search.clinicalgenome.org'
+        self.session = session if session is not None else requests
+        self.parser = parser
+        self.clean_phenotypes = clean_phenotypes
+        self.clingen_base_url = base_url or 'https://search.clinicalgenome.org'
         self.clingen_gene_url = f"{self.clingen_base_url}/kb/genes/{self.hgnc_id}"
-        self.gene_response = requests.get(self.clingen_gene_url)
+        self.gene_response = self._fetch(self.clingen_gene_url, 'gene')
+        self.gene_page = self._parse_gene_page()
         self.valid_gene = self._valid_gene() 
         self.disease_entries = self._get_clingen_disease_entries()
         self.valid_entry = self.disease_entries is not None    
         
         if self.valid_entry:
-            self.disease_responses = [requests.get(x) for x in self.disease_entries]
-            self.table = pd.concat([self._get_table(x) for x in self.disease_responses], ignore_index=True)
+            self.disease_responses = [self._fetch(x, 'disease') for x in self.disease_entries]
+            self.disease_responses = [x for x in self.disease_responses if x.status_code != 404]
+            self.valid_entry = len(self.disease_responses) > 0
+
+        if self.valid_entry:
+            self.table = self._get_table(self.disease_responses)
         else:
             self.disease_responses = None
             self.table = None
             
+    def _fetch(self, url, page):
+        """
+        Internal method requesting a page, recorded as a scrape.fetch stage
+        A page that is not found is returned, any other response than 200 raises requests.HTTPError,
+        so a failed request, e.g. a 503 after all retries, is not taken for a gene without curations
+        """
+        with stage('scrape.fetch', hgnc_id=self.hgnc_id, page=page) as metrics:
+            response = self.session.get(url)
+            metrics.add(bytes=len(response.content), status_code=response.status_code)
+        if response.status_code not in (200, 404):
+            raise requests.HTTPError(f'{response.status_code} response for {page} page {url}', response=response)
+        return response
+
+    def _parse_gene_page(self):
+        """
+        Internal method that parses the gene page once for use by _valid_gene
+        and _get_clingen_disease_entries
+
+        Returns:
+            dict: Output of clingen_html.parse_gene_page or None if the gene page was not found
+        """
+        if self.gene_response.status_code == 404:
+            return None
+        with stage('scrape.parse', hgnc_id=self.hgnc_id, page='gene'):
+            return clingen_html.parse_gene_page(self.gene_response.text, self.parser)
+
     def _valid_gene(self):
         """
         Internal method to determine if the HGNC ID is valid
@@ -32,14 +80,10 @@ class gcep_scrape:
         Returns:
             _type_: _description_
         """
-        if self.gene_response.status_code != 200:
+        if self.gene_page is None:
             return False
         else: 
-            soup = BeautifulSoup(self.gene_response.text, 'html.parser')
-            error_header = soup.find('h1', string='Error retrieving Gene details')
-            error_div = soup.find('div', {'class': 'alert-danger'})
-            
-            return not (error_header or error_div)
+            return self.gene_page['valid']
 
     def _get_clingen_disease_entries(self):
         """If an HGNC ID is valid, determine if there are any gene-disease curations
@@ -51,101 +95,14 @@ class gcep_scrape:
         if not self.valid_gene:
             return None
         else:
-            soup = BeautifulSoup(self.gene_response.text, 'html.parser')
-            links = soup.find_all('a', class_='btn btn-xs btn-success btn-block btn-report')
-            output = [link.get('href') for link in links if link.get('href').startswith('/kb/gene-validity/CGGV:assertion')]
+            links = self.gene_page['disease_links']
+            output = [link for link in links if link and link.startswith(clingen_html.DISEASE_LINK_PREFIX)]
             output = [f'{self.clingen_base_url}{link}' for link in output]
             if len(output) == 0:
                 return None
             return output
         
-    def _parse_hpo_free_text(self, input_string):
-        """
-        Takes a string of format "HPO terms(s): HPO term (HPO_ID), HPO term (HPO_ID) Free text: Free text"
-        or "Free text: Free text HPO terms(s): HPO term (HPO_ID), HPO term (HPO_ID)"
-        and returns a dictionary with keys "phenotype_hpo" and "phenotype_text"
-
-        Args:
-            input_string (_type_): _description_
-
-        Returns:
-            _type_: _description_
-        """
-        if type(input_string) != str:
-            return None
-                
-        hpo_terms_start = "HPO terms(s):"
-        free_text_start = "Free text:"
-
-        hpo_terms_index = input_string.find(hpo_terms_start)
-        free_text_index = input_string.find(free_text_start)
-
-        hpo_terms = None
-        free_text = None
-
-        if hpo_terms_index != -1:
-            if free_text_index != -1:
-                hpo_terms = input_string[hpo_terms_index + len(hpo_terms_start):free_text_index].strip()
-            else:
-                hpo_terms = input_string[hpo_terms_index + len(hpo_terms_start):].strip()
-
-        if free_text_index != -1:
-            free_text = input_string[free_text_index + len(free_text_start):].strip()
-
-        return {"phenotype_hpo": hpo_terms, "phenotype_text": free_text}
-    
-    def _format_hpo_list(self, hpo_string):
-        """
-        Converts a string of HPO terms into a list of HPO terms.
-
-        Args:
-            hpo_string (str): A string containing HPO terms.
-
-        Returns:
-            list: A list of HPO terms.
-        """
-        if hpo_string is None:
-            return None
-        else:
-            pattern = r"([^()]+?\(HP:\d+\))"
-            matches = re.findall(pattern, hpo_string)
-            return matches
-    
-    def _format_hpo_string(self, hpo_str):
-        """
-        Internal method used to reformat how HPO terms are stored in GCEP json data
-        Intake format from GCEP JSON follows pattern "HPO term (HPO_ID)"
-        Output format is a dictionary with keys "HPO_ID" and "HPO_term"
-        This allows the HPO_ID to be used with HPO3 module for further analysis
-        
-        Args:
-            hpo_str (_type_): _description_
-
-        Returns:
-            _type_: _description_
-        """        
-        try: 
-            match = re.match(r"(.+?)\s*\((HP:\d+)\)", hpo_str)
-            if match:
-                hpo_dict = {
-                    "HPO_ID": match.group(2),
-                    "HPO_term": match.group(1)
-                }
-                return hpo_dict
-            else:
-                hpo_dict = {
-                    "HPO_ID": None,
-                    "HPO_term": None
-                }
-                return hpo_dict
-        except:
-            hpo_dict = {
-                    "HPO_ID": None,
-                    "HPO_term": None
-                }
-            return hpo_dict
-        
-    def _get_disease_features(self, disease_response):
+    def _get_disease_features(self, disease_page):
         """
         Get additional data for gene-disease relationship that occurs
         outside of proband table. This inlcudes the disease name, the
@@ -154,65 +111,59 @@ class gcep_scrape:
         the gene-disease relationship
 
         Args:
-            disease_response (_type_): _description_
+            disease_page (dict): Parsed disease page from clingen_html.parse_disease_page
 
         Returns:
             _type_: _description_
         """        
-        
-        soup = BeautifulSoup(disease_response.text, 'html.parser')
-        
-        # Get MONDO disease ID
-        mondo_tag = soup.find('div', string=re.compile(r"MONDO:\d+"))
-        if mondo_tag:
-            mondo =  mondo_tag.text
-        else:
-            mondo = None
-        
-        # Get gene-disease calssification status
-        target_href = "https://www.clinicalgenome.org/docs/gene-disease-validity-classification-information/"
-        classification_tag = soup.find("a", href=target_href)
-        if classification_tag:
-            classification = classification_tag.get_text(strip=True)
-        else:
-            classification = None
-        
-        # Get additional stats in <dt><dd> structure    
-        dt_output = []
-        for dt in soup.find_all('dt'):
-            entry = ' '.join(dt.find_all(string=True, recursive=False)).strip()
-            entry = entry.split(':')[0]
-            entry = entry.replace('\n', '')
-            entry = entry.rstrip()
-            dt_output.append(entry)
-            
-        dd_output = []
-        for dd in soup.find_all('dd'):
-            entry = ' '.join(dd.find_all(string=True, recursive=False)).strip()
-            entry = entry.split(':')[0]
-            entry = entry.replace('\n', '')
-            entry = entry.rstrip()
-            dd_output.append(entry)
-            
-        # Compile data into dictionary   
-        output_dict = dict(zip(dt_output, dd_output))
+        output_dict = disease_page['fields']
         output_dict = {k:output_dict.get(k) for k in output_dict.keys() if k in ['Gene', 'Disease', 'Mode of Inheritance', 'Expert Panel']}
-        output_dict.update({"MONDO": mondo, "classification": classification})
+        output_dict.update({"MONDO": disease_page['mondo'], "classification": disease_page['classification']})
         return output_dict
     
-    def _get_table(self, disease_response):
-        disease_features = self._get_disease_features(disease_response)
-                
-        soup = BeautifulSoup(disease_response.text, 'html.parser')
-        table = soup.find('table', {'id': 'geclv'})
-        df_proband = pd.read_html(StringIO(str(table)))[0]
-        
-        # Split phenotype string in to HPO terms and free text
-        df_hpo = df_proband['Proband Phenotypes'].apply(self._parse_hpo_free_text)        
-        df_proband['HPO terms'] = df_hpo.apply(lambda x: x['phenotype_hpo'] if x else None)
-        df_proband['HPO terms'] = df_proband['HPO terms'].apply(self._format_hpo_list) 
-        df_proband['HPO free text'] = df_hpo.apply(lambda x: x['phenotype_text'] if x else None)
-        df_proband.drop(columns=['Proband Phenotypes'], inplace=True)
+    def _get_table(self, disease_responses):
+        """
+        Internal method building the proband table of all disease pages of the gene
+        Pages are parsed one by one and their phenotype cells parsed together in one bulk pass
+        """
+        disease_pages, tables = [], []
+        for disease_response in disease_responses:
+            # Parse the page once and build the proband table directly from the extracted cells
+            with stage('scrape.parse', hgnc_id=self.hgnc_id, page='disease') as metrics:
+                disease_page = clingen_html.parse_disease_page(disease_response.text, self.parser)
+                metrics.add(rows=len(disease_page['proband_rows'][1]) if disease_page['proband_rows'] else 0)
+            disease_pages.append(disease_page)
+            tables.append(clingen_html.rows_to_frame(disease_page['proband_rows']))
+        with stage('scrape.table', hgnc_id=self.hgnc_id) as metrics:
+            # Split phenotype strings of all pages in to HPO terms and free text at once
+            phenotypes = scrape_phenotypes.parse_phenotypes(
+                pd.concat([x[scrape_phenotypes.phenotype_column] for x in tables], ignore_index=True),
+                clean=self.clean_phenotypes
+            )
+            output = []
+            start = 0
+            for disease_page, df_proband in zip(disease_pages, tables):
+                output.append(self._build_table(disease_page, df_proband, phenotypes.iloc[start:start + len(df_proband)]))
+                start += len(df_proband)
+            df_proband = pd.concat(output, ignore_index=True)
+            metrics.add(rows=len(df_proband))
+        return df_proband
+
+    def _build_table(self, disease_page, df_proband, phenotypes):
+        """
+        Internal method completing the proband table of a disease page with its parsed phenotypes
+        and the gene-disease features of the page
+
+        Args:
+            disease_page (dict): Parsed disease page from clingen_html.parse_disease_page
+            df_proband (pd.DataFrame): Proband table of the page from clingen_html.rows_to_frame
+            phenotypes (pd.DataFrame): Rows of scrape_phenotypes.parse_phenotypes for the probands of the page
+        """
+        disease_features = self._get_disease_features(disease_page)
+        phenotypes = phenotypes.set_axis(df_proband.index)
+        df_proband['HPO terms'] = phenotypes['HPO terms']
+        df_proband['HPO free text'] = phenotypes['HPO free text']
+        df_proband.drop(columns=[scrape_phenotypes.phenotype_column], inplace=True)
         
         df_proband.insert(0, 'Gene', disease_features['Gene'])
         df_proband.insert(1, 'HGNC', self.hgnc_id)
@@ -230,7 +181,7 @@ class gcep_scrape:
         """
         Takes data from self.table and returns a new table for each HPO term for every 
         Gene-Disease-proband combination
-        Includes application of _format_hpo_string to reformat HPO terms
+        HPO_ID and HPO_term are extracted from all HPO terms at once with scrape_phenotypes.hpo_table
 
         Returns:
             _type_: _description_
@@ -238,11 +189,11 @@ class gcep_scrape:
         if not self.valid_entry:
             return None
         else:                 
-            df = self.table
-            df = df[['Gene', 'Disease', "MONDO", 'label','HPO terms']].explode("HPO terms", ignore_index=True)
-            df['HPO terms'] = df['HPO terms'].apply(self._format_hpo_string) 
-            df = df.join(pd.json_normalize(df.pop('HPO terms')))
-            df = df.dropna(subset=['HPO_ID'])
+            with stage('scrape.hpo_table', hgnc_id=self.hgnc_id) as metrics:
+                df = scrape_phenotypes.hpo_table(
+                    self.table, columns=['Gene', 'Disease', 'MONDO', 'label'], clean=self.clean_phenotypes
+                )
+                metrics.add(rows=len(df))
             return df
     
 def gcep_diagnostics(HGNC_ID):
@@ -3,32 +3,221 @@ from pyprojroot.here import here
 import argparse
 import pandas as pd
 import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 here()
 sys.path.insert(0, here('scripts'))
 from gcep_scrape import gcep_scrape
+from gcep_http import clingen_session, response_cache
+from scrape_manifest import scrape_manifest
+import stage_metrics
+
+
+def read_hgnc_ids(args):
+    """
+    Collect HGNC IDs to scrape from the command line arguments
+    IDs passed with --hgnc_list and lines of --hgnc_file are combined in order with
+    duplicates removed. Falls back to the single positional HGNC_ID
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+
+    Returns:
+        list: HGNC IDs to scrape
+    """
+    hgnc_ids = list(args.hgnc_list or [])
+    if args.hgnc_file:
+        with open(args.hgnc_file) as f:
+            hgnc_ids += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not hgnc_ids:
+        hgnc_ids = [args.HGNC_ID]
+    return list(dict.fromkeys(hgnc_ids))
+
+
+def save_gcep_query(gcep_query, save_dir):
+    """
+    Write the proband table and HPO table of a gcep_scrape object to save_dir
+
+    Args:
+        gcep_query (gcep_scrape): Completed scrape of a single gene
+        save_dir (str): Directory to save output files
+
+    Returns:
+        list: Paths of the written files
+    """
+    outputs = []
+    if gcep_query.valid_entry:
+        df_hpo=gcep_query.hpo_table()
+        with stage_metrics.stage('scrape.write', hgnc_id=gcep_query.hgnc_id) as metrics:
+            table_path = f'{save_dir}/{gcep_query.hgnc_id.replace(":", "_")}.pkl.gz'
+            with gzip.open(table_path, 'wb') as f:
+                gcep_query.table.to_pickle(f)
+            outputs.append(table_path)
+            if not df_hpo.empty:
+                hpo_path = f'{save_dir}/{gcep_query.hgnc_id.replace(":", "_")}_hpo.csv'
+                df_hpo.to_csv(hpo_path, index=False)
+                outputs.append(hpo_path)
+            metrics.add(rows=len(gcep_query.table), bytes=sum(os.path.getsize(x) for x in outputs))
+    return outputs
+
+
+def scrape_gene(hgnc_id, save_dir, session, manifest=None):
+    """
+    Scrape a single gene and save its output files
+
+    Args:
+        hgnc_id (str): The gene HGNC ID to scrape
+        save_dir (str): Directory to save output files
+        session (clingen_session): Shared session used for all requests
+        manifest (scrape_manifest): Optional manifest recording the attempt
+
+    Returns:
+        bool: Whether the gene had a valid ClinGen entry
+    """
+    print(f'### STARTING {hgnc_id}', file=sys.stderr)
+    if manifest is not None:
+        manifest.start(hgnc_id)
+    try:
+        with stage_metrics.stage('scrape.gene', hgnc_id=hgnc_id) as metrics:
+            gcep_query = gcep_scrape(hgnc_id, session=session)
+            outputs = save_gcep_query(gcep_query, save_dir)
+            metrics.add(rows=len(gcep_query.table) if gcep_query.valid_entry else 0, valid_entry=gcep_query.valid_entry)
+    except Exception as e:
+        if manifest is not None:
+            manifest.fail(hgnc_id, e)
+        raise
+    if manifest is not None:
+        manifest.finish(hgnc_id, gcep_query.valid_entry, outputs)
+    return gcep_query.valid_entry
+
+
+def run_batch(hgnc_ids, save_dir, session, workers, manifest=None):
+    """
+    Scrape genes concurrently, printing HGNC_ID and valid_entry of each finished gene
+
+    Args:
+        hgnc_ids (list): HGNC IDs to scrape
+        save_dir (str): Directory to save output files
+        session (clingen_session): Shared session used for all requests
+        workers (int): Number of genes scraped concurrently
+        manifest (scrape_manifest): Optional manifest recording every attempt
+
+    Returns:
+        list: HGNC IDs that failed
+    """
+    failed = []
+    if not hgnc_ids:
+        return failed
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(hgnc_ids)))
+    futures = {executor.submit(scrape_gene, x, save_dir, session, manifest): x for x in hgnc_ids}
+    try:
+        for future in as_completed(futures):
+            hgnc_id = futures[future]
+            try:
+                print(f'{hgnc_id}\t{future.result()}', flush=True)
+            except Exception as e:
+                # A single failed gene should not stop the rest of the batch
+                failed.append(hgnc_id)
+                print(f'### FAILED {hgnc_id}: {type(e).__name__}: {e}', file=sys.stderr)
+    except KeyboardInterrupt:
+        # Drop queued genes and let running ones finish so the manifest stays consistent
+        print('### INTERRUPTED, waiting for running genes to finish', file=sys.stderr)
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return failed
+
+
+def run_manifest(hgnc_ids, args, session, manifest):
+    """
+    Scrape the genes of hgnc_ids that the manifest has not completed yet
+    Failed genes are retried in rounds with an exponential backoff until they reach max_attempts
+
+    Returns:
+        int: Number of genes of hgnc_ids that are still failed
+    """
+    manifest.add(hgnc_ids)
+    todo = manifest.todo(hgnc_ids, args.max_attempts)
+    print(f'### MANIFEST {len(hgnc_ids) - len(todo)} of {len(hgnc_ids)} genes need no work', file=sys.stderr)
+    retry_round = 0
+    try:
+        while todo:
+            failed = run_batch(todo, args.SAVE_DIR, session, args.workers, manifest)
+            todo = manifest.todo(failed, args.max_attempts)
+            if todo:
+                delay = args.retry_backoff * 2 ** retry_round
+                print(f'### RETRYING {len(todo)} failed genes in {delay:.0f}s', file=sys.stderr)
+                time.sleep(delay)
+                retry_round += 1
+    except KeyboardInterrupt:
+        manifest.reset(hgnc_ids)
+        print(f'### INTERRUPTED, resume with --manifest {args.manifest}', file=sys.stderr)
+        raise
+    hgnc_ids = set(hgnc_ids)
+    failures = manifest.failures()
+    failures = failures[failures['hgnc_id'].isin(hgnc_ids)]
+    for row in failures.itertuples():
+        print(f'### GAVE UP {row.hgnc_id} after {row.attempts} attempts: {row.error_class}: {row.error_message}', file=sys.stderr)
+    return len(failures)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Scrape ClinGen probands")
     parser.add_argument('HGNC_ID', type=str, nargs='?', default="HGNC:12731", help='The gene HGNC ID to scrape')
     parser.add_argument('SAVE_DIR', type=str, nargs='?', default = here(), help='Directory to save output files')
+    parser.add_argument('--hgnc_list', type=str, nargs='+', help='Multiple HGNC IDs to scrape in one process')
+    parser.add_argument('--hgnc_file', type=str, help='File with one HGNC ID per line to scrape in one process')
+    parser.add_argument('--workers', type=int, default=8, help='Number of genes scraped concurrently')
+    parser.add_argument('--max_per_host', type=int, default=4, help='Maximum concurrent requests to the ClinGen host')
+    parser.add_argument('--rate_limit', type=float, default=None, help='Maximum requests per second to the ClinGen host')
+    parser.add_argument('--retries', type=int, default=3, help='Number of retries for failed requests')
+    parser.add_argument('--backoff', type=float, default=1.0, help='Base delay in seconds between retries, doubled after every attempt')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of an on-disk HTTP response cache. Disabled if not set')
+    parser.add_argument('--cache_ttl', type=float, default=None, help='Hours after which cached responses are revalidated. Never if not set')
+    parser.add_argument('--cache_max_mb', type=float, default=None, help='Maximum size of the response cache in MB')
+    parser.add_argument('--replay', action='store_true', help='Serve all requests from --cache_dir only, without network access')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='SQLite manifest of the job. Genes already done are skipped and the run can be resumed after a crash or Ctrl-C')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Maximum number of attempts per gene recorded in --manifest')
+    parser.add_argument('--retry_backoff', type=float, default=30.0,
+                        help='Seconds to wait before retrying failed genes with --manifest, doubled after every round')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='JSON lines file that timing, bytes, rows and peak RSS of every stage are appended to')
+    parser.add_argument('--profile_dir', type=str, default=None, help='Directory a cProfile dump of every stage is written to')
     args = parser.parse_args()
-    
-    print(f'### STARTING {args.HGNC_ID}', file=sys.stderr)
-    
-    
-    gcep_query = gcep_scrape(args.HGNC_ID)
-    print(f'{args.HGNC_ID}\t{gcep_query.valid_entry}')
-
-        
-    if gcep_query.valid_entry:
-        with gzip.open(f'{args.SAVE_DIR}/{args.HGNC_ID.replace(":", "_")}.pkl.gz', 'wb') as f:
-            gcep_query.table.to_pickle(f)
-        df_hpo=gcep_query.hpo_table()
-        if not df_hpo.empty:
-            df_hpo.to_csv(f'{args.SAVE_DIR}/{args.HGNC_ID.replace(':', '_')}_hpo.csv' , index=False)
+    stage_metrics.configure(args.metrics, args.profile_dir)
+
+    hgnc_ids = read_hgnc_ids(args)
+    if args.replay and not args.cache_dir:
+        parser.error('--replay requires --cache_dir')
+    cache = None
+    if args.cache_dir:
+        cache = response_cache(
+            args.cache_dir,
+            ttl=args.cache_ttl * 3600 if args.cache_ttl is not None else None,
+            max_bytes=int(args.cache_max_mb * 1e6) if args.cache_max_mb is not None else None,
+            replay=args.replay
+        )
+    session = clingen_session(
+        max_per_host=args.max_per_host,
+        rate_limit=args.rate_limit,
+        retries=args.retries,
+        backoff=args.backoff,
+        cache=cache
+    )
+
+    with session:
+        if args.manifest is None:
+            n_failed = len(run_batch(hgnc_ids, args.SAVE_DIR, session, args.workers))
+        else:
+            with scrape_manifest(args.manifest) as manifest:
+                n_failed = run_manifest(hgnc_ids, args, session, manifest)
+
+    if n_failed:
+        sys.exit(1)
 
 
 if __name__ ==  "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,201 @@
+import sys
+import argparse
+import h5py
+import numpy as np
+
+linkages = ['mean', 'min', 'max', 'medoid']
+cohesion_columns = ['size', 'within_mean', 'within_min', 'within_max', 'between_mean', 'cohesion_ratio', 'medoid_row']
+
+
+def _decode(dataset):
+    return [x.decode() for x in dataset[:]]
+
+
+def read_groups(f, by):
+    """
+    Return the group names and the group-sorted row indices of the probands of f
+
+    Args:
+        f (h5py.File): HDF5 file written by create_hpo_distance_object.py
+        by (str): 'gene' or 'disease'
+
+    Returns:
+        tuple: (names, indptr, rows) where rows[indptr[i]:indptr[i + 1]] are the rows of names[i]
+    """
+    metadata = f['proband_metadata']
+    if f'{by}_index' in metadata:
+        index = metadata[f'{by}_index']
+        return _decode(index['names']), index['indptr'][:], index['rows'][:]
+    # Files without a stored index, same ordering as hpo_h5._write_group_index
+    names, inverse = np.unique(np.array(_decode(metadata[by]), dtype=str), return_inverse=True)
+    rows = np.argsort(inverse, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(names)))])
+    return names.tolist(), indptr, rows
+
+
+def aggregate_distance(dataset, indptr, rows, linkage=linkages, chunk_rows=1024):
+    """
+    Reduce a square proband distance matrix to a group x group matrix for each linkage
+    The matrix is read once in row chunks. Columns of each chunk are put in group order so
+    that every group is a contiguous block reduced with ufunc.reduceat, and the reduced rows
+    are accumulated into their group. Medoids are found from the within-group row sums and
+    their rows read in a second, G-row pass, so the cost is linear in the size of the matrix
+
+    Distances of a proband to itself are excluded, so the diagonal of mean, min and max is
+    the within-group mean, minimum and maximum distance between different probands, and is
+    NaN for groups of one proband
+
+    Args:
+        dataset (h5py.Dataset or np.ndarray): Square proband distance matrix
+        indptr (np.ndarray): Group row pointers into rows, see read_groups
+        rows (np.ndarray): Group-sorted proband rows
+        linkage (list): Linkages to compute, each one of linkages
+        chunk_rows (int): Number of matrix rows read at once
+
+    Returns:
+        tuple: (dict of linkage to G x G matrix, dict of cohesion statistic to length G array)
+    """
+    unknown = [x for x in linkage if x not in linkages]
+    if unknown:
+        raise ValueError(f'linkage must be in {linkages}, not {unknown}')
+    n = dataset.shape[0]
+    n_groups = len(indptr) - 1
+    sizes = np.diff(indptr)
+    group_of = np.empty(n, dtype=np.int64)
+    group_of[rows] = np.repeat(np.arange(n_groups), sizes)
+    starts = indptr[:-1]
+
+    sums = np.zeros((n_groups, n_groups))
+    mins = np.full((n_groups, n_groups), np.inf)
+    maxs = np.full((n_groups, n_groups), -np.inf)
+    within_row_sum = np.zeros(n)
+    # Position of each row's own column in group order
+    self_cols = np.empty(n, dtype=np.int64)
+    self_cols[rows] = np.arange(n)
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        chunk_groups = group_of[start:stop]
+        dist = np.asarray(dataset[start:stop], dtype=np.float64)[:, rows]
+        diagonal = (np.arange(stop - start), self_cols[start:stop])
+
+        dist[diagonal] = 0
+        partial = np.add.reduceat(dist, starts, axis=1)
+        np.add.at(sums, chunk_groups, partial)
+        within_row_sum[start:stop] = partial[np.arange(stop - start), chunk_groups]
+        if 'min' in linkage:
+            dist[diagonal] = np.inf
+            np.minimum.at(mins, chunk_groups, np.minimum.reduceat(dist, starts, axis=1))
+        if 'max' in linkage:
+            dist[diagonal] = -np.inf
+            np.maximum.at(maxs, chunk_groups, np.maximum.reduceat(dist, starts, axis=1))
+
+    pairs = np.outer(sizes, sizes).astype(np.float64)
+    np.fill_diagonal(pairs, sizes * (sizes - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(pairs > 0, sums / pairs, np.nan)
+    singletons = sizes < 2
+    mins[singletons, singletons] = np.nan
+    maxs[singletons, singletons] = np.nan
+
+    # Medoid of each group: the proband with the lowest summed distance to the rest of its group
+    medoid_rows = np.array([
+        rows[indptr[g] + np.argmin(within_row_sum[rows[indptr[g]:indptr[g + 1]]])] for g in range(n_groups)
+    ], dtype=np.int64)
+
+    output = {}
+    if 'mean' in linkage:
+        output['mean'] = mean
+    if 'min' in linkage:
+        output['min'] = mins
+    if 'max' in linkage:
+        output['max'] = maxs
+    if 'medoid' in linkage:
+        unique, inverse = np.unique(medoid_rows, return_inverse=True)
+        medoid_dist = np.asarray(dataset[unique, :], dtype=np.float64)[inverse]
+        output['medoid'] = medoid_dist[:, medoid_rows]
+
+    total_row_sum = sums.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between_mean = (total_row_sum - np.diag(sums)) / (sizes * (n - sizes))
+    within_mean = np.diag(mean)
+    cohesion = {
+        'size': sizes,
+        'within_mean': within_mean,
+        'within_min': np.diag(mins) if 'min' in linkage else np.full(n_groups, np.nan),
+        'within_max': np.diag(maxs) if 'max' in linkage else np.full(n_groups, np.nan),
+        'between_mean': between_mean,
+        'cohesion_ratio': within_mean / between_mean,
+        'medoid_row': medoid_rows
+    }
+    return output, cohesion
+
+
+def write_aggregates(f, by, names, matrices, cohesion, **attrs):
+    """
+    Write aggregate matrices and cohesion statistics to aggregates/by of an open HDF5 file,
+    replacing the group if it exists
+    """
+    path = f'aggregates/{by}'
+    if path in f:
+        del f[path]
+    group = f.create_group(path)
+    group.create_dataset('names', data=np.array(names, dtype='S'))
+    for name, mtx in matrices.items():
+        group.create_dataset(name, data=mtx)
+    cohesion_group = group.create_group('cohesion')
+    for name, values in cohesion.items():
+        cohesion_group.create_dataset(name, data=values)
+    for key, value in attrs.items():
+        group.attrs[key] = value
+
+
+def read_aggregates(hf_path, by, linkage='mean'):
+    """
+    Read a group x group matrix and the cohesion statistics written by aggregate_distance_file
+
+    Returns:
+        tuple: (pd.DataFrame of the matrix indexed by group name, pd.DataFrame of cohesion statistics)
+    """
+    import pandas as pd
+    with h5py.File(hf_path, 'r') as f:
+        group = f[f'aggregates/{by}']
+        names = _decode(group['names'])
+        df_mtx = pd.DataFrame(group[linkage][:], index=names, columns=names)
+        df_cohesion = pd.DataFrame({x: group[f'cohesion/{x}'][:] for x in cohesion_columns}, index=names)
+    return df_mtx, df_cohesion
+
+
+def aggregate_distance_file(hf_path, by=('gene', 'disease'), linkage=linkages, kind='proband', chunk_rows=1024):
+    """
+    Aggregate a proband distance matrix of an HDF5 file written by create_hpo_distance_object.py
+    into gene x gene and/or disease x disease matrices written back to the same file
+
+    Args:
+        hf_path (str): Path of the HDF5 file
+        by (list): Groupings, 'gene' and/or 'disease'
+        linkage (list): Linkages to compute, each one of linkages
+        kind (str): 'proband' or the name of a metric sweep dataset
+        chunk_rows (int): Number of matrix rows read at once
+    """
+    matrix_path = 'proband_distance' if kind == 'proband' else f'metrics/{kind}'
+    with h5py.File(hf_path, 'a') as f:
+        for grouping in by:
+            names, indptr, rows = read_groups(f, grouping)
+            matrices, cohesion = aggregate_distance(f[matrix_path], indptr, rows, linkage, chunk_rows)
+            write_aggregates(f, grouping, names, matrices, cohesion, matrix=kind)
+            print(f'Aggregated {len(rows)} probands into {len(names)} {grouping} groups', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gene and disease level aggregates of a proband distance matrix")
+    parser.add_argument('HF_PATH', type=str, help='HDF5 file written by create_hpo_distance_object.py')
+    parser.add_argument('--by', type=str, nargs='+', default=['gene', 'disease'], choices=['gene', 'disease'], help='Groupings')
+    parser.add_argument('--linkage', type=str, nargs='+', default=linkages, choices=linkages, help='Linkages to compute')
+    parser.add_argument('--kind', type=str, default='proband', help="'proband' or a metric sweep dataset name")
+    parser.add_argument('--chunk_rows', type=int, default=1024, help='Number of matrix rows read at once')
+    args = parser.parse_args()
+    aggregate_distance_file(args.HF_PATH, args.by, args.linkage, args.kind, args.chunk_rows)
+
+
+if __name__ == "__main__":
+    main()
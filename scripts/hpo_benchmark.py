@@ -0,0 +1,746 @@
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, unquote
+import numpy as np
+import pandas as pd
+from stage_metrics import peak_rss_mb
+
+BENCHMARK_FORMAT_VERSION = 1
+# Genes of the gcep_scrape self test: one and two curations, no curation, invalid ID and curated without HPO terms
+fixture_hgnc_ids = ['HGNC:11936', 'HGNC:11364', 'HGNC:5', 'HGNC:123412341234', 'HGNC:23336', 'HGNC:20']
+fixture_benchmarks = ['parse', 'scrape', 'hpo_table', 'gcep', 'gcep_hpo_table']
+size_benchmarks = ['validation', 'cohort', 'distance', 'distance_engine', 'write', 'read', 'read_rows']
+benchmarks = fixture_benchmarks + size_benchmarks
+default_sizes = [100, 1000, 10000, 50000]
+
+
+def synthetic_hpo_table(n_probands, seed=0, terms_per_proband=8, probands_per_gene=20,
+                        shared_fraction=0.5, obsolete_fraction=0.01):
+    """
+    Deterministic synthetic proband HPO table sampled from the loaded HPO Ontology, in the layout of
+    gcep.hpo_table. Probands are split into genes of probands_per_gene probands with one disease each.
+    Every gene has a profile of terms its probands draw shared_fraction of their terms from, the rest
+    are drawn from all phenotypic abnormalities, so probands of a gene are closer than other probands.
+    obsolete_fraction of the IDs are obsolete terms, which validation remaps or drops
+    The same arguments and HPO release always give the same table
+
+    Args:
+        n_probands (int): Number of probands
+        seed (int): Seed of the random generator
+        terms_per_proband (int): Mean number of terms of a proband, at least 1
+        probands_per_gene (int): Number of probands of a gene
+        shared_fraction (float): Probability that a term is drawn from the gene profile
+        obsolete_fraction (float): Probability that a term is replaced by an obsolete term
+
+    Returns:
+        pd.DataFrame: Gene, Disease, label, HPO_ID and HPO_term, one row per term of a proband
+    """
+    from pyhpo import Ontology
+    rng = np.random.default_rng(seed)
+    root = Ontology[118]
+    terms = sorted((x for x in Ontology if not x.is_obsolete and x.child_of(root)), key=int)
+    obsolete = sorted((x for x in Ontology if x.is_obsolete), key=int)
+    term_ids = np.array([x.id for x in terms], dtype=object)
+    term_names = np.array([x.name for x in terms], dtype=object)
+
+    gene_of = np.arange(n_probands) // probands_per_gene
+    n_genes = int(gene_of[-1]) + 1 if n_probands else 0
+    profile_size = 2 * terms_per_proband
+    profiles = rng.integers(len(terms), size=(n_genes, profile_size))
+    n_terms = 1 + rng.poisson(terms_per_proband - 1, size=n_probands)
+    proband = np.repeat(np.arange(n_probands), n_terms)
+    shared = rng.random(len(proband)) < shared_fraction
+    rows = np.where(
+        shared,
+        profiles[gene_of[proband], rng.integers(profile_size, size=len(proband))],
+        rng.integers(len(terms), size=len(proband))
+    )
+    hpo_id, hpo_term = term_ids[rows], term_names[rows]
+    replaced = rng.random(len(proband)) < obsolete_fraction
+    picks = rng.integers(len(obsolete), size=int(replaced.sum()))
+    hpo_id[replaced] = [obsolete[i].id for i in picks]
+    hpo_term[replaced] = [obsolete[i].name for i in picks]
+
+    genes = np.array([f'GENE{i:05d}' for i in range(n_genes)], dtype=object)
+    diseases = np.array([f'Synthetic disease {i:05d}' for i in range(n_genes)], dtype=object)
+    df = pd.DataFrame({
+        'Gene': genes[gene_of[proband]],
+        'Disease': diseases[gene_of[proband]],
+        'label': [f'P{i:06d}' for i in proband],
+        'HPO_ID': hpo_id,
+        'HPO_term': hpo_term
+    })
+    return df.drop_duplicates(subset=['label', 'HPO_ID'], ignore_index=True)
+
+
+def _n_pairs(n):
+    return n * (n - 1) // 2
+
+
+def _gcep_kwargs(query):
+    """
+    gcep arguments of the query parameters of a recorded /snapshots request
+    """
+    return {k: query[k] for k in ['status', 'affiliation', 'start', 'end']}
+
+
+def _route(url):
+    """
+    Path and sorted query parameters a recorded response is served under
+    """
+    parts = urlsplit(url)
+    return unquote(parts.path), tuple(sorted(parse_qsl(parts.query)))
+
+
+class fixture_server:
+    """
+    Local stand-in for the ClinGen website and API replaying the responses recorded in a
+    gcep_http.response_cache directory, see record_fixtures. Requests are matched on path and
+    query parameters, so gcep_scrape objects with base_url and gcep objects with gcep_url set to
+    url fetch exactly the recorded gene pages, disease pages and snapshots. Raises ValueError if
+    the gene page of an expected gene was not recorded, and other requests get 500 instead of a
+    404 that gcep_scrape would take for a gene without curations
+    Started and stopped by using it as a context manager
+    """
+    def __init__(self, fixture_dir, port=0, hgnc_ids=fixture_hgnc_ids):
+        """
+        Args:
+            fixture_dir (str): response_cache directory of recorded responses
+            port (int): Port on 127.0.0.1, a free port if 0
+            hgnc_ids (list): HGNC IDs whose gene pages must be recorded, see record_fixtures
+        """
+        from gcep_http import response_cache
+        if not os.path.isdir(fixture_dir):
+            raise FileNotFoundError(f'No recorded fixtures in {fixture_dir}')
+        self.cache = response_cache(fixture_dir, replay=True)
+        self.recorded = {}
+        for key, meta in self.cache.items():
+            self.recorded[_route(meta['url'])] = (key, meta)
+        missing = sorted(set(hgnc_ids) - set(self.gene_ids()))
+        if missing:
+            raise ValueError(
+                f'Gene pages of {missing} are not recorded in {fixture_dir}, record them with '
+                f'python scripts/hpo_benchmark.py record --fixtures {fixture_dir}'
+            )
+        self.port = port
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def __len__(self):
+        return len(self.recorded)
+
+    def pages(self, prefix):
+        """
+        Recorded responses with status 200 whose path starts with prefix
+
+        Returns:
+            list: (path, query parameters, response) tuples sorted by path
+        """
+        output = []
+        for (path, query), (key, meta) in sorted(self.recorded.items()):
+            if path.startswith(prefix) and meta['status_code'] == 200:
+                output.append((path, dict(query), self.cache.load(key)[0]))
+        return output
+
+    def gene_ids(self):
+        """
+        HGNC IDs of all recorded gene pages, including invalid genes
+        """
+        return sorted(path.rsplit('/', 1)[-1] for path, _ in self.recorded if path.startswith('/kb/genes/'))
+
+    def snapshot_queries(self):
+        """
+        Path prefix and query parameters of all recorded /snapshots requests of the GCEP API
+        """
+        return [(path[:-len('/snapshots')], dict(query)) for path, query in sorted(self.recorded) if path.endswith('/snapshots')]
+
+    def _handler(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                entry = server.recorded.get(_route(self.path))
+                cached = server.cache.load(entry[0]) if entry is not None else None
+                if cached is None:
+                    self.send_error(500, f'Not recorded in {server.cache.cache_dir}')
+                    return
+                response, _ = cached
+                self.send_response(response.status_code)
+                for name, value in response.headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(response.content)))
+                self.end_headers()
+                self.wfile.write(response.content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), self._handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def record_fixtures(fixture_dir, hgnc_ids=fixture_hgnc_ids, gcep_queries=(), rate_limit=2, base_url=None):
+    """
+    Record the gene and disease pages of genes, and GCEP API snapshots, from the live ClinGen
+    website into a response_cache directory replayed by fixture_server. Responses already
+    recorded are not fetched again, remove fixture_dir to record them again
+
+    Args:
+        fixture_dir (str): Directory of the recorded responses
+        hgnc_ids (list): HGNC IDs of the genes whose pages are recorded
+        gcep_queries (list): Keyword arguments of gcep objects whose snapshots are recorded
+        rate_limit (float): Maximum number of requests per second
+        base_url (str): Base URL of the ClinGen website, see gcep_scrape
+
+    Returns:
+        int: Number of recorded responses
+    """
+    from gcep_http import clingen_session, response_cache
+    from gcep_scrape import gcep_scrape
+    session = clingen_session(cache=response_cache(fixture_dir), rate_limit=rate_limit)
+    for hgnc_id in hgnc_ids:
+        query = gcep_scrape(hgnc_id, session=session, base_url=base_url)
+        print(f'{hgnc_id}: {len(query.disease_entries or [])} curations', file=sys.stderr)
+    if gcep_queries:
+        from gcep import gcep
+        for kwargs in gcep_queries:
+            print(f'{len(gcep(session=session, **kwargs).json)} snapshots', file=sys.stderr)
+    return sum(1 for _ in session.cache.items())
+
+
+def _measure(fn, repeat):
+    """
+    Run fn once with tracemalloc to measure its peak allocation, then repeat times untraced to time it
+    tracemalloc sees allocations of Python and NumPy but not of hpo3 or HDF5
+
+    Returns:
+        tuple: (wall times in seconds, peak traced allocation in bytes, counters returned by fn)
+    """
+    tracemalloc.start()
+    try:
+        counters = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counters = fn()
+        times.append(time.perf_counter() - start)
+    return times, peak, counters
+
+
+class benchmark_suite:
+    """
+    Benchmarks of HTML parsing, hpo_table construction, HPO validation, distance computation and
+    HDF5 write/read on recorded ClinGen fixtures and deterministic synthetic cohorts
+
+    Every benchmark is run once traced to measure peak allocation and then repeat times to time it.
+    Results hold the wall times, the rows, bytes and pairs processed and their rates per second at the
+    median time, the peak traced allocation and the peak RSS of the process. Fixture benchmarks are
+    skipped without fixture_dir and matrix benchmarks are skipped for sizes with more than max_pairs pairs
+    """
+    def __init__(self, sizes=default_sizes, fixture_dir=None, seed=0, repeat=3, max_pairs=2_000_000,
+                 format_version=2, dtype='f4', layout='chunked', work_dir=None, hgnc_ids=fixture_hgnc_ids):
+        """
+        Args:
+            sizes (list): Numbers of probands of the synthetic cohorts
+            fixture_dir (str): response_cache directory of recorded ClinGen responses, see record_fixtures
+            seed (int): Seed of the synthetic cohorts
+            repeat (int): Number of timed runs of every benchmark
+            max_pairs (int): Maximum number of pairs of a matrix benchmark
+            format_version, dtype, layout: HDF5 storage of the write and read benchmarks, see hpo_h5.write_hpo_h5
+            work_dir (str): Directory of the written HDF5 files, a temporary directory if None
+            hgnc_ids (list): HGNC IDs whose gene pages must be recorded in fixture_dir
+        """
+        self.sizes = sizes
+        self.fixture_dir = fixture_dir
+        self.seed = seed
+        self.repeat = repeat
+        self.max_pairs = max_pairs
+        self.storage = {'format_version': format_version, 'dtype': dtype, 'layout': layout}
+        self.work_dir = work_dir
+        self.hgnc_ids = hgnc_ids
+        self._server = None
+        self._cache = {}
+
+    def config(self):
+        return {
+            'sizes': self.sizes, 'fixture_dir': self.fixture_dir, 'seed': self.seed, 'repeat': self.repeat,
+            'max_pairs': self.max_pairs, 'hgnc_ids': self.hgnc_ids, **self.storage
+        }
+
+    def _cached(self, key, build):
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    # Inputs shared by benchmarks, built once and outside the timed runs
+
+    def _table(self, n):
+        return self._cached(('table', n), lambda: synthetic_hpo_table(n, self.seed))
+
+    def _validated(self, n):
+        from hpo_validation import hpo_term_index
+        return self._cached(('validated', n), lambda: hpo_term_index().validate(self._table(n))[0])
+
+    def _cohort(self, n):
+        def build():
+            from hpo_cohort import hpo_cohort
+            df = self._validated(n).copy()
+            df['ID'] = df['Gene'] + '__' + df['Disease'] + '__' + df['label']
+            df_probands = df.drop_duplicates(subset=['Gene', 'Disease', 'label']).sort_values(['Gene', 'Disease', 'label'])
+            df_probands = df_probands[['Gene', 'Disease', 'label', 'ID']].reset_index(drop=True)
+            cohort = hpo_cohort.from_table(df, key_column='ID', term_column='HPO_ID', keys=df_probands['ID'])
+            df_probands['hpo_ids'] = cohort.hpo_id_strings()
+            return cohort, df_probands
+        return self._cached(('cohort', n), build)
+
+    def _h5_path(self, n):
+        return os.path.join(self.work_dir, f'synthetic_{n}.h5')
+
+    def _scrapes(self):
+        def build():
+            from gcep_scrape import gcep_scrape
+            return [gcep_scrape(x, base_url=self._server.url) for x in self._server.gene_ids()]
+        return self._cached('scrapes', build)
+
+    def _gcep_queries(self):
+        def build():
+            from gcep import gcep
+            return [
+                gcep(api_key='', gcep_url=f'{self._server.url}{prefix}', **_gcep_kwargs(query))
+                for prefix, query in self._server.snapshot_queries()
+            ]
+        return self._cached('gcep_queries', build)
+
+    # Benchmarks, each returns (size, timed function returning counters) or (size, reason it is skipped)
+
+    def _parse(self):
+        import clingen_html
+        pages = [(clingen_html.parse_gene_page, r.text) for _, _, r in self._server.pages('/kb/genes/')]
+        pages += [(clingen_html.parse_disease_page, r.text) for _, _, r in self._server.pages(clingen_html.DISEASE_LINK_PREFIX)]
+        n_bytes = sum(len(html.encode()) for _, html in pages)
+
+        def fn():
+            rows = 0
+            for parse, html in pages:
+                page = parse(html)
+                if page.get('proband_rows') is not None:
+                    rows += len(page['proband_rows'][1])
+            return {'rows': rows, 'bytes': n_bytes, 'pages': len(pages)}
+        return len(pages), fn
+
+    def _scrape(self):
+        from gcep_scrape import gcep_scrape
+        gene_ids = self._server.gene_ids()
+
+        def fn():
+            queries = [gcep_scrape(x, base_url=self._server.url) for x in gene_ids]
+            return {'rows': sum(len(x.table) for x in queries if x.valid_entry), 'genes': len(gene_ids)}
+        return len(gene_ids), fn
+
+    def _hpo_table(self):
+        queries = [x for x in self._scrapes() if x.valid_entry]
+
+        def fn():
+            return {'rows': sum(len(x.hpo_table()) for x in queries), 'input_rows': sum(len(x.table) for x in queries)}
+        return len(queries), fn
+
+    def _gcep(self):
+        if not self._server.snapshot_queries():
+            return None, 'no recorded /snapshots responses'
+        from gcep import gcep
+
+        def fn():
+            queries = [
+                gcep(api_key='', gcep_url=f'{self._server.url}{prefix}', **_gcep_kwargs(query))
+                for prefix, query in self._server.snapshot_queries()
+            ]
+            return {'rows': sum(len(x.hpo_table()) for x in queries), 'snapshots': sum(len(x.json) for x in queries)}
+        return len(self._server.snapshot_queries()), fn
+
+    def _gcep_hpo_table(self):
+        if not self._server.snapshot_queries():
+            return None, 'no recorded /snapshots responses'
+        from gcep import gcep
+        records = [x.json for x in self._gcep_queries()]
+
+        def fn():
+            rows = 0
+            for query, json_records in zip(self._gcep_queries(), records):
+                # A fresh object per run so proband_table and hpo_table are rebuilt from the fetched snapshots
+                table_query = gcep(api_key='', gcep_url=query.gcep_url, **_gcep_kwargs(query.params))
+                table_query.json = json_records
+                rows += len(table_query.hpo_table())
+            return {'rows': rows, 'snapshots': sum(len(x) for x in records)}
+        return len(records), fn
+
+    def _validation(self, n):
+        from hpo_validation import hpo_term_index
+        df = self._table(n)
+
+        def fn():
+            df_valid, report = hpo_term_index().validate(df)
+            return {'rows': len(df), 'remapped_or_dropped': len(report)}
+        return n, fn
+
+    def _cohort_benchmark(self, n):
+        from hpo_cohort import hpo_cohort
+        df = self._validated(n).copy()
+        df['ID'] = df['Gene'] + '__' + df['Disease'] + '__' + df['label']
+
+        def fn():
+            cohort = hpo_cohort.from_table(df, key_column='ID', term_column='HPO_ID')
+            return {'rows': len(df), 'bytes': cohort.nbytes, 'n_terms': len(cohort.term_codes)}
+        return n, fn
+
+    def _distance(self, n):
+        from hpo_distance import create_hpo_distance
+        hpo_sets = self._cohort(n)[0].hpo_sets()
+
+        def fn():
+            create_hpo_distance(hpo_sets)
+            return {'rows': n, 'pairs': _n_pairs(n)}
+        return n, fn
+
+    def _distance_engine(self, n):
+        from hpo_similarity import set_similarity_engine
+        cohort = self._cohort(n)[0]
+
+        def fn():
+            engine = set_similarity_engine.from_cohort(cohort, kind='omim', method='graphic')
+            engine.distance_matrix(combine='funSimAvg')
+            return {'rows': n, 'pairs': _n_pairs(n), 'n_terms': len(cohort.term_codes)}
+        return n, fn
+
+    def _write(self, n):
+        from hpo_h5 import write_hpo_h5
+        cohort, df_probands = self._cohort(n)
+        rng = np.random.default_rng(self.seed)
+        # Random symmetric distances, the term matrix is cut to the first terms fitting in max_pairs
+        mtx_proband = rng.random((n, n), dtype=np.float32)
+        mtx_proband = (mtx_proband + mtx_proband.T) / 2
+        np.fill_diagonal(mtx_proband, 0)
+        n_terms = len(cohort.term_codes)
+        while _n_pairs(n_terms) > self.max_pairs:
+            n_terms //= 2
+        mtx_hpo = rng.random((n_terms, n_terms), dtype=np.float32)
+        mtx_hpo = (mtx_hpo + mtx_hpo.T) / 2
+        np.fill_diagonal(mtx_hpo, 0)
+        df_hpo_meta = pd.DataFrame({'hpo_id': cohort.term_ids[:n_terms], 'hpo_name': cohort.term_ids[:n_terms]})
+        path = self._h5_path(n)
+
+        def fn():
+            write_hpo_h5(path, mtx_hpo, df_hpo_meta, mtx_proband, df_probands, **self.storage)
+            cohort.save(path)
+            return {'rows': n, 'bytes': os.path.getsize(path), 'pairs': _n_pairs(n) + _n_pairs(n_terms), 'n_terms': n_terms}
+        return n, fn
+
+    def _read(self, n):
+        from hpo_h5 import read_hpo_h5
+        path = self._h5_path(n)
+        if not os.path.exists(path):
+            return None, 'write benchmark was not run'
+
+        def fn():
+            output = read_hpo_h5(path)
+            return {'rows': len(output['proband_key']), 'bytes': os.path.getsize(path), 'pairs': _n_pairs(n)}
+        return n, fn
+
+    def _read_rows(self, n):
+        from hpo_h5 import hpo_distance_file
+        path = self._h5_path(n)
+        if not os.path.exists(path):
+            return None, 'write benchmark was not run'
+        keys = self._cohort(n)[1]['ID'].to_numpy()
+        picks = keys[np.random.default_rng(self.seed).integers(n, size=min(n, 256))]
+
+        def fn():
+            with hpo_distance_file(path) as f:
+                for key in picks:
+                    f.row(key)
+            return {'rows': len(picks), 'pairs': len(picks) * n}
+        return n, fn
+
+    def _case(self, name, size):
+        """
+        Set up one benchmark, returning (size, timed function) or (size, reason it is skipped)
+        """
+        if name in fixture_benchmarks:
+            if self._server is None:
+                return None, 'no fixture_dir'
+            return getattr(self, f'_{name}')()
+        if name in ['distance', 'distance_engine', 'write', 'read', 'read_rows'] and _n_pairs(size) > self.max_pairs:
+            return size, f'{_n_pairs(size)} pairs is more than max_pairs'
+        if name == 'cohort':
+            return self._cohort_benchmark(size)
+        return getattr(self, f'_{name}')(size)
+
+    def run(self, names=None):
+        """
+        Run benchmarks, all if names is None
+
+        Returns:
+            dict: Environment, configuration and a list of results, see write_results
+        """
+        names = names or benchmarks
+        unknown = set(names) - set(benchmarks)
+        if unknown:
+            raise ValueError(f'Unknown benchmarks {sorted(unknown)}, choose from {benchmarks}')
+        owns_work_dir = self.work_dir is None
+        if owns_work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='hpo_benchmark_')
+        if self.fixture_dir is not None and any(x in fixture_benchmarks for x in names):
+            self._server = fixture_server(self.fixture_dir, hgnc_ids=self.hgnc_ids).start()
+        started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        # Loads the Ontology the synthetic cohorts are sampled from
+        env = environment()
+        results = []
+        try:
+            cases = [(x, None) for x in fixture_benchmarks if x in names]
+            cases += [(x, n) for n in self.sizes for x in size_benchmarks if x in names]
+            for name, n in cases:
+                results.append(self._run_case(name, n))
+        finally:
+            if self._server is not None:
+                self._server.stop()
+                self._server = None
+            if owns_work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                self.work_dir = None
+            self._cache = {}
+        return {
+            'format_version': BENCHMARK_FORMAT_VERSION,
+            'started_at': started_at,
+            'environment': env,
+            'config': self.config(),
+            'results': results
+        }
+
+    def _run_case(self, name, n):
+        result = {'benchmark': name, 'size': n}
+        try:
+            size, fn = self._case(name, n)
+            result['size'] = size
+            if isinstance(fn, str):
+                result.update(status='skipped', reason=fn)
+            else:
+                times, peak, counters = _measure(fn, self.repeat)
+                result.update(_summary(times, peak, counters))
+        except Exception as e:
+            result.update(status=type(e).__name__, reason=str(e))
+        label = f'{name} {result["size"]}' if result['size'] is not None else name
+        if result['status'] == 'ok':
+            print(f'{label}: {result["median_s"]:.4f} s, {result["peak_alloc_mb"]:.1f} MB', file=sys.stderr)
+        else:
+            print(f'{label}: {result["status"]} ({result["reason"]})', file=sys.stderr)
+        return result
+
+
+def _summary(times, peak, counters):
+    median = statistics.median(times) if times else float('nan')
+    output = {
+        'status': 'ok',
+        'repeat': len(times),
+        'times_s': [round(x, 6) for x in times],
+        'best_s': round(min(times), 6) if times else None,
+        'median_s': round(median, 6)
+    }
+    output.update({'rows': 0, 'bytes': 0, 'pairs': 0})
+    output.update(counters)
+    if median > 0:
+        for key, rate, scale in [('rows', 'rows_per_s', 1), ('bytes', 'mb_per_s', 1e6), ('pairs', 'pairs_per_s', 1)]:
+            if output[key]:
+                output[rate] = round(output[key] / scale / median, 3)
+    output['peak_alloc_mb'] = round(peak / 2 ** 20, 3)
+    output['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return output
+
+
+def environment():
+    """
+    Versions and machine details recorded with every run, so only comparable runs are compared
+    """
+    import h5py
+    from pyhpo import Ontology
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    Ontology()
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'h5py': h5py.__version__,
+        'hpo_version': Ontology.version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def write_results(results, path):
+    """
+    Write the results of benchmark_suite.run as JSON
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def read_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('format_version', 1) > BENCHMARK_FORMAT_VERSION:
+        raise ValueError(f'Benchmark results format {results["format_version"]} is newer than {BENCHMARK_FORMAT_VERSION}')
+    return results
+
+
+def compare_results(base, new, threshold=0.1):
+    """
+    Compare two runs by benchmark and size. A benchmark regressed if its median time or its peak
+    traced allocation grew by more than threshold
+
+    Args:
+        base (dict): Results of the reference run
+        new (dict): Results of the run checked for regressions
+        threshold (float): Allowed relative increase, 0.1 allows 10%
+
+    Returns:
+        pd.DataFrame: Median times, peak allocations, their ratios new / base and a regression flag
+        of every benchmark that ran in both runs
+    """
+    columns = ['benchmark', 'size', 'median_s', 'peak_alloc_mb']
+    df_base, df_new = (
+        pd.DataFrame([x for x in results['results'] if x['status'] == 'ok'], columns=columns)
+        for results in (base, new)
+    )
+    df = df_base.merge(df_new, on=['benchmark', 'size'], suffixes=('_base', '_new'))
+    df['time_ratio'] = df['median_s_new'] / df['median_s_base']
+    df['alloc_ratio'] = df['peak_alloc_mb_new'] / df['peak_alloc_mb_base'].where(df['peak_alloc_mb_base'] > 0)
+    df['regression'] = (df['time_ratio'] > 1 + threshold) | (df['alloc_ratio'] > 1 + threshold)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the ClinGen scrape and HPO distance pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks and write their results as JSON')
+    run_parser.add_argument('--output', type=str, default=None,
+                            help='Results file, data/benchmarks/benchmark_[time].json if not given')
+    run_parser.add_argument('--benchmarks', type=str, nargs='+', default=None, choices=benchmarks, help='Benchmarks to run, all if not given')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='Numbers of probands of the synthetic cohorts')
+    run_parser.add_argument('--fixtures', type=str, default='data/benchmark_fixtures',
+                            help='Directory of recorded ClinGen responses, fixture benchmarks are skipped if it does not exist')
+    run_parser.add_argument('--hgnc', type=str, nargs='+', default=fixture_hgnc_ids, help='HGNC IDs whose gene pages must be recorded')
+    run_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic cohorts')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of every benchmark')
+    run_parser.add_argument('--max_pairs', type=int, default=2_000_000, help='Maximum number of pairs of a matrix benchmark')
+    run_parser.add_argument('--format_version', type=int, default=2, choices=[1, 2], help='HDF5 format version of the write and read benchmarks')
+    run_parser.add_argument('--dtype', type=str, default='f4', choices=['f4', 'f2'], help='Matrix dtype in format version 2')
+    run_parser.add_argument('--layout', type=str, default='chunked', choices=['chunked', 'contiguous'], help='Matrix layout in format version 2')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files, exits with 1 on regressions')
+    compare_parser.add_argument('BASE', type=str, help='Results of the reference run')
+    compare_parser.add_argument('NEW', type=str, help='Results of the run checked for regressions')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative increase of time and allocation')
+
+    record_parser = subparsers.add_parser('record', help='Record ClinGen pages and snapshots from the live site as fixtures')
+    record_parser.add_argument('--fixtures', type=str, default='data/benchmark_fixtures', help='Directory of the recorded responses')
+    record_parser.add_argument('--hgnc', type=str, nargs='+', default=fixture_hgnc_ids, help='HGNC IDs of the recorded genes')
+    record_parser.add_argument('--gcep', type=str, default=None, choices=['pird', 'scid'],
+                               help='Also record the snapshots of a GCEP, requires gcep_config.py')
+    record_parser.add_argument('--start', type=str, default='2024-12-01', help='Start of the recorded approval date window')
+    record_parser.add_argument('--end', type=str, default='2025-01-31', help='End of the recorded approval date window')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve recorded fixtures on a local port until interrupted')
+    serve_parser.add_argument('--fixtures', type=str, default='data/benchmark_fixtures', help='Directory of the recorded responses')
+    serve_parser.add_argument('--hgnc', type=str, nargs='+', default=fixture_hgnc_ids, help='HGNC IDs whose gene pages must be recorded')
+    serve_parser.add_argument('--port', type=int, default=8765, help='Port on 127.0.0.1')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        fixture_dir = args.fixtures if os.path.isdir(args.fixtures) else None
+        if fixture_dir is None:
+            print(f'No fixtures in {args.fixtures}, fixture benchmarks are skipped', file=sys.stderr)
+        suite = benchmark_suite(
+            args.sizes, fixture_dir, args.seed, args.repeat, args.max_pairs,
+            args.format_version, args.dtype, args.layout, hgnc_ids=args.hgnc
+        )
+        results = suite.run(args.benchmarks)
+        output = args.output or os.path.join(
+            'data/benchmarks', f'benchmark_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+        )
+        write_results(results, output)
+        print(f'Wrote {output}', file=sys.stderr)
+    elif args.command == 'compare':
+        base, new = read_results(args.BASE), read_results(args.NEW)
+        for key in ['hpo_version', 'cpu_count', 'numpy']:
+            if base['environment'].get(key) != new['environment'].get(key):
+                print(f'{key} differs: {base["environment"].get(key)} != {new["environment"].get(key)}', file=sys.stderr)
+        df = compare_results(base, new, args.threshold)
+        print(df.to_string(index=False))
+        if df['regression'].any():
+            print(f'{df["regression"].sum()} benchmarks regressed by more than {args.threshold:.0%}', file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'record':
+        gcep_queries = []
+        if args.gcep:
+            import gcep_config
+            gcep_queries.append({
+                'api_key': getattr(gcep_config, f'api_key_{args.gcep}'),
+                'gcep_url': gcep_config.gcep_url,
+                'status': 'approved',
+                'affiliation': getattr(gcep_config, f'affiliation_{args.gcep}'),
+                'start': args.start,
+                'end': args.end
+            })
+        n = record_fixtures(args.fixtures, args.hgnc, gcep_queries)
+        print(f'{n} responses recorded in {args.fixtures}', file=sys.stderr)
+    else:
+        with fixture_server(args.fixtures, args.port, args.hgnc) as server:
+            print(f'Serving {len(server)} recorded responses on {server.url}', file=sys.stderr)
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+
+
+if __name__ == "__main__":
+    main()
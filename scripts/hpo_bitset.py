@@ -0,0 +1,253 @@
+import sys
+import argparse
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from stage_metrics import stage
+import stage_metrics
+
+weightings = ['ic', 'jaccard']
+
+
+def _pack(bits):
+    """
+    Pack a 2D boolean array into rows of little endian bytes
+    """
+    return np.packbits(bits, axis=1, bitorder='little')
+
+
+class closure_bitset_engine:
+    """
+    Approximate set similarity of probands from their ancestor closures packed as bitsets
+
+    The closure of a proband is the union of the ancestors of its HPO terms, including the terms
+    themselves. Closures are stored as packed bitsets, one bit per ancestor shared by at least two
+    probands, since other ancestors can not be in an intersection. The score of a pair is the
+    IC-weighted Jaccard index of their closures (simGIC), IC(A & B) / IC(A | B), or the plain
+    Jaccard index, with IC(A | B) = IC(A) + IC(B) - IC(A & B). The weighted intersections of a
+    tile of pairs are one matrix product of the unpacked bitsets of its rows, scaled by the IC
+    weights, and of its columns. Bitsets are unpacked instead of intersected with np.bitwise_and
+    and np.bitwise_count on the packed words because a popcount can not weight bits by their IC:
+    the weighted sum needs a 256 entry table of weights per byte, which is about 35x slower than the
+    float32 product on a 1024 x 1024 tile of 2048 ancestors, and even unweighted popcounts of
+    uint64 words are about 3x slower than the product, which runs in BLAS. Only one tile is
+    unpacked at a time, so memory stays bounded by the tile size
+
+    Scores are not hpo3 set similarities but rank pairs the same way closely enough to screen out
+    pairs with no shared phenotype before computing exact similarities, see screened_set_similarity
+    """
+    def __init__(self, cohort, kind='omim', weighting='ic', snapshot=None):
+        """
+        Args:
+            cohort (hpo_cohort.hpo_cohort): Cohort of proband HPO sets
+            kind (str): Information content kind of the weights
+            weighting (str): 'ic' for simGIC or 'jaccard' for unweighted closures
+            snapshot (hpo_ontology.ontology_snapshot): Ontology snapshot closures and IC are read from.
+                The HPO Ontology must be loaded if None and the cohort has no closures or weighting is 'ic'
+        """
+        if weighting not in weightings:
+            raise ValueError(f'weighting must be one of {weightings}, not {weighting}')
+        if cohort.closure_indptr is None:
+            cohort = cohort.with_closures(snapshot)
+        self.kind = kind
+        self.weighting = weighting
+        self.n_sets = len(cohort)
+
+        # Proband x ancestor closure incidence, the product of proband x term and term x ancestor incidences
+        ancestor_codes, columns = np.unique(cohort.closure_codes, return_inverse=True)
+        n_terms = len(cohort.term_codes)
+        term_closure = csr_matrix(
+            (np.ones(len(columns), dtype=np.int32), columns, cohort.closure_indptr), shape=(n_terms, len(ancestor_codes))
+        )
+        proband_terms = csr_matrix(
+            (np.ones(len(cohort.indices), dtype=np.int32), cohort.indices, cohort.indptr), shape=(self.n_sets, n_terms)
+        )
+        closure = (proband_terms @ term_closure).tocsc()
+        closure.data[:] = 1
+
+        if weighting == 'ic' and snapshot is not None:
+            weights = snapshot.information_content(ancestor_codes, kind)
+        elif weighting == 'ic':
+            from pyhpo import Ontology
+            weights = np.array([Ontology[int(x)].information_content[kind] for x in ancestor_codes])
+        else:
+            weights = np.ones(len(ancestor_codes))
+        self.totals = np.asarray(closure @ weights).ravel()
+
+        # Only ancestors with a weight shared by two probands or more can be in an intersection
+        keep = (np.diff(closure.indptr) > 1) & (weights > 0)
+        self.ancestor_codes = ancestor_codes[keep]
+        self.weights = weights[keep].astype(np.float32)
+        closure = closure[:, keep].tocsr()
+        self.bitsets = np.vstack([
+            _pack(closure[start:start + 4096].toarray().astype(bool))
+            for start in range(0, self.n_sets, 4096)
+        ] or [np.zeros((0, 0), dtype=np.uint8)])
+
+    @property
+    def nbytes(self):
+        return self.bitsets.nbytes + self.weights.nbytes + self.totals.nbytes
+
+    def _unpack(self, rows):
+        bits = np.unpackbits(self.bitsets[rows], axis=1, count=len(self.weights), bitorder='little')
+        return bits.astype(np.float32)
+
+    def intersection_block(self, rows, cols):
+        """
+        Weight of the closure intersection of every set in rows with every set in cols
+
+        Returns:
+            np.ndarray: len(rows) x len(cols) float32 array
+        """
+        return (self._unpack(rows) * self.weights) @ self._unpack(cols).T
+
+    def score_block(self, rows, cols):
+        """
+        simGIC or Jaccard score of every set in rows with every set in cols, 0 if both closures are empty
+
+        Returns:
+            np.ndarray: len(rows) x len(cols) float32 array
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        inter = self.intersection_block(rows, cols)
+        union = self.totals[rows][:, None] + self.totals[cols][None, :] - inter
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(union > 0, inter / np.where(union > 0, union, 1), 0).astype(np.float32)
+
+    def score_matrix(self, block_size=1024):
+        """
+        Square score matrix between all sets, computed in tiles of block_size x block_size
+        """
+        n = self.n_sets
+        mtx = np.ones((n, n), dtype=np.float32)
+        for start in range(0, n, block_size):
+            rows = np.arange(start, min(start + block_size, n))
+            for col_start in range(0, n, block_size):
+                cols = np.arange(col_start, min(col_start + block_size, n))
+                mtx[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = self.score_block(rows, cols)
+        np.fill_diagonal(mtx, 1)
+        return mtx
+
+    def candidate_pairs(self, threshold, block_size=1024):
+        """
+        Pairs of distinct sets whose score is at least threshold, scanning tiles on and above the diagonal
+
+        Args:
+            threshold (float): Minimum score of a candidate pair
+            block_size (int): Number of rows and columns of a tile
+
+        Returns:
+            np.ndarray: k x 2 array of set indices (i, j) with i < j
+        """
+        n = self.n_sets
+        found = []
+        for start in range(0, n, block_size):
+            rows = np.arange(start, min(start + block_size, n))
+            for col_start in range(start, n, block_size):
+                cols = np.arange(col_start, min(col_start + block_size, n))
+                i, j = np.nonzero(self.score_block(rows, cols) >= threshold)
+                i, j = rows[i], cols[j]
+                upper = i < j
+                found.append(np.column_stack([i[upper], j[upper]]))
+        return np.vstack(found) if found else np.zeros((0, 2), dtype=np.int64)
+
+
+def screened_set_similarity(cohort, threshold, kind='omim', method='graphic', combine='funSimAvg',
+                            weighting='ic', block_size=1024, batch_size=100000, snapshot=None):
+    """
+    Exact set similarities of only the pairs passing the closure bitset screen
+    Pairs scoring below threshold are left out of the result, so the cost of the exact step
+    scales with the number of candidate pairs instead of the number of all pairs
+
+    Args:
+        cohort (hpo_cohort.hpo_cohort): Cohort of proband HPO sets
+        threshold (float): Minimum closure_bitset_engine score of a computed pair
+        kind (str): Information content kind of the screen and of the exact similarities
+        method (str): Term similarity method of the exact similarities
+        combine (str): Set similarity combine method of the exact similarities
+        weighting (str): Score of the screen, see closure_bitset_engine
+        block_size (int): Tile size of the screen
+        batch_size (int): Number of candidate pairs computed at once
+        snapshot (hpo_ontology.ontology_snapshot): Ontology snapshot the screen and the exact
+            similarities are computed from. Exact similarities then come from a set_similarity_engine,
+            which matches hpo3 to float precision. If None the HPO Ontology must be loaded and
+            exact similarities are computed by hpo3
+
+    Returns:
+        scipy.sparse.csr_matrix: Symmetric matrix of the exact similarities of the candidate pairs
+    """
+    n = len(cohort)
+    with stage('bitset.screen', weighting=weighting, threshold=threshold) as metrics:
+        engine = closure_bitset_engine(cohort, kind, weighting, snapshot=snapshot)
+        pairs = engine.candidate_pairs(threshold, block_size)
+        metrics.add(rows=n, bytes=engine.nbytes, pairs=n * (n - 1) // 2, candidates=len(pairs))
+
+    with stage('bitset.exact', engine='hpo3' if snapshot is None else 'snapshot') as metrics:
+        if snapshot is not None:
+            from hpo_similarity import set_similarity_engine
+            from hpo_sweep import term_similarity_sweep
+            terms = term_similarity_sweep(cohort, snapshot=snapshot)
+            exact = set_similarity_engine.from_cohort(cohort, kind, method, term_similarity=terms.similarity(kind, method))
+
+            def batch_similarity(batch):
+                return exact.similarity(batch, combine=combine)
+        else:
+            from pyhpo import helper
+            hpo_sets = cohort.hpo_sets()
+
+            def batch_similarity(batch):
+                return helper.batch_set_similarity(
+                    [(hpo_sets[i], hpo_sets[j]) for i, j in batch], kind=kind, method=method, combine=combine
+                )
+        sim = np.zeros(len(pairs))
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            sim[start:start + len(batch)] = batch_similarity(batch)
+        metrics.add(pairs=len(pairs))
+    mtx = csr_matrix((sim, (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    return (mtx + mtx.T).tocsr()
+
+
+def main():
+    from pyhpo import Ontology
+    from hpo_cohort import hpo_cohort
+    from hpo_graph import save_graph
+    from hpo_ontology import ontology_snapshot
+    parser = argparse.ArgumentParser(description="Closure bitset screened HPO set similarity graph of the cohort of an HPO distance file")
+    parser.add_argument('HF_PATH', type=str, help='HDF5 file written by create_hpo_distance_object.py, with a cohort group')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Minimum screen score of a computed pair')
+    parser.add_argument('--weighting', type=str, default='ic', choices=weightings, help='Screen score')
+    parser.add_argument('--kind', type=str, default='omim', help='Information content kind')
+    parser.add_argument('--method', type=str, default='graphic', help='Term similarity method passed to hpo3')
+    parser.add_argument('--combine', type=str, default='funSimAvg', help='Set similarity combine method passed to hpo3')
+    parser.add_argument('--block_size', type=int, default=1024, help='Tile size of the screen')
+    parser.add_argument('--name', type=str, default=None, help='Name of the stored graph')
+    parser.add_argument('--ontology_snapshot', type=str, default=None,
+                        help='Ontology snapshot written by hpo_ontology.py, e.g. data/hp_[date].snapshot, used instead of the HPO Ontology')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='JSON lines file that timing, bytes, rows, pairs per second and peak RSS of every stage are appended to')
+    parser.add_argument('--profile_dir', type=str, default=None, help='Directory a cProfile dump of every stage is written to')
+    args = parser.parse_args()
+    stage_metrics.configure(args.metrics, args.profile_dir)
+
+    snapshot = None
+    if args.ontology_snapshot:
+        snapshot = ontology_snapshot(args.ontology_snapshot)
+    else:
+        Ontology()
+    cohort = hpo_cohort.load(args.HF_PATH)
+    mtx = screened_set_similarity(
+        cohort, args.threshold, args.kind, args.method, args.combine, args.weighting, args.block_size,
+        snapshot=snapshot
+    )
+    name = args.name or f'screen_{args.weighting}_t{args.threshold}'
+    with h5py.File(args.HF_PATH, 'a') as f:
+        save_graph(f, name, mtx, threshold=args.threshold, weighting=args.weighting,
+                   kind=args.kind, method=args.method, combine=args.combine)
+    print(f'Graph {name}: {mtx.shape[0]} nodes, {mtx.nnz // 2} edges', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import h5py
+import numpy as np
+import pandas as pd
+from pyhpo import Ontology, HPOSet
+
+
+def hpo_codes(hpo_ids):
+    """
+    Intern HPO IDs as int32 codes, the integer part of the ID (HP:0001250 -> 1250)
+    """
+    return pd.Series(hpo_ids, dtype=object).str[3:].astype(np.int32).to_numpy()
+
+
+def hpo_ids_of(codes):
+    """
+    Convert int32 codes back to HPO IDs
+    """
+    return [f'HP:{x:07d}' for x in codes]
+
+
+def _csr(group_index, values, n_groups):
+    """
+    Sort values by group and return CSR row pointers and the sorted values
+    """
+    order = np.lexsort((values, group_index))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(group_index, minlength=n_groups))]).astype(np.int64)
+    return indptr, values[order]
+
+
+class hpo_cohort:
+    """
+    Compact representation of the HPO sets of a cohort of probands
+    HPO IDs are interned as sorted int32 codes and the terms of each proband are stored as
+    CSR arrays: the terms of proband i are term_codes[indices[indptr[i]:indptr[i + 1]]], sorted
+    and without duplicates. The ancestor closure of every cohort term (including the term itself)
+    can be precomputed and is stored the same way over the cohort terms.
+    A cohort holds a few NumPy arrays instead of one HPOSet per proband, so it is cheap to keep
+    in memory, save, and send to worker processes, which rebuild HPOSets only when hpo3 needs them
+    """
+    def __init__(self, keys, term_codes, indptr, indices, closure_indptr=None, closure_codes=None):
+        """
+        Args:
+            keys (list): Unique key of each proband, e.g. Gene__Disease__label
+            term_codes (np.ndarray): Sorted int32 codes of all cohort terms
+            indptr (np.ndarray): CSR row pointers of proband terms, length len(keys) + 1
+            indices (np.ndarray): CSR int32 indices of proband terms into term_codes
+            closure_indptr (np.ndarray): Optional CSR row pointers of the ancestor closure of each cohort term
+            closure_codes (np.ndarray): Optional int32 codes of the ancestors of each cohort term
+        """
+        self.keys = np.asarray(keys, dtype=object)
+        self.term_codes = np.asarray(term_codes, dtype=np.int32)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.closure_indptr = None if closure_indptr is None else np.asarray(closure_indptr, dtype=np.int64)
+        self.closure_codes = None if closure_codes is None else np.asarray(closure_codes, dtype=np.int32)
+
+    @classmethod
+    def from_table(cls, df, key_column='ID', term_column='HPO_ID', keys=None):
+        """
+        Build a cohort from a table with one row per proband and HPO term, e.g. a validated gcep.hpo_table()
+
+        Args:
+            df (pd.DataFrame): Table of proband keys and HPO IDs
+            key_column (str): Column of proband keys
+            term_column (str): Column of HPO IDs
+            keys (list): Order of the probands. Sorted unique keys of df if None
+
+        Returns:
+            hpo_cohort: The cohort
+        """
+        df = df[[key_column, term_column]].dropna()
+        keys = np.asarray(sorted(pd.unique(df[key_column])) if keys is None else keys, dtype=object)
+        key_index = pd.Index(keys).get_indexer(df[key_column])
+        if (key_index < 0).any():
+            raise ValueError(f'{key_column} has keys missing from keys')
+        codes = hpo_codes(df[term_column])
+        # Drop repeated terms of a proband
+        pairs = np.unique(np.stack([key_index, codes], axis=1), axis=0)
+        term_codes, term_index = np.unique(pairs[:, 1], return_inverse=True)
+        indptr, indices = _csr(pairs[:, 0], term_index.astype(np.int32), len(keys))
+        return cls(keys, term_codes, indptr, indices)
+
+    @classmethod
+    def from_hpo_sets(cls, hpo_set_list, keys=None):
+        """
+        Build a cohort from HPOSet objects
+        """
+        keys = [str(i) for i in range(len(hpo_set_list))] if keys is None else keys
+        df = pd.DataFrame(
+            [(key, term.id) for key, hpo_set in zip(keys, hpo_set_list) for term in hpo_set],
+            columns=['key', 'hpo_id']
+        )
+        return cls.from_table(df, key_column='key', term_column='hpo_id', keys=keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def term_ids(self):
+        return hpo_ids_of(self.term_codes)
+
+    @property
+    def set_sizes(self):
+        return np.diff(self.indptr)
+
+    @property
+    def nbytes(self):
+        arrays = [self.keys, self.term_codes, self.indptr, self.indices, self.closure_indptr, self.closure_codes]
+        return sum(x.nbytes for x in arrays if x is not None)
+
+    def set_codes(self, i):
+        """
+        Return the int32 codes of the terms of proband i
+        """
+        return self.term_codes[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def hpo_id_strings(self):
+        """
+        Return the comma separated, sorted HPO IDs of every proband, as stored in proband_metadata/hpo_ids
+        """
+        term_ids = np.asarray(self.term_ids, dtype=object)
+        return [','.join(term_ids[self.indices[start:stop]]) for start, stop in zip(self.indptr[:-1], self.indptr[1:])]
+
+    def subset(self, rows):
+        """
+        Return a cohort of the probands in rows, keeping all cohort terms and closures
+        """
+        rows = np.asarray(rows)
+        sizes = self.set_sizes[rows]
+        indices = np.concatenate([self.indices[self.indptr[i]:self.indptr[i + 1]] for i in rows]) if len(rows) else []
+        return hpo_cohort(
+            self.keys[rows], self.term_codes, np.concatenate([[0], np.cumsum(sizes)]), indices,
+            self.closure_indptr, self.closure_codes
+        )
+
+    def term_cohort(self):
+        """
+        Return a cohort with one single-term set per cohort term, keyed by HPO ID
+        Used for the HPO term distance matrix
+        """
+        n = len(self.term_codes)
+        return hpo_cohort(
+            self.term_ids, self.term_codes, np.arange(n + 1), np.arange(n),
+            self.closure_indptr, self.closure_codes
+        )
+
+    def with_closures(self, snapshot=None):
+        """
+        Return the cohort with the ancestor closure of every cohort term
+
+        Args:
+            snapshot (hpo_ontology.ontology_snapshot): Ontology snapshot the closures are read from.
+                The HPO Ontology must be loaded if None
+        """
+        if snapshot is not None:
+            closure_indptr, closure_codes = snapshot.closures(self.term_codes)
+            return hpo_cohort(self.keys, self.term_codes, self.indptr, self.indices, closure_indptr, closure_codes)
+        closures = [[code] + [int(x) for x in Ontology[int(code)].all_parents] for code in self.term_codes]
+        closure_indptr = np.concatenate([[0], np.cumsum([len(x) for x in closures])])
+        closure_codes = np.fromiter((y for x in closures for y in sorted(x)), dtype=np.int32, count=closure_indptr[-1])
+        return hpo_cohort(self.keys, self.term_codes, self.indptr, self.indices, closure_indptr, closure_codes)
+
+    def closure(self, t):
+        """
+        Return the int32 codes of the ancestor closure of cohort term index t
+        """
+        if self.closure_indptr is None:
+            raise ValueError('Cohort has no closures, use with_closures()')
+        return self.closure_codes[self.closure_indptr[t]:self.closure_indptr[t + 1]]
+
+    def hpo_set(self, i):
+        """
+        Build the HPOSet of proband i. The HPO Ontology must be loaded
+        """
+        return HPOSet([Ontology[int(x)] for x in self.set_codes(i)])
+
+    def hpo_sets(self):
+        """
+        Build the HPOSet of every proband, for functions that need hpo3 objects
+        """
+        terms = [Ontology[int(x)] for x in self.term_codes]
+        return [
+            HPOSet([terms[t] for t in self.indices[start:stop]])
+            for start, stop in zip(self.indptr[:-1], self.indptr[1:])
+        ]
+
+    def save(self, hf_path, group='cohort'):
+        """
+        Save the cohort arrays to a group of an HDF5 file, replacing the group if it exists
+
+        Args:
+            hf_path (str): Path of the HDF5 file, created if it does not exist
+            group (str): Name of the group
+        """
+        with h5py.File(hf_path, 'a') as f:
+            if group in f:
+                del f[group]
+            g = f.create_group(group)
+            g.create_dataset('keys', data=np.array(self.keys, dtype='S'))
+            g.create_dataset('term_codes', data=self.term_codes)
+            g.create_dataset('indptr', data=self.indptr)
+            g.create_dataset('indices', data=self.indices)
+            if self.closure_indptr is not None:
+                g.create_dataset('closure_indptr', data=self.closure_indptr)
+                g.create_dataset('closure_codes', data=self.closure_codes)
+
+    @classmethod
+    def load(cls, hf_path, group='cohort'):
+        with h5py.File(hf_path, 'r') as f:
+            g = f[group]
+            return cls(
+                g['keys'][:].astype(str), g['term_codes'][:], g['indptr'][:], g['indices'][:],
+                g['closure_indptr'][:] if 'closure_indptr' in g else None,
+                g['closure_codes'][:] if 'closure_codes' in g else None
+            )
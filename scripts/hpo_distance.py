@@ -0,0 +1,309 @@
+import itertools
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from pyhpo import HPOSet, helper
+from scipy.spatial.distance import squareform
+
+from stage_metrics import stage
+
+
+def create_hpo_distance(hpo_set_list, kind="omim", method="graphic", combine="funSimAvg"):
+    """
+    Take a list of HPOSet objects and return a matrix of the distances between each set in the list
+    Several metric configurations are computed more cheaply in one pass with hpo_sweep.similarity_sweep
+
+    Args:
+        hpo_set_list (_type_): List of HPOSet objects objects
+        kind (str): Information content kind passed to hpo3
+        method (str): Term similarity method passed to hpo3
+        combine (str): Set similarity combine method passed to hpo3
+
+    Returns:
+        _type_: distance matrix
+    """
+
+    # Create list of all tuples representing all pairwise combinations of HPO sets in HPO_set_list
+    hpoSet_combinations = [
+        (a[0], a[1]) for a in itertools.combinations(hpo_set_list, 2)
+    ]
+
+    # Get similarities of HPO set pairs from HPO3
+    mtx_sim = helper.batch_set_similarity(
+        hpoSet_combinations,
+        kind=kind,
+        method=method,
+        combine=combine
+    )
+
+    # Convert similarity matrix to distance matrix
+    mtx_dist = squareform([1 - x for x in mtx_sim])
+    return mtx_dist
+
+
+def update_hpo_distance(hpo_set_list, keys, previous_keys, previous_mtx, kind="omim", method="graphic", combine="funSimAvg"):
+    """
+    Incrementally update a distance matrix previously returned by create_hpo_distance
+    Rows whose key is present in previous_keys are copied from previous_mtx, rows that
+    are new or whose key changed are compared against every other set, and rows of
+    previous_mtx that are not in keys are dropped. Only the pairs involving new or
+    changed rows are computed
+
+    Args:
+        hpo_set_list (list): HPOSet objects, in the row order of the returned matrix
+        keys (list): Hashable key of each set that changes whenever the set changes,
+            e.g. (proband ID, HPO IDs)
+        previous_keys (list): Keys of the rows of previous_mtx
+        previous_mtx (np.ndarray): Square distance matrix to update, computed with the same kind, method and combine
+        kind (str): Information content kind passed to hpo3
+        method (str): Term similarity method passed to hpo3
+        combine (str): Set similarity combine method passed to hpo3
+
+    Returns:
+        tuple: distance matrix matching create_hpo_distance(hpo_set_list, kind, method, combine) and a dict of the number of
+        reused_rows, computed_rows and computed_pairs
+    """
+    previous_index = {k: i for i, k in enumerate(previous_keys)}
+    n = len(hpo_set_list)
+    mtx_dist = np.zeros((n, n))
+
+    # Copy distances between unchanged rows
+    kept = np.array([i for i, k in enumerate(keys) if k in previous_index], dtype=int)
+    kept_previous = np.array([previous_index[keys[i]] for i in kept], dtype=int)
+    mtx_dist[np.ix_(kept, kept)] = previous_mtx[np.ix_(kept_previous, kept_previous)]
+
+    # Compare new and changed rows against all other rows, counting new-new pairs once
+    changed = [i for i, k in enumerate(keys) if k not in previous_index]
+    changed_set = set(changed)
+    pairs = [
+        (i, j) for i in changed for j in range(n)
+        if j != i and (j not in changed_set or j > i)
+    ]
+    if pairs:
+        mtx_sim = helper.batch_set_similarity(
+            [(hpo_set_list[i], hpo_set_list[j]) for i, j in pairs],
+            kind=kind,
+            method=method,
+            combine=combine
+        )
+        rows, cols = np.array(pairs).T
+        mtx_dist[rows, cols] = 1 - np.array(mtx_sim)
+        mtx_dist[cols, rows] = mtx_dist[rows, cols]
+    counts = {'reused_rows': len(kept), 'computed_rows': len(changed), 'computed_pairs': len(pairs)}
+    return mtx_dist, counts
+
+
+# HPOSet objects or set_similarity_engine and the (kind, method, combine) metric of the
+# current worker process, set by _init_tile_worker
+_worker_hpo_sets = None
+_worker_engine = None
+_worker_metric = None
+
+
+def _snapshot_engine(cohort, snapshot_path, kind="omim", method="graphic"):
+    """
+    Build a set_similarity_engine of a cohort from an Ontology snapshot, without loading the HPO Ontology
+    Term similarities are computed by hpo_sweep.term_similarity_sweep, which matches hpo3 to float precision
+    """
+    from hpo_ontology import ontology_snapshot
+    from hpo_similarity import set_similarity_engine
+    from hpo_sweep import term_similarity_sweep
+    terms = term_similarity_sweep(cohort, snapshot=ontology_snapshot(snapshot_path))
+    return set_similarity_engine.from_cohort(
+        cohort, kind, method, term_similarity=terms.similarity(kind, method)
+    )
+
+
+def _init_tile_worker(serialized_sets=None, cohort=None, engine_path=None, metric=("omim", "graphic", "funSimAvg")):
+    """
+    Initializer of tiled_hpo_distance worker processes
+    HPOSet objects can not be pickled, so each worker rebuilds them once from their serialized
+    form or from the arrays of an hpo_cohort. With engine_path, the arrays of a set_similarity_engine
+    saved by the parent process, workers memory-map the engine instead of loading the HPO Ontology
+    """
+    global _worker_hpo_sets, _worker_engine, _worker_metric
+    _worker_engine = None
+    _worker_metric = metric
+    if engine_path is not None:
+        from hpo_similarity import set_similarity_engine
+        _worker_engine = set_similarity_engine.load(engine_path, cohort, *metric[:2])
+        return
+    from pyhpo import Ontology
+    Ontology()
+    if cohort is not None:
+        _worker_hpo_sets = cohort.hpo_sets()
+    else:
+        _worker_hpo_sets = [HPOSet.from_serialized(x) for x in serialized_sets]
+
+
+def _tile_distance(hpo_set_list, rows, cols, kind="omim", method="graphic", combine="funSimAvg"):
+    """
+    Compute the distance block between the sets in the row range and the column range
+    Tiles on the diagonal only compute their upper triangle
+
+    Args:
+        hpo_set_list (list): HPOSet objects
+        rows (tuple): (start, stop) of the row range
+        cols (tuple): (start, stop) of the column range
+        kind, method, combine (str): Metric passed to hpo3
+
+    Returns:
+        tuple: rows, cols and the distance block as a float64 array
+    """
+    pairs = [
+        (i, j) for i in range(*rows) for j in range(*cols)
+        if rows != cols or j > i
+    ]
+    block = np.zeros((rows[1] - rows[0], cols[1] - cols[0]))
+    if pairs:
+        mtx_sim = helper.batch_set_similarity(
+            [(hpo_set_list[i], hpo_set_list[j]) for i, j in pairs],
+            kind=kind,
+            method=method,
+            combine=combine
+        )
+        i, j = np.array(pairs).T
+        block[i - rows[0], j - cols[0]] = 1 - np.array(mtx_sim)
+    if rows == cols:
+        block = block + block.T
+    return rows, cols, block
+
+
+def _engine_tile_distance(engine, rows, cols, combine="funSimAvg"):
+    """
+    Compute a distance block like _tile_distance with a set_similarity_engine
+    """
+    block = 1 - engine.similarity_block(np.arange(*rows), np.arange(*cols), combine)
+    if rows == cols:
+        np.fill_diagonal(block, 0)
+    return rows, cols, block
+
+
+def _worker_tile_distance(rows, cols):
+    if _worker_engine is not None:
+        return _engine_tile_distance(_worker_engine, rows, cols, _worker_metric[2])
+    return _tile_distance(_worker_hpo_sets, rows, cols, *_worker_metric)
+
+
+class tiled_hpo_distance:
+    """
+    Memory-bounded alternative to create_hpo_distance for large cohorts
+    The pairs of the distance matrix are generated lazily as square tiles that are
+    computed in-process or fanned out to a process pool. Each finished tile and its
+    transpose are written straight into an HDF5 dataset, so peak memory depends on
+    tile_size and the number of workers rather than on the number of sets
+    """
+    def __init__(self, hpo_set_list, tile_size=512, workers=1, snapshot_path=None,
+                 kind="omim", method="graphic", combine="funSimAvg"):
+        """
+        Args:
+            hpo_set_list (list): HPOSet objects, or an hpo_cohort which is sent to the workers
+                as compact arrays instead of serialized sets
+            tile_size (int): Number of rows and columns in one tile
+            workers (int): Number of worker processes. 1 computes tiles in the current process.
+                hpo3 already spreads each tile's pairs over all CPUs, so more workers mainly
+                help when tiles are small
+            snapshot_path (str): Optional hpo_ontology snapshot, requires an hpo_cohort. Tiles are then
+                computed from a set_similarity_engine built once from the snapshot. Its term similarity
+                and best match matrices are saved next to the snapshot and memory-mapped by the workers,
+                which do not load the HPO Ontology
+            kind (str): Information content kind
+            method (str): Term similarity method
+            combine (str): Set similarity combine method
+        """
+        self.cohort = None
+        if not isinstance(hpo_set_list, list):
+            self.cohort = hpo_set_list
+            hpo_set_list = None
+        if snapshot_path is not None and self.cohort is None:
+            raise ValueError('snapshot_path requires an hpo_cohort')
+        self.snapshot_path = snapshot_path
+        self._hpo_set_list = hpo_set_list
+        self.tile_size = tile_size
+        self.metric = (kind, method, combine)
+        self.workers = workers if workers is not None else os.cpu_count()
+        n = len(self.cohort) if self.cohort is not None else len(hpo_set_list)
+        self.shape = (n, n)
+
+    @property
+    def hpo_set_list(self):
+        if self._hpo_set_list is None:
+            self._hpo_set_list = self.cohort.hpo_sets()
+        return self._hpo_set_list
+
+    def tiles(self):
+        """
+        Lazily generate the (rows, cols) ranges of all tiles on and above the diagonal
+        """
+        n = self.shape[0]
+        starts = range(0, n, self.tile_size)
+        for r in starts:
+            for c in starts:
+                if c >= r:
+                    yield (r, min(r + self.tile_size, n)), (c, min(c + self.tile_size, n))
+
+    def write(self, dataset):
+        """
+        Compute all tiles and write them into dataset, recorded as a distance.similarity stage
+        with the number of pairs computed
+
+        Args:
+            dataset (h5py.Dataset): Square dataset of shape self.shape, ideally chunked by tile_size
+        """
+        with stage('distance.similarity', engine='tiled', workers=self.workers) as metrics:
+            self._write(dataset)
+            n = self.shape[0]
+            metrics.add(rows=n, pairs=n * (n - 1) // 2)
+
+    def _write(self, dataset):
+        if self.workers <= 1:
+            engine = None
+            if self.snapshot_path is not None:
+                engine = _snapshot_engine(self.cohort, self.snapshot_path, *self.metric[:2])
+            for rows, cols in self.tiles():
+                if engine is not None:
+                    self._write_tile(dataset, *_engine_tile_distance(engine, rows, cols, self.metric[2]))
+                else:
+                    self._write_tile(dataset, *_tile_distance(self.hpo_set_list, rows, cols, *self.metric))
+            return
+
+        if self.snapshot_path is not None:
+            # The engine is built once and shared, rather than rebuilt by every worker
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.snapshot_path))) as engine_path:
+                _snapshot_engine(self.cohort, self.snapshot_path, *self.metric[:2]).save(engine_path)
+                self._write_parallel(dataset, (None, self.cohort, engine_path, self.metric))
+        elif self.cohort is not None:
+            self._write_parallel(dataset, (None, self.cohort, None, self.metric))
+        else:
+            self._write_parallel(dataset, ([x.serialize() for x in self.hpo_set_list], None, None, self.metric))
+
+    def _write_parallel(self, dataset, initargs):
+        """
+        Internal method computing tiles on a process pool initialized with _init_tile_worker(*initargs)
+        """
+        tiles = self.tiles()
+        # Workers are spawned rather than forked, forking after hpo3 started its thread pool can deadlock
+        with ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_tile_worker, initargs=initargs
+        ) as executor:
+            # Keep a bounded number of tiles in flight so finished tiles do not pile up in memory
+            pending = set()
+            for rows, cols in itertools.islice(tiles, 2 * self.workers):
+                pending.add(executor.submit(_worker_tile_distance, rows, cols))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._write_tile(dataset, *future.result())
+                    next_tile = next(tiles, None)
+                    if next_tile is not None:
+                        pending.add(executor.submit(_worker_tile_distance, *next_tile))
+
+    def _write_tile(self, dataset, rows, cols, block):
+        dataset[rows[0]:rows[1], cols[0]:cols[1]] = block
+        if rows != cols:
+            dataset[cols[0]:cols[1], rows[0]:rows[1]] = block.T
+
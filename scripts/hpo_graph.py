@@ -0,0 +1,188 @@
+import sys
+import argparse
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def _metadata_group(kind):
+    return 'hpo_metadata' if kind == 'hpo' else 'proband_metadata'
+
+
+def _matrix_path(kind):
+    return {'proband': 'proband_distance', 'hpo': 'hpo_distance'}.get(kind, f'metrics/{kind}')
+
+
+def similarity_graph(dataset, k=15, threshold=None, mutual=False, chunk_rows=1024):
+    """
+    Build a sparse similarity graph from a square distance dataset, reading it in row chunks
+    Only chunk_rows rows of the dense matrix are in memory at once. Each row keeps its k nearest
+    neighbours and/or the neighbours within threshold, and edges are weighted by similarity (1 - distance)
+
+    Args:
+        dataset (h5py.Dataset or np.ndarray): Square distance matrix
+        k (int): Number of nearest neighbours kept per row. None keeps all neighbours within threshold
+        threshold (float): Maximum distance of an edge. None keeps the k nearest neighbours
+        mutual (bool): Keep only edges found from both ends instead of edges found from either end
+        chunk_rows (int): Number of rows read at once
+
+    Returns:
+        scipy.sparse.csr_matrix: Symmetric float32 adjacency matrix without self loops
+    """
+    if k is None and threshold is None:
+        raise ValueError('k or threshold must be set')
+    n = dataset.shape[0]
+    edge_rows, edge_cols, edge_dist = [], [], []
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        dist = np.asarray(dataset[start:stop], dtype=np.float32)
+        dist[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        if k is not None and n > 1:
+            kk = min(k, n - 1)
+            cols = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+            rows = np.repeat(np.arange(start, stop), kk)
+            cols = cols.ravel()
+            values = dist[rows - start, cols]
+            if threshold is not None:
+                keep = values <= threshold
+                rows, cols, values = rows[keep], cols[keep], values[keep]
+        else:
+            rows, cols = np.nonzero(dist <= threshold)
+            values = dist[rows, cols]
+            rows = rows + start
+        edge_rows.append(rows)
+        edge_cols.append(cols)
+        edge_dist.append(values)
+
+    rows = np.concatenate(edge_rows) if edge_rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(edge_cols) if edge_cols else np.zeros(0, dtype=np.int64)
+    weights = 1 - np.concatenate(edge_dist) if edge_dist else np.zeros(0, dtype=np.float32)
+    graph = csr_matrix((weights.astype(np.float32), (rows, cols)), shape=(n, n))
+    graph = graph.minimum(graph.T) if mutual else graph.maximum(graph.T)
+    graph = csr_matrix(graph)
+    # Neighbours with no similarity at all are not edges
+    graph.data[graph.data < 0] = 0
+    graph.eliminate_zeros()
+    return graph
+
+
+def save_graph(f, name, graph, **attrs):
+    """
+    Save a CSR graph to graphs/name of an open HDF5 file, replacing it if it exists
+    """
+    path = f'graphs/{name}'
+    if path in f:
+        del f[path]
+    group = f.create_group(path)
+    group.create_dataset('indptr', data=graph.indptr)
+    group.create_dataset('indices', data=graph.indices)
+    group.create_dataset('data', data=graph.data)
+    group.attrs['shape'] = graph.shape
+    for key, value in attrs.items():
+        group.attrs[key] = 'None' if value is None else value
+
+
+def load_graph(f, name):
+    group = f[f'graphs/{name}']
+    return csr_matrix(
+        (group['data'][:], group['indices'][:], group['indptr'][:]),
+        shape=tuple(group.attrs['shape'])
+    )
+
+
+def leiden_clusters(graph, resolution=1.0, seed=0, n_iterations=-1):
+    """
+    Cluster a weighted graph with the Leiden algorithm, using igraph and leidenalg
+
+    Args:
+        graph (scipy.sparse.csr_matrix): Symmetric adjacency matrix
+        resolution (float): Resolution parameter of the RB configuration model, higher gives more clusters
+        seed (int): Random seed
+        n_iterations (int): Number of Leiden iterations, negative runs until the partition is stable
+
+    Returns:
+        np.ndarray: int32 cluster label of every node, clusters numbered by decreasing size
+    """
+    import igraph
+    import leidenalg
+    upper = graph.tocoo()
+    keep = upper.row < upper.col
+    g = igraph.Graph(
+        n=graph.shape[0],
+        edges=np.column_stack([upper.row[keep], upper.col[keep]]).tolist(),
+        edge_attrs={'weight': upper.data[keep].astype(float).tolist()}
+    )
+    partition = leidenalg.find_partition(
+        g, leidenalg.RBConfigurationVertexPartition, weights='weight',
+        resolution_parameter=resolution, seed=seed, n_iterations=n_iterations
+    )
+    return np.asarray(partition.membership, dtype=np.int32)
+
+
+def write_clusters(f, name, labels, kind='proband', **attrs):
+    """
+    Write cluster labels to clusters/name next to the metadata of the clustered rows
+    """
+    path = f'{_metadata_group(kind)}/clusters/{name}'
+    if path in f:
+        del f[path]
+    dataset = f.create_dataset(path, data=labels)
+    for key, value in attrs.items():
+        dataset.attrs[key] = 'None' if value is None else value
+
+
+def read_clusters(f, name, kind='proband'):
+    return f[f'{_metadata_group(kind)}/clusters/{name}'][:]
+
+
+def cluster_distance_file(hf_path, kind='proband', k=15, threshold=None, mutual=False,
+                          resolution=1.0, seed=0, name=None, chunk_rows=1024):
+    """
+    Build a similarity graph from a distance matrix of an HDF5 file written by create_hpo_distance_object.py,
+    cluster it with Leiden and write the graph and labels back to the same file
+
+    Args:
+        hf_path (str): Path of the HDF5 file
+        kind (str): 'proband', 'hpo' or the name of a metric sweep dataset
+        name (str): Name of the graph and cluster labels. Derived from the parameters if None
+        See similarity_graph and leiden_clusters for the other arguments
+
+    Returns:
+        np.ndarray: Cluster labels
+    """
+    if name is None:
+        name = f'{kind}_k{k}_t{threshold}_r{resolution}'
+    params = {'matrix': kind, 'k': k, 'threshold': threshold, 'mutual': mutual}
+    with h5py.File(hf_path, 'a') as f:
+        graph = similarity_graph(f[_matrix_path(kind)], k, threshold, mutual, chunk_rows)
+        print(f'Graph {name}: {graph.shape[0]} nodes, {graph.nnz // 2} edges', file=sys.stderr)
+        save_graph(f, name, graph, **params)
+        labels = leiden_clusters(graph, resolution, seed)
+        write_clusters(f, name, labels, kind, graph=name, resolution=resolution, seed=seed, **params)
+    print(f'Leiden {name}: {labels.max(initial=-1) + 1} clusters', file=sys.stderr)
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sparse similarity graph and Leiden clustering of an HPO distance file")
+    parser.add_argument('HF_PATH', type=str, help='HDF5 file written by create_hpo_distance_object.py')
+    parser.add_argument('--kind', type=str, default='proband', help="'proband', 'hpo' or a metric sweep dataset name")
+    parser.add_argument('--k', type=int, default=15, help='Number of nearest neighbours per row. 0 keeps all neighbours within --threshold')
+    parser.add_argument('--threshold', type=float, default=None, help='Maximum distance of an edge')
+    parser.add_argument('--mutual', action='store_true', help='Keep only mutual nearest neighbour edges')
+    parser.add_argument('--resolution', type=float, default=1.0, help='Leiden resolution parameter')
+    parser.add_argument('--seed', type=int, default=0, help='Leiden random seed')
+    parser.add_argument('--name', type=str, default=None, help='Name of the stored graph and cluster labels')
+    parser.add_argument('--chunk_rows', type=int, default=1024, help='Number of matrix rows read at once')
+    args = parser.parse_args()
+    if not args.k and args.threshold is None:
+        parser.error('--k 0 requires --threshold')
+
+    cluster_distance_file(
+        args.HF_PATH, args.kind, args.k or None, args.threshold, args.mutual,
+        args.resolution, args.seed, args.name, args.chunk_rows
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import h5py
+import numpy as np
+
+# Format version 1 stores dense float64 squares with whole-dataset gzip
+# Format version 2 stores float32 (or float16) matrices either in row chunks with a fast-decode
+# filter or contiguous and uncompressed for memory-mapping, plus ID to row indices
+FORMAT_VERSION = 2
+LAYOUTS = ['chunked', 'contiguous']
+# Metric of files written before the metric was stored
+DEFAULT_METRIC = {'kind': 'omim', 'method': 'graphic', 'combine': 'funSimAvg'}
+
+
+def _storage_kwargs(shape, format_version, dtype, layout, chunk_rows):
+    """
+    Internal function returning h5py create_dataset arguments for a distance matrix
+    """
+    if format_version == 1:
+        return {'dtype': 'f8', 'compression': 'gzip'}
+    if layout == 'contiguous':
+        return {'dtype': dtype}
+    # Row chunks let a single row be read by decompressing one chunk. lzf decodes much faster than gzip
+    rows = max(1, min(chunk_rows, shape[0]))
+    return {
+        'dtype': dtype, 'compression': 'lzf', 'shuffle': True,
+        'chunks': (rows, max(1, shape[1])) if shape[0] else None
+    }
+
+
+def _write_distance(f, name, mtx, format_version=FORMAT_VERSION, dtype='f4', layout='chunked', chunk_rows=64):
+    """
+    Write a distance matrix to dataset name of f
+    mtx is either a square array or an object with shape, tile_size and write(dataset),
+    such as hpo_distance.tiled_hpo_distance, that fills a chunked dataset tile by tile
+    """
+    if isinstance(mtx, np.ndarray):
+        f.create_dataset(name, data=mtx, **_storage_kwargs(mtx.shape, format_version, dtype, layout, chunk_rows))
+    else:
+        # Tiles are written with their mirrored transposes, so chunks are square tiles. Full-width
+        # row chunks would make every tile write decompress and rewrite chunks of tile_size x n
+        chunk = min(mtx.tile_size, mtx.shape[0]) or None
+        kwargs = _storage_kwargs(mtx.shape, format_version, dtype, layout, mtx.tile_size)
+        if 'chunks' in kwargs or format_version == 1:
+            kwargs['chunks'] = (chunk, chunk) if chunk else None
+        dataset = f.create_dataset(name, shape=mtx.shape, **kwargs)
+        mtx.write(dataset)
+
+
+def _write_group_index(group, name, values):
+    """
+    Store the rows belonging to each distinct value as a CSR style index
+    names[i] owns rows[indptr[i]:indptr[i + 1]]
+    """
+    values = np.asarray(values, dtype=object)
+    names, inverse = np.unique(values.astype(str), return_inverse=True)
+    rows = np.argsort(inverse, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(names)))])
+    index_group = group.create_group(name)
+    index_group.create_dataset('names', data=np.array(names, dtype='S'))
+    index_group.create_dataset('indptr', data=indptr)
+    index_group.create_dataset('rows', data=rows)
+
+
+def write_hpo_h5(hf_save_path, mtx_hpo_dist, df_hpo_meta, mtx_proband_dist, df_probands,
+                 format_version=FORMAT_VERSION, dtype='f4', layout='chunked', chunk_rows=64, metric=None):
+    """
+    Save HPO and proband distance matrices and their metadata to an HDF5 file
+
+    Args:
+        hf_save_path (str): Path of the HDF5 file, overwritten if it exists
+        mtx_hpo_dist (np.ndarray): Distance matrix between individual HPO terms, or a
+            hpo_distance.tiled_hpo_distance that is computed while it is written
+        df_hpo_meta (pd.DataFrame): HPO metadata with columns hpo_id and hpo_name, in matrix row order
+        mtx_proband_dist (np.ndarray): Distance matrix between proband HPO sets, or a
+            hpo_distance.tiled_hpo_distance that is computed while it is written
+        df_probands (pd.DataFrame): Proband metadata with columns Gene, Disease, label and hpo_ids,
+            in matrix row order
+        format_version (int): 1 for the original float64 gzip layout, 2 for the compact layout
+        dtype (str): Matrix dtype in format version 2, 'f4' or 'f2'
+        layout (str): Format version 2 layout. 'chunked' stores row chunks compressed with lzf,
+            'contiguous' stores uncompressed matrices that hpo_distance_file can memory-map
+        chunk_rows (int): Number of rows per chunk in the 'chunked' layout
+        metric (dict): kind, method and combine of the distances, stored as file attributes so
+            incremental updates can check they use the same metric
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f'layout must be one of {LAYOUTS}, not {layout}')
+    storage = {'format_version': format_version, 'dtype': dtype, 'layout': layout, 'chunk_rows': chunk_rows}
+
+    with h5py.File(hf_save_path, 'w') as f:
+        f.attrs['format_version'] = format_version
+        for key, value in (metric or {}).items():
+            f.attrs[key] = value
+        if format_version >= 2:
+            f.attrs['layout'] = layout
+
+        # Save HPO distance matrix and metadata
+        ## HPO distance matrix
+        _write_distance(f, 'hpo_distance', mtx_hpo_dist, **storage)
+        ## HPO metadata
+        hpo_metadata_group = f.create_group('hpo_metadata')
+        hpo_metadata_group.create_dataset('hpo_id', data=np.array(df_hpo_meta['hpo_id'].values, dtype='S'))
+        hpo_metadata_group.create_dataset('hpo_name', data=np.array(df_hpo_meta['hpo_name'].values, dtype='S'))
+        hpo_metadata_group.create_dataset('index', data=df_hpo_meta.index.values)
+        hpo_metadata_group.attrs['columns'] = np.array(df_hpo_meta.columns.tolist(), dtype='S')
+
+        # Save proband distance matrix and metadata
+        ## Proband distance matrix
+        _write_distance(f, 'proband_distance', mtx_proband_dist, **storage)
+        ## Proband metadata
+        proband_metadata_group = f.create_group('proband_metadata')
+        proband_metadata_group.create_dataset('gene', data=np.array(df_probands['Gene'].values, dtype='S'))
+        proband_metadata_group.create_dataset('disease', data=np.array(df_probands['Disease'].values, dtype='S'))
+        proband_metadata_group.create_dataset('proband_id', data=np.array(df_probands['label'].values, dtype='S'))
+        ## Comma separated HPO IDs of each proband, used to detect changed probands in incremental updates
+        proband_metadata_group.create_dataset('hpo_ids', data=np.array(df_probands['hpo_ids'].values, dtype='S'))
+        proband_metadata_group.create_dataset('index', data=df_probands.index.values)
+        proband_metadata_group.attrs['columns'] = np.array(df_probands.columns.tolist(), dtype='S')
+
+        if format_version >= 2:
+            ## Unique proband key and gene/disease to row indices for random access by ID
+            proband_key = df_probands['Gene'] + '__' + df_probands['Disease'] + '__' + df_probands['label']
+            proband_metadata_group.create_dataset('proband_key', data=np.array(proband_key.values, dtype='S'))
+            _write_group_index(proband_metadata_group, 'gene_index', df_probands['Gene'].values)
+            _write_group_index(proband_metadata_group, 'disease_index', df_probands['Disease'].values)
+
+
+def _decode(dataset):
+    return [x.decode() for x in dataset[:]]
+
+
+def _metric(f):
+    if 'kind' not in f.attrs:
+        return None
+    return {key: str(f.attrs[key]) for key in ['kind', 'method', 'combine']}
+
+
+def read_hpo_metric(hf_path):
+    """
+    Read the metric dict of kind, method and combine of a file written by write_hpo_h5 without
+    reading its matrices. None for files written before the metric was stored, which were written
+    with DEFAULT_METRIC
+    """
+    with h5py.File(hf_path, 'r') as f:
+        return _metric(f)
+
+
+def read_hpo_h5(hf_path):
+    """
+    Read distance matrices and the metadata needed to incrementally update them
+    from a file written by write_hpo_h5
+
+    Args:
+        hf_path (str): Path of the HDF5 file
+
+    Returns:
+        dict: hpo_distance and proband_distance matrices, hpo_id list, proband_key list
+        of "Gene__Disease__label" IDs, proband_hpo_ids list of comma separated HPO IDs and the
+        metric dict of kind, method and combine. proband_hpo_ids is None for files written before
+        HPO IDs were stored and metric for files written before the metric was stored
+    """
+    with h5py.File(hf_path, 'r') as f:
+        proband_metadata = f['proband_metadata']
+        output = {
+            'hpo_distance': f['hpo_distance'][:].astype(np.float64),
+            'hpo_id': _decode(f['hpo_metadata/hpo_id']),
+            'proband_distance': f['proband_distance'][:].astype(np.float64),
+            'proband_key': [
+                f'{gene}__{disease}__{label}' for gene, disease, label in zip(
+                    _decode(proband_metadata['gene']),
+                    _decode(proband_metadata['disease']),
+                    _decode(proband_metadata['proband_id'])
+                )
+            ],
+            'proband_hpo_ids': _decode(proband_metadata['hpo_ids']) if 'hpo_ids' in proband_metadata else None,
+            'metric': _metric(f)
+        }
+    return output
+
+
+class hpo_distance_file:
+    """
+    Lazy, ID-addressable reader of files written by write_hpo_h5
+    The file is only opened on first access and metadata is only decoded when needed.
+    Single rows and submatrices are read without loading the full matrix: in the chunked
+    layout only the chunks holding the requested rows are decompressed, in the contiguous
+    layout matrices are memory-mapped. Format version 1 files are supported but every row
+    read decompresses the whole-dataset gzip chunks it touches
+    """
+    matrices = {'proband': 'proband_distance', 'hpo': 'hpo_distance'}
+
+    def __init__(self, hf_path):
+        self.hf_path = str(hf_path)
+        self._file = None
+        self._cache = {}
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = h5py.File(self.hf_path, 'r')
+        return self._file
+
+    @property
+    def format_version(self):
+        return int(self.file.attrs.get('format_version', 1))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cached(self, key, build):
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    @property
+    def proband_ids(self):
+        """
+        "Gene__Disease__label" ID of every proband row
+        """
+        def build():
+            metadata = self.file['proband_metadata']
+            if 'proband_key' in metadata:
+                return _decode(metadata['proband_key'])
+            return [
+                f'{gene}__{disease}__{label}' for gene, disease, label in zip(
+                    _decode(metadata['gene']), _decode(metadata['disease']), _decode(metadata['proband_id'])
+                )
+            ]
+        return self._cached('proband_ids', build)
+
+    @property
+    def hpo_ids(self):
+        return self._cached('hpo_ids', lambda: _decode(self.file['hpo_metadata/hpo_id']))
+
+    @property
+    def metric_names(self):
+        """
+        Names of the proband distance datasets of a metric sweep, usable as kind in all read methods
+        """
+        return list(self.file['metrics']) if 'metrics' in self.file else []
+
+    def _row_lookup(self, kind):
+        kind = 'hpo' if kind == 'hpo' else 'proband'
+        ids = self.hpo_ids if kind == 'hpo' else self.proband_ids
+        return self._cached(f'{kind}_lookup', lambda: {x: i for i, x in enumerate(ids)})
+
+    def _group_rows(self, name, value):
+        """
+        Internal method returning the proband rows of a gene or disease
+        """
+        def build():
+            metadata = self.file['proband_metadata']
+            if f'{name}_index' in metadata:
+                index = metadata[f'{name}_index']
+                names = _decode(index['names'])
+                indptr = index['indptr'][:]
+                rows = index['rows'][:]
+                return {x: rows[indptr[i]:indptr[i + 1]] for i, x in enumerate(names)}
+            values = np.array(_decode(metadata[name]), dtype=object)
+            return {x: np.flatnonzero(values == x) for x in np.unique(values)}
+        groups = self._cached(f'{name}_rows', build)
+        if value not in groups:
+            raise KeyError(f'{name} {value} not in {self.hf_path}')
+        return groups[value]
+
+    def rows_of(self, ids, kind='proband'):
+        """
+        Row indices of proband IDs ("Gene__Disease__label") or HPO IDs
+        """
+        lookup = self._row_lookup(kind)
+        return np.array([lookup[x] for x in ids], dtype=np.int64)
+
+    def _dataset(self, kind):
+        # Metric sweep datasets share the proband rows of proband_distance
+        return self.file[self.matrices.get(kind, f'metrics/{kind}')]
+
+    def memmap(self, kind='proband'):
+        """
+        Memory-map a full matrix without reading it
+
+        Returns:
+            np.memmap: Read-only matrix. Raises ValueError for compressed or chunked datasets
+        """
+        def build():
+            dataset = self._dataset(kind)
+            offset = dataset.id.get_offset()
+            if dataset.chunks is not None or offset is None:
+                raise ValueError(f'{dataset.name} is not stored contiguously, write it with layout="contiguous"')
+            return np.memmap(self.hf_path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+        return self._cached(f'{kind}_memmap', build)
+
+    def matrix(self, kind='proband'):
+        """
+        Full matrix, memory-mapped when possible and read otherwise
+        """
+        dataset = self._dataset(kind)
+        if dataset.chunks is None and dataset.compression is None:
+            return self.memmap(kind)
+        return dataset[:]
+
+    def _read_rows(self, kind, rows):
+        """
+        Internal method reading rows in the order given. h5py requires increasing indices,
+        so rows are read sorted and unique and reordered afterwards
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        dataset = self._dataset(kind)
+        if dataset.chunks is None and dataset.compression is None:
+            return np.asarray(self.memmap(kind)[rows])
+        unique, inverse = np.unique(rows, return_inverse=True)
+        return dataset[unique, :][inverse]
+
+    def row(self, item_id, kind='proband'):
+        """
+        Distances from one proband or HPO term to all others
+
+        Args:
+            item_id (str): Proband ID ("Gene__Disease__label") or HPO ID
+            kind (str): 'proband', 'hpo' or one of metric_names
+        """
+        return self._read_rows(kind, self.rows_of([item_id], kind))[0]
+
+    def submatrix(self, ids, kind='proband'):
+        """
+        Distances between the given probands or HPO terms, in the order given
+        """
+        rows = self.rows_of(ids, kind)
+        return self._read_rows(kind, rows)[:, rows]
+
+    def submatrix_by(self, gene=None, disease=None):
+        """
+        Distances between the probands of a gene and/or disease
+
+        Args:
+            gene (str): Gene symbol
+            disease (str): Disease name
+
+        Returns:
+            tuple: (proband IDs, distance submatrix)
+        """
+        rows = np.arange(len(self.proband_ids))
+        if gene is not None:
+            rows = np.intersect1d(rows, self._group_rows('gene', gene))
+        if disease is not None:
+            rows = np.intersect1d(rows, self._group_rows('disease', disease))
+        ids = [self.proband_ids[i] for i in rows]
+        return ids, self._read_rows('proband', rows)[:, rows]
@@ -0,0 +1,316 @@
+import sys
+import os
+import argparse
+import warnings
+import h5py
+import numpy as np
+import pandas as pd
+from pyprojroot.here import here
+
+levels = ['table', 'subtable']
+
+
+class iuis_index:
+    """
+    Gene to IUIS category index built once from data/iuis_table.csv
+    A gene can belong to several categories, so membership is a genes x categories boolean matrix
+    """
+    def __init__(self, df_iuis, level='table'):
+        """
+        Args:
+            df_iuis (pd.DataFrame): Table written by process_iuis_table.R
+            level (str): 'table' or 'subtable'. Subtable categories are named table.subtable
+        """
+        if level not in levels:
+            raise ValueError(f'level must be one of {levels}, not {level}')
+        self.level = level
+        df = df_iuis.drop_duplicates(subset=['gene', 'table', 'subtable']).sort_values(['table', 'subtable'])
+        if level == 'table':
+            keys = df['table'].astype(str)
+            descriptions = df['table_description']
+        else:
+            keys = df['table'].astype(str) + '.' + df['subtable'].astype(str)
+            descriptions = df['table_description'].where(
+                df['subtable_description'].fillna('None') == 'None',
+                df['table_description'] + ': ' + df['subtable_description']
+            )
+        df = pd.DataFrame({'gene': df['gene'].to_numpy(), 'category': keys.to_numpy(), 'description': descriptions.to_numpy()})
+        df_categories = df.drop_duplicates('category')
+        self.categories = df_categories['category'].tolist()
+        self.descriptions = df_categories['description'].tolist()
+        self.genes = pd.Index(sorted(df['gene'].unique()))
+        self.membership = np.zeros((len(self.genes), len(self.categories)), dtype=bool)
+        self.membership[
+            self.genes.get_indexer(df['gene']), pd.Index(self.categories).get_indexer(df['category'])
+        ] = True
+
+    @classmethod
+    def from_csv(cls, path, level='table'):
+        return cls(pd.read_csv(path), level)
+
+    def gene_membership(self, genes):
+        """
+        Return the category membership of genes, all False for genes that are not in the IUIS table
+
+        Returns:
+            np.ndarray: len(genes) x len(categories) boolean matrix
+        """
+        index = self.genes.get_indexer(genes)
+        membership = self.membership[index]
+        membership[index < 0] = False
+        return membership
+
+
+def _category_stats(sums, counts, membership):
+    """
+    Within- and between-category distance sums and pair counts from gene x gene sums and pair counts
+
+    Args:
+        sums (np.ndarray): G x G sums of proband distances between genes
+        counts (np.ndarray): G x G numbers of proband pairs between genes, self pairs excluded
+        membership (np.ndarray): G x C category membership of the genes
+    """
+    u = membership.astype(np.float64)
+    outside = 1 - u
+    # Pairs sharing at least one category against pairs sharing none
+    shared = (u @ u.T) > 0
+    return {
+        'within_sum': np.einsum('gc,gh,hc->c', u, sums, u),
+        'within_pairs': np.einsum('gc,gh,hc->c', u, counts, u),
+        'between_sum': np.einsum('gc,gh,hc->c', u, sums, outside),
+        'between_pairs': np.einsum('gc,gh,hc->c', u, counts, outside),
+        'shared_sum': sums[shared].sum(),
+        'shared_pairs': counts[shared].sum(),
+        'unshared_sum': sums[~shared].sum(),
+        'unshared_pairs': counts[~shared].sum()
+    }
+
+
+def _ratio(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b > 0, a / np.where(b > 0, b, 1), np.nan)
+
+
+class iuis_stratification:
+    """
+    Within- and between-IUIS-category statistics of a proband distance matrix
+
+    The matrix is read once in row chunks, restricted to probands whose gene is in the IUIS
+    table. Each chunk is reduced to gene x gene distance sums, and binned into within- and
+    between-category histograms per category and overall. Summaries and permutation tests are
+    then computed from the G x G gene sums only: categories are a property of genes, so the
+    permutation tests shuffle the category labels of genes, keeping probands of a gene together,
+    and never read the matrix again
+    """
+    def __init__(self, dataset, genes, index, bins=50, value_range=(0, 1), chunk_rows=1024):
+        """
+        Args:
+            dataset (h5py.Dataset or np.ndarray): Square proband distance matrix
+            genes (list): Gene of every proband row
+            index (iuis_index): Gene to category index
+            bins (int): Number of histogram bins
+            value_range (tuple): Range of the histogram bins, distances outside it are counted in the end bins
+            chunk_rows (int): Number of matrix rows read at once
+        """
+        self.index = index
+        genes = np.asarray(genes, dtype=str)
+        self.n_probands = len(genes)
+        gene_names, gene_of = np.unique(genes, return_inverse=True)
+        categorized = index.gene_membership(gene_names).any(axis=1)
+        self.uncategorized_genes = gene_names[~categorized].tolist()
+        # Gene space of the categorized genes, and their proband rows sorted by gene
+        self.gene_names = gene_names[categorized]
+        gene_code = np.full(len(gene_names), -1)
+        gene_code[categorized] = np.arange(categorized.sum())
+        row_gene = gene_code[gene_of]
+        rows = np.flatnonzero(row_gene >= 0)
+        rows = rows[np.argsort(row_gene[rows], kind='stable')]
+        # Categories without probands are left out
+        membership = index.gene_membership(self.gene_names)
+        present = membership.any(axis=0)
+        self.membership = membership[:, present]
+        self.categories = [x for x, keep in zip(index.categories, present) if keep]
+        self.descriptions = [x for x, keep in zip(index.descriptions, present) if keep]
+        self.gene_sizes = np.bincount(row_gene[rows], minlength=len(self.gene_names))
+        self.bin_edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        self._pass(dataset, rows, row_gene, bins, chunk_rows)
+
+    def _pass(self, dataset, rows, row_gene, bins, chunk_rows):
+        """
+        Internal method reading the matrix once and accumulating gene sums and histograms
+        """
+        n_genes, n_categories = self.membership.shape
+        col_genes = row_gene[rows]
+        starts = np.concatenate([[0], np.cumsum(self.gene_sizes)[:-1]])
+        col_member = self.membership[col_genes]
+        position = np.full(len(row_gene), -1)
+        position[rows] = np.arange(len(rows))
+        self.gene_sums = np.zeros((n_genes, n_genes))
+        hist_within = np.zeros((n_categories, bins), dtype=np.int64)
+        hist_between = np.zeros((n_categories, bins), dtype=np.int64)
+        hist_shared = np.zeros(bins, dtype=np.int64)
+        hist_unshared = np.zeros(bins, dtype=np.int64)
+        for start in range(0, self.n_probands, chunk_rows):
+            stop = min(start + chunk_rows, self.n_probands)
+            keep = np.flatnonzero(position[start:stop] >= 0)
+            if not len(keep):
+                continue
+            dist = np.asarray(dataset[start:stop], dtype=np.float64)[keep][:, rows]
+            chunk_genes = row_gene[start + keep]
+            chunk_member = self.membership[chunk_genes]
+            np.add.at(self.gene_sums, chunk_genes, np.add.reduceat(dist, starts, axis=1))
+
+            binned = np.clip(np.searchsorted(self.bin_edges, dist, side='right') - 1, 0, bins - 1)
+            not_self = np.ones(dist.shape, dtype=bool)
+            not_self[np.arange(len(keep)), position[start + keep]] = False
+            shared = (chunk_member.astype(np.int64) @ col_member.T.astype(np.int64)) > 0
+            hist_shared += np.bincount(binned[shared & not_self], minlength=bins)
+            hist_unshared += np.bincount(binned[~shared & not_self], minlength=bins)
+            for c in range(n_categories):
+                in_c = chunk_member[:, c]
+                if not in_c.any():
+                    continue
+                block, block_self = binned[in_c], not_self[in_c]
+                hist_within[c] += np.bincount(block[:, col_member[:, c]][block_self[:, col_member[:, c]]], minlength=bins)
+                hist_between[c] += np.bincount(block[:, ~col_member[:, c]].ravel(), minlength=bins)
+
+        self.gene_pairs = np.outer(self.gene_sizes, self.gene_sizes) - np.diag(self.gene_sizes)
+        self.histograms = {'within': hist_within, 'between': hist_between, 'shared': hist_shared, 'unshared': hist_unshared}
+
+    def summary(self):
+        """
+        Per-category summary of within- and between-category distances
+
+        Returns:
+            pd.DataFrame: One row per category with numbers of genes and probands, pair counts,
+                mean within- and between-category distances and their ratio
+        """
+        stats = _category_stats(self.gene_sums, self.gene_pairs, self.membership)
+        within_mean = _ratio(stats['within_sum'], stats['within_pairs'])
+        between_mean = _ratio(stats['between_sum'], stats['between_pairs'])
+        return pd.DataFrame({
+            'category': self.categories,
+            'description': self.descriptions,
+            'n_genes': self.membership.sum(axis=0),
+            'n_probands': self.gene_sizes @ self.membership,
+            'within_pairs': stats['within_pairs'].astype(np.int64),
+            'within_mean': within_mean,
+            'between_pairs': stats['between_pairs'].astype(np.int64),
+            'between_mean': between_mean,
+            'within_between_ratio': _ratio(within_mean, between_mean)
+        })
+
+    def distributions(self):
+        """
+        Histograms of within- and between-category distances, per category and overall
+        Overall, within pairs share at least one category and between pairs share none
+
+        Returns:
+            pd.DataFrame: Long table with columns category, comparison, bin_start, bin_end and count
+        """
+        frames = []
+        edges = {'bin_start': self.bin_edges[:-1], 'bin_end': self.bin_edges[1:]}
+        for comparison, overall in [('within', 'shared'), ('between', 'unshared')]:
+            frames.append(pd.DataFrame({'category': 'all', 'comparison': comparison, **edges, 'count': self.histograms[overall]}))
+            for c, category in enumerate(self.categories):
+                frames.append(pd.DataFrame({'category': category, 'comparison': comparison, **edges, 'count': self.histograms[comparison][c]}))
+        return pd.concat(frames, ignore_index=True)
+
+    def permutation_test(self, n_permutations=1000, seed=0):
+        """
+        Permutation test of whether probands of a category are closer to each other than expected
+        Category labels are shuffled between genes and the statistics recomputed from the gene sums
+
+        Args:
+            n_permutations (int): Number of permutations
+            seed (int): Random seed
+
+        Returns:
+            pd.DataFrame: summary with the null mean and standard deviation of the within-category
+                mean distance and the one-sided p-value of a lower observed value per category, and an
+                'all' row testing the difference between the mean distance of pairs sharing no category
+                and pairs sharing one, with the counts and means of those pairs
+        """
+        def statistics(membership):
+            stats = _category_stats(self.gene_sums, self.gene_pairs, membership)
+            within = _ratio(stats['within_sum'], stats['within_pairs'])
+            overall = stats['unshared_sum'] / max(stats['unshared_pairs'], 1) - stats['shared_sum'] / max(stats['shared_pairs'], 1)
+            return np.append(within, overall)
+
+        rng = np.random.default_rng(seed)
+        observed = statistics(self.membership)
+        null = np.array([
+            statistics(self.membership[rng.permutation(len(self.gene_names))]) for _ in range(n_permutations)
+        ])
+        # Lower within-category means and larger overall differences are more extreme. Permutations
+        # leaving a category without pairs are not counted
+        extreme = np.concatenate([null[:, :-1] <= observed[:-1], null[:, -1:] >= observed[-1:]], axis=1)
+        valid = ~np.isnan(null)
+        df = self.summary()
+        # Overall, within pairs share at least one category and between pairs share none
+        stats = _category_stats(self.gene_sums, self.gene_pairs, self.membership)
+        overall = {
+            'category': 'all', 'description': 'Between minus within mean distance', 'n_genes': len(self.gene_names),
+            'n_probands': self.gene_sizes.sum(),
+            'within_pairs': stats['shared_pairs'], 'within_mean': float(_ratio(stats['shared_sum'], stats['shared_pairs'])),
+            'between_pairs': stats['unshared_pairs'], 'between_mean': float(_ratio(stats['unshared_sum'], stats['unshared_pairs']))
+        }
+        overall['within_between_ratio'] = float(_ratio(overall['within_mean'], overall['between_mean']))
+        count_columns = ['n_genes', 'n_probands', 'within_pairs', 'between_pairs']
+        df = pd.concat([df, pd.DataFrame([overall])], ignore_index=True).astype({x: np.int64 for x in count_columns})
+        df['statistic'] = observed
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            df['null_mean'] = np.nanmean(null, axis=0)
+            df['null_std'] = np.nanstd(null, axis=0)
+        df['p_value'] = (1 + extreme.sum(axis=0)) / (1 + valid.sum(axis=0))
+        df.loc[np.isnan(observed), 'p_value'] = np.nan
+        return df
+
+
+def stratify_distance_file(hf_path, iuis_path, level='table', kind='proband', bins=50, chunk_rows=1024):
+    """
+    IUIS stratification of a proband distance matrix of an HDF5 file written by create_hpo_distance_object.py
+
+    Args:
+        hf_path (str): Path of the HDF5 file
+        iuis_path (str): Path of iuis_table.csv
+        level (str): 'table' or 'subtable'
+        kind (str): 'proband' or the name of a metric sweep dataset
+        bins (int): Number of histogram bins
+
+    Returns:
+        iuis_stratification: Stratification of the matrix
+    """
+    index = iuis_index.from_csv(iuis_path, level)
+    matrix_path = 'proband_distance' if kind == 'proband' else f'metrics/{kind}'
+    with h5py.File(hf_path, 'r') as f:
+        genes = [x.decode() for x in f['proband_metadata/gene'][:]]
+        strata = iuis_stratification(f[matrix_path], genes, index, bins=bins, chunk_rows=chunk_rows)
+    if strata.uncategorized_genes:
+        print(f'Genes not in the IUIS table: {", ".join(strata.uncategorized_genes)}', file=sys.stderr)
+    return strata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IUIS category stratified statistics of a proband distance matrix")
+    parser.add_argument('HF_PATH', type=str, help='HDF5 file written by create_hpo_distance_object.py')
+    parser.add_argument('--iuis', type=str, default=here('data/iuis_table.csv'), help='IUIS table csv')
+    parser.add_argument('--level', type=str, default='table', choices=levels, help='IUIS category level')
+    parser.add_argument('--kind', type=str, default='proband', help="'proband' or a metric sweep dataset name")
+    parser.add_argument('--bins', type=int, default=50, help='Number of histogram bins')
+    parser.add_argument('--n_permutations', type=int, default=1000, help='Number of label permutations')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the permutations')
+    parser.add_argument('--chunk_rows', type=int, default=1024, help='Number of matrix rows read at once')
+    parser.add_argument('--out', type=str, default=None, help='Prefix of the output csv files, HF_PATH without extension by default')
+    args = parser.parse_args()
+
+    strata = stratify_distance_file(args.HF_PATH, args.iuis, args.level, args.kind, args.bins, args.chunk_rows)
+    prefix = (args.out or os.path.splitext(args.HF_PATH)[0]) + f'_iuis_{args.level}'
+    strata.permutation_test(args.n_permutations, args.seed).to_csv(f'{prefix}_summary.csv', index=False)
+    strata.distributions().to_csv(f'{prefix}_distributions.csv', index=False)
+    print(f'Wrote {prefix}_summary.csv and {prefix}_distributions.csv', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
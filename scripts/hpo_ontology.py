@@ -0,0 +1,190 @@
+import sys
+import os
+import glob
+import json
+import shutil
+import argparse
+import datetime
+import numpy as np
+from pyprojroot.here import here
+
+SNAPSHOT_FORMAT_VERSION = 1
+ic_kinds = ['omim', 'orpha', 'gene']
+_arrays = [
+    'term_codes', 'names', 'obsolete', 'replaced_by',
+    'parent_indptr', 'parent_indices', 'child_indptr', 'child_indices',
+    'closure_indptr', 'closure_indices'
+] + [f'ic_{kind}' for kind in ic_kinds]
+
+
+def snapshot_path(version, data_dir='data'):
+    """
+    Path of the snapshot of an HPO release, next to its obo file: data/hp_[date].snapshot
+    """
+    return os.path.join(data_dir, f'hp_{version}.snapshot')
+
+
+def find_snapshot(data_dir='data', version=None):
+    """
+    Return the path of the snapshot of version, or of the latest snapshot in data_dir if version is None
+
+    Returns:
+        str: Path of the snapshot, None if there is none
+    """
+    if version is not None:
+        path = snapshot_path(version, data_dir)
+        return path if os.path.isdir(path) else None
+    paths = sorted(glob.glob(os.path.join(data_dir, 'hp_*.snapshot')))
+    return paths[-1] if paths else None
+
+
+def _csr(lists):
+    indptr = np.concatenate([[0], np.cumsum([len(x) for x in lists])]).astype(np.int64)
+    indices = np.fromiter((y for x in lists for y in sorted(x)), dtype=np.int32, count=indptr[-1])
+    return indptr, indices
+
+
+def build_snapshot(data_dir='data'):
+    """
+    Write a snapshot of the loaded HPO Ontology to data_dir/hp_[version].snapshot
+    The snapshot is written to a temporary directory and renamed, so readers never see a partial snapshot
+
+    Returns:
+        str: Path of the snapshot
+    """
+    from pyhpo import Ontology
+    terms = sorted(Ontology, key=int)
+    term_codes = np.array([int(x) for x in terms], dtype=np.int32)
+
+    def rows(related):
+        return np.searchsorted(term_codes, np.array([int(x) for x in related], dtype=np.int32))
+
+    arrays = {
+        'term_codes': term_codes,
+        'names': np.array([x.name for x in terms], dtype=str),
+        'obsolete': np.array([x.is_obsolete for x in terms], dtype=bool),
+        'replaced_by': np.array([int(x.replaced_by[3:]) if x.replaced_by else -1 for x in terms], dtype=np.int32)
+    }
+    arrays['parent_indptr'], arrays['parent_indices'] = _csr([rows(x.parents) for x in terms])
+    arrays['child_indptr'], arrays['child_indices'] = _csr([rows(x.children) for x in terms])
+    arrays['closure_indptr'], arrays['closure_indices'] = _csr(
+        [np.append(rows(x.all_parents), i) for i, x in enumerate(terms)]
+    )
+    for kind in ic_kinds:
+        arrays[f'ic_{kind}'] = np.array([x.information_content[kind] for x in terms])
+
+    version = Ontology.version()
+    path = snapshot_path(version, data_dir)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), values)
+    with open(os.path.join(tmp_path, 'snapshot.json'), 'w') as f:
+        json.dump({
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'hpo_version': version,
+            'n_terms': len(terms),
+            'ic_kinds': ic_kinds,
+            'created': datetime.datetime.now().isoformat(timespec='seconds')
+        }, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path
+
+
+class ontology_snapshot:
+    """
+    Read-only HPO Ontology arrays: term codes, names, parent/child adjacency, ancestor closures
+    and information content, as written by build_snapshot
+
+    Terms are rows sorted by their int code (HP:0001250 -> 1250). Adjacency and closures are
+    CSR arrays of rows, e.g. the ancestors of row i, including i, are
+    closure_indices[closure_indptr[i]:closure_indptr[i + 1]]. Arrays are memory-mapped, so loading
+    takes milliseconds and processes loading the same snapshot share one copy in the page cache
+    """
+    def __init__(self, path, mmap=True):
+        """
+        Args:
+            path (str): Snapshot directory
+            mmap (bool): Memory-map the arrays instead of reading them
+        """
+        with open(os.path.join(path, 'snapshot.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] > SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f'Snapshot format {self.meta["format_version"]} is newer than {SNAPSHOT_FORMAT_VERSION}')
+        self.path = path
+        for name in _arrays:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None))
+
+    @property
+    def version(self):
+        return self.meta['hpo_version']
+
+    def __len__(self):
+        return len(self.term_codes)
+
+    def rows(self, codes):
+        """
+        Rows of int codes, raising KeyError for codes that are not terms of the snapshot
+        """
+        codes = np.asarray(codes, dtype=np.int32)
+        rows = np.searchsorted(self.term_codes, codes)
+        missing = (rows >= len(self.term_codes)) | (self.term_codes[np.minimum(rows, len(self.term_codes) - 1)] != codes)
+        if missing.any():
+            raise KeyError(f'HPO codes not in snapshot {self.version}: {codes[missing][:10].tolist()}')
+        return rows
+
+    def information_content(self, codes, kind='omim'):
+        if kind not in ic_kinds:
+            raise ValueError(f'kind must be one of {ic_kinds}, not {kind}')
+        return np.asarray(getattr(self, f'ic_{kind}')[self.rows(codes)])
+
+    def parents(self, code):
+        i = self.rows([code])[0]
+        return self.term_codes[self.parent_indices[self.parent_indptr[i]:self.parent_indptr[i + 1]]]
+
+    def children(self, code):
+        i = self.rows([code])[0]
+        return self.term_codes[self.child_indices[self.child_indptr[i]:self.child_indptr[i + 1]]]
+
+    def closures(self, codes):
+        """
+        Ancestor closures (ancestors and the term itself) of terms as CSR arrays of sorted codes,
+        the layout of hpo_cohort closures
+
+        Returns:
+            tuple: (indptr, codes) with the closure of codes[i] in codes[indptr[i]:indptr[i + 1]]
+        """
+        rows = self.rows(codes)
+        starts, stops = self.closure_indptr[rows], self.closure_indptr[rows + 1]
+        indptr = np.concatenate([[0], np.cumsum(stops - starts)]).astype(np.int64)
+        # Gather all closure slices at once, rows of closure_indices are sorted so codes are too
+        offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, stops - starts)
+        return indptr, self.term_codes[self.closure_indices[offsets]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect a memory-mappable snapshot of the HPO Ontology")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Snapshot the Ontology bundled with hpo3')
+    build_parser.add_argument('--data_dir', type=str, default=here('data'), help='Directory of the hp_[date].obo files')
+    info_parser = subparsers.add_parser('info', help='Print the metadata of a snapshot')
+    info_parser.add_argument('PATH', type=str, nargs='?', default=None, help='Snapshot directory, latest in data/ if not given')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from pyhpo import Ontology
+        Ontology()
+        path = build_snapshot(args.data_dir)
+        print(f'Wrote {path}', file=sys.stderr)
+    else:
+        path = args.PATH or find_snapshot(here('data'))
+        if path is None:
+            parser.error('No snapshot found in data/')
+        snapshot = ontology_snapshot(path)
+        print(json.dumps(snapshot.meta, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import sys
+import argparse
+import h5py
+import numpy as np
+import pandas as pd
+from pyprojroot.here import here
+from pyhpo import Ontology, helper
+
+here()
+sys.path.insert(0, here('scripts'))
+from hpo_similarity import combine_best_match
+from hpo_h5 import read_hpo_metric, DEFAULT_METRIC
+
+
+def _encode(values):
+    return np.array(list(values), dtype='S')
+
+
+def _decode(dataset):
+    return [x.decode() for x in dataset[:]]
+
+
+class proband_index:
+    """
+    Prebuilt index over proband HPO sets for top-k similarity queries of new patients
+    Stores each proband's terms as integer indices into the cohort term list and the
+    ancestor closure of every cohort term with its information content.
+    A query only compares query terms with cohort terms that share an informative ancestor
+    (term similarity is 0 otherwise for resnik, lin, graphic, rel and ic) and scores
+    probands in decreasing order of an upper bound, stopping as soon as no remaining
+    proband can enter the top k probands or genes
+    """
+    # Term similarity methods that are 0 for terms without a common ancestor of positive IC
+    ic_bounded_methods = ['resnik', 'lin', 'graphic', 'rel', 'ic']
+
+    def __init__(self, gene, disease, label, term_ids, indptr, indices,
+                 closure_indptr, closure_ids, closure_ic, kind="omim", method="graphic", combine="funSimAvg"):
+        """
+        Args:
+            gene (list): Gene of each proband
+            disease (list): Disease of each proband
+            label (list): Label of each proband
+            term_ids (list): HPO IDs of all cohort terms
+            indptr (np.ndarray): CSR row pointers of proband terms
+            indices (np.ndarray): CSR indices of proband terms into term_ids
+            closure_indptr (np.ndarray): CSR row pointers of the ancestor closure of each cohort term
+            closure_ids (np.ndarray): Integer HPO IDs of the ancestors (including the term itself)
+            closure_ic (np.ndarray): Information content of each entry of closure_ids
+            kind (str): Information content kind used for similarity
+            method (str): Term similarity method
+            combine (str): Set similarity combine method
+        """
+        self.gene = np.asarray(gene, dtype=object)
+        self.disease = np.asarray(disease, dtype=object)
+        self.label = np.asarray(label, dtype=object)
+        self.term_ids = list(term_ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.closure_indptr = np.asarray(closure_indptr, dtype=np.int64)
+        self.closure_ids = np.asarray(closure_ids, dtype=np.int64)
+        self.closure_ic = np.asarray(closure_ic, dtype=np.float64)
+        self.kind = kind
+        self.method = method
+        self.combine = combine
+        self.set_sizes = np.diff(self.indptr)
+        self._terms = None
+
+    @classmethod
+    def build(cls, df_probands, kind="omim", method="graphic", combine="funSimAvg"):
+        """
+        Build an index from a table of probands. The HPO Ontology must be loaded
+
+        Args:
+            df_probands (pd.DataFrame): Probands with columns Gene, Disease, label and hpo_ids,
+                a comma separated string of HPO IDs
+            kind (str): Information content kind used for similarity
+            method (str): Term similarity method
+            combine (str): Set similarity combine method
+
+        Returns:
+            proband_index: The index
+        """
+        proband_terms = [[y for y in x.split(',') if y] for x in df_probands['hpo_ids']]
+        term_ids = sorted({y for x in proband_terms for y in x})
+        term_index = {x: i for i, x in enumerate(term_ids)}
+        indptr = np.concatenate([[0], np.cumsum([len(x) for x in proband_terms])])
+        indices = np.array([term_index[y] for x in proband_terms for y in x], dtype=np.int64)
+
+        closures = []
+        for term_id in term_ids:
+            term = Ontology.get_hpo_object(term_id)
+            closures.append([term] + list(term.all_parents))
+        closure_indptr = np.concatenate([[0], np.cumsum([len(x) for x in closures])])
+        closure_ids = np.array([int(y) for x in closures for y in x], dtype=np.int64)
+        closure_ic = np.array([y.information_content[kind] for x in closures for y in x])
+
+        return cls(
+            df_probands['Gene'].to_list(), df_probands['Disease'].to_list(), df_probands['label'].to_list(),
+            term_ids, indptr, indices, closure_indptr, closure_ids, closure_ic, kind, method, combine
+        )
+
+    @classmethod
+    def from_distance_h5(cls, hf_path, kind=None, method=None, combine=None):
+        """
+        Build an index from the proband metadata of a file written by create_hpo_distance_object.py
+        The index uses the metric the distances of the file were computed with. Raises ValueError
+        if kind, method or combine are given and differ from it
+
+        Args:
+            hf_path (str): Path of the HDF5 distance file
+            kind (str): Information content kind, the kind of the file if None
+            method (str): Term similarity method, the method of the file if None
+            combine (str): Set similarity combine method, the combine method of the file if None
+        """
+        metric = read_hpo_metric(hf_path) or DEFAULT_METRIC
+        requested = {'kind': kind, 'method': method, 'combine': combine}
+        conflicts = [
+            f'{key} {value} (file: {metric[key]})'
+            for key, value in requested.items() if value is not None and value != metric[key]
+        ]
+        if conflicts:
+            raise ValueError(f'{hf_path} stores distances of another metric: {", ".join(conflicts)}')
+        with h5py.File(hf_path, 'r') as f:
+            metadata = f['proband_metadata']
+            if 'hpo_ids' not in metadata:
+                raise ValueError(f'{hf_path} does not store proband HPO IDs, re-run create_hpo_distance_object.py')
+            df_probands = pd.DataFrame({
+                'Gene': _decode(metadata['gene']),
+                'Disease': _decode(metadata['disease']),
+                'label': _decode(metadata['proband_id']),
+                'hpo_ids': _decode(metadata['hpo_ids'])
+            })
+        return cls.build(df_probands, **metric)
+
+    def save(self, hf_save_path):
+        with h5py.File(hf_save_path, 'w') as f:
+            f.attrs['kind'] = self.kind
+            f.attrs['method'] = self.method
+            f.attrs['combine'] = self.combine
+            probands = f.create_group('probands')
+            probands.create_dataset('gene', data=_encode(self.gene))
+            probands.create_dataset('disease', data=_encode(self.disease))
+            probands.create_dataset('label', data=_encode(self.label))
+            probands.create_dataset('indptr', data=self.indptr)
+            probands.create_dataset('indices', data=self.indices)
+            terms = f.create_group('terms')
+            terms.create_dataset('term_id', data=_encode(self.term_ids))
+            terms.create_dataset('closure_indptr', data=self.closure_indptr)
+            terms.create_dataset('closure_ids', data=self.closure_ids)
+            terms.create_dataset('closure_ic', data=self.closure_ic)
+
+    @classmethod
+    def load(cls, hf_path):
+        with h5py.File(hf_path, 'r') as f:
+            probands = f['probands']
+            terms = f['terms']
+            return cls(
+                _decode(probands['gene']), _decode(probands['disease']), _decode(probands['label']),
+                _decode(terms['term_id']), probands['indptr'][:], probands['indices'][:],
+                terms['closure_indptr'][:], terms['closure_ids'][:], terms['closure_ic'][:],
+                f.attrs['kind'], f.attrs['method'], f.attrs['combine']
+            )
+
+    def _term_objects(self):
+        """
+        Internal method returning HPOTerm objects of all cohort terms, created on first use
+        """
+        if self._terms is None:
+            self._terms = [Ontology.get_hpo_object(x) for x in self.term_ids]
+        return self._terms
+
+    def _candidate_terms(self, query_term, min_shared_ic):
+        """
+        Internal method returning indices of cohort terms sharing an ancestor with
+        information content above min_shared_ic with query_term
+        """
+        query_closure = [query_term] + list(query_term.all_parents)
+        informative = [int(x) for x in query_closure if x.information_content[self.kind] > min_shared_ic]
+        shared = np.isin(self.closure_ids, informative) & (self.closure_ic > min_shared_ic)
+        return np.flatnonzero(np.logical_or.reduceat(shared, self.closure_indptr[:-1]))
+
+    def _query_term_similarity(self, query_terms, min_shared_ic):
+        """
+        Internal method computing the query term x cohort term similarity matrix
+        Pairs without a shared informative ancestor are skipped and left at 0
+        """
+        cohort_terms = self._term_objects()
+        sim = np.zeros((len(query_terms), len(self.term_ids)))
+        prune = self.method in self.ic_bounded_methods
+        pairs = []
+        for q, query_term in enumerate(query_terms):
+            candidates = self._candidate_terms(query_term, min_shared_ic) if prune else range(len(cohort_terms))
+            pairs.extend((q, t) for t in candidates)
+        if pairs:
+            scores = helper.batch_similarity(
+                [(query_terms[q], cohort_terms[t]) for q, t in pairs],
+                kind=self.kind,
+                method=self.method
+            )
+            q, t = np.array(pairs).T
+            sim[q, t] = scores
+        return sim
+
+    def _exact_sum_ba(self, sim, probands):
+        """
+        Internal method returning, for each proband, the sum over query terms of their
+        best match among the proband's terms
+        """
+        sizes = self.set_sizes[probands]
+        columns = np.concatenate([self.indices[self.indptr[i]:self.indptr[i + 1]] for i in probands])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        return np.maximum.reduceat(sim[:, columns], starts, axis=1).sum(axis=0)
+
+    def query(self, hpo_ids, k=10, min_shared_ic=0.0, batch_size=256):
+        """
+        Find the probands and genes most similar to a set of HPO terms
+
+        Args:
+            hpo_ids (list): HPO IDs of the new patient. Unknown IDs are skipped
+            k (int): Number of probands and genes to return
+            min_shared_ic (float): Term pairs whose common ancestors all have an information content
+                at or below this value are treated as dissimilar. 0 is exact, larger values
+                prune more term pairs at the cost of ignoring weak similarities
+            batch_size (int): Number of probands scored exactly per step
+
+        Returns:
+            tuple: (probands, genes) DataFrames of the top k probands and genes, sorted by score
+        """
+        query_terms = {}
+        for hpo_id in hpo_ids:
+            try:
+                term = Ontology.get_hpo_object(hpo_id)
+            except (KeyError, ValueError, RuntimeError):
+                print(f'Skipping unknown HPO term {hpo_id}', file=sys.stderr)
+                continue
+            query_terms[term.id] = term
+        query_terms = list(query_terms.values())
+        if not query_terms:
+            raise ValueError('No valid HPO terms in query')
+        n_query = len(query_terms)
+        n_probands = len(self.set_sizes)
+        sizes = self.set_sizes.astype(np.float64)
+
+        sim = self._query_term_similarity(query_terms, min_shared_ic)
+        # Best match of each cohort term in the query, gives sum_ab exactly for all probands
+        best_query = sim.max(axis=0)
+        term_terms = self.indices
+        segment_starts = self.indptr[:-1]
+        nonempty = self.set_sizes > 0
+        sum_ab = np.zeros(n_probands)
+        max_best = np.zeros(n_probands)
+        if nonempty.any():
+            sum_ab[nonempty] = np.add.reduceat(best_query[term_terms], segment_starts[nonempty])
+            max_best[nonempty] = np.maximum.reduceat(best_query[term_terms], segment_starts[nonempty])
+
+        # Upper bound of sum_ba: no query term can match a proband better than the proband's
+        # best matching term matches the query, nor better than its best match in the cohort
+        upper_ba = np.minimum(n_query * max_best, sim.max(axis=1).sum())
+        upper = combine_best_match(sum_ab, upper_ba, n_query, sizes, self.combine)
+
+        order = np.argsort(-upper, kind='stable')
+        scores = np.full(n_probands, -np.inf)
+        gene_best = {}
+        for start in range(0, n_probands, batch_size):
+            batch = order[start:start + batch_size]
+            # Stop once the k-th best proband and gene beat every remaining upper bound
+            if start >= k and len(gene_best) >= k:
+                kth_proband = np.partition(scores, -k)[-k]
+                kth_gene = sorted(gene_best.values(), reverse=True)[k - 1]
+                if upper[batch[0]] <= min(kth_proband, kth_gene):
+                    break
+            batch = batch[nonempty[batch]]
+            if not len(batch):
+                continue
+            scores[batch] = combine_best_match(
+                sum_ab[batch], self._exact_sum_ba(sim, batch), n_query, sizes[batch], self.combine
+            )
+            for i in batch:
+                gene_best[self.gene[i]] = max(gene_best.get(self.gene[i], -np.inf), scores[i])
+
+        scored = np.flatnonzero(np.isfinite(scores))
+        top = scored[np.argsort(-scores[scored], kind='stable')]
+        df_probands = pd.DataFrame({
+            'gene': self.gene[top],
+            'disease': self.disease[top],
+            'label': self.label[top],
+            'score': scores[top]
+        })
+        df_genes = (
+            df_probands.groupby('gene', sort=False)
+            .agg(score=('score', 'max'), best_disease=('disease', 'first'), best_label=('label', 'first'), n_probands_scored=('score', 'size'))
+            .reset_index()
+            .sort_values('score', ascending=False, kind='stable')
+        )
+        return df_probands.head(k).reset_index(drop=True), df_genes.head(k).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the curated probands and genes most similar to a patient's HPO terms")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build a query index from a distance file written by create_hpo_distance_object.py')
+    build_parser.add_argument('DISTANCE_H5', type=str, help='HDF5 distance file, e.g. data/pird_hpo.h5')
+    build_parser.add_argument('INDEX_H5', type=str, help='Path of the index file to write')
+    build_parser.add_argument('--kind', type=str, default=None, help='Information content kind, the kind of the distance file by default')
+    build_parser.add_argument('--method', type=str, default=None, help='Term similarity method, the method of the distance file by default')
+    build_parser.add_argument('--combine', type=str, default=None, help='Set similarity combine method, the combine method of the distance file by default')
+
+    query_parser = subparsers.add_parser('query', help='Query an index with HPO terms')
+    query_parser.add_argument('INDEX_H5', type=str, help='Index file written by the build command')
+    query_parser.add_argument('HPO_IDS', type=str, nargs='+', help='HPO IDs of the patient')
+    query_parser.add_argument('-k', type=int, default=10, help='Number of probands and genes to return')
+    query_parser.add_argument('--min_shared_ic', type=float, default=0.0,
+                              help='Treat term pairs without a common ancestor above this information content as dissimilar')
+    args = parser.parse_args()
+
+    Ontology()
+    if args.command == 'build':
+        try:
+            index = proband_index.from_distance_h5(args.DISTANCE_H5, kind=args.kind, method=args.method, combine=args.combine)
+        except ValueError as e:
+            parser.error(str(e))
+        index.save(args.INDEX_H5)
+    else:
+        index = proband_index.load(args.INDEX_H5)
+        df_probands, df_genes = index.query(args.HPO_IDS, k=args.k, min_shared_ic=args.min_shared_ic)
+        print(df_probands.to_string())
+        print()
+        print(df_genes.to_string())
+
+
+if __name__ == "__main__":
+    main()
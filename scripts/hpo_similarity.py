@@ -0,0 +1,337 @@
+import os
+
+import numpy as np
+from pyhpo import helper
+
+combine_methods = ['funSimAvg', 'funSimMax', 'BMA']
+
+
+def combine_best_match(sum_ab, sum_ba, size_a, size_b, combine):
+    """
+    Combine best match sums into set similarities, as hpo3 does for HPOSet.similarity
+
+    Args:
+        sum_ab (np.ndarray): Sum over the terms of set b of their best match in set a
+        sum_ba (np.ndarray): Sum over the terms of set a of their best match in set b
+        size_a (np.ndarray): Number of terms of set a
+        size_b (np.ndarray): Number of terms of set b
+        combine (str): One of combine_methods
+
+    Returns:
+        np.ndarray: Set similarities, 0 where a set is empty
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if combine == 'BMA':
+            sim = (sum_ab + sum_ba) / (size_a + size_b)
+        else:
+            mean_a = sum_ba / size_a
+            mean_b = sum_ab / size_b
+            if combine == 'funSimAvg':
+                sim = (mean_a + mean_b) / 2
+            elif combine == 'funSimMax':
+                sim = np.maximum(mean_a, mean_b)
+            else:
+                raise ValueError(f'combine must be one of {combine_methods}, not {combine}')
+    return np.nan_to_num(sim, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+class set_similarity_engine:
+    """
+    Vectorized HPO set similarity built on a precomputed term x term similarity matrix
+    The similarity between every pair of HPO terms in the cohort is computed once with hpo3.
+    Each HPOSet is mapped to an integer array of term indices and set similarities
+    (funSimAvg, funSimMax, BMA) are computed from NumPy gathers and max reductions
+
+    For every set i and every term t, best[i, t] is the highest similarity between t and any
+    term of set i. The sum over the terms of set j of best[i, :] then gives the column part
+    of the combine methods for pair (i, j), so a block of rows of the proband matrix is a
+    single sparse-dense matrix product
+    """
+    def __init__(self, hpo_set_list, kind="omim", method="graphic", term_similarity=None, term_ids=None):
+        """
+        Args:
+            hpo_set_list (list): HPOSet objects
+            kind (str): Information content used for term similarity, passed to hpo3
+            method (str): Term similarity method, passed to hpo3
+            term_similarity (np.ndarray): Optional precomputed square term similarity matrix
+                ordered by term_ids. Computed with hpo3 if not given
+            term_ids (list): HPO IDs of the rows of term_similarity
+        """
+        set_terms = [list(x) for x in hpo_set_list]
+
+        if term_ids is None:
+            terms = {}
+            for x in set_terms:
+                for term in x:
+                    terms.setdefault(term.id, term)
+            term_ids = sorted(terms)
+            terms = [terms[x] for x in term_ids]
+        else:
+            terms = None
+        term_index = {x: i for i, x in enumerate(term_ids)}
+
+        # CSR style term indices of each set
+        set_sizes = np.array([len(x) for x in set_terms], dtype=np.int64)
+        indices = np.array([term_index[t.id] for x in set_terms for t in x], dtype=np.int64)
+        self._set_arrays(term_ids, terms, set_sizes, indices, kind, method, term_similarity)
+
+    @classmethod
+    def from_cohort(cls, cohort, kind="omim", method="graphic", term_similarity=None):
+        """
+        Build an engine from the CSR arrays of an hpo_cohort without creating HPOSet objects
+        Only the HPOTerm objects of the cohort terms are looked up when term_similarity is not given
+
+        Args:
+            cohort (hpo_cohort.hpo_cohort): Cohort of HPO sets
+            kind (str): Information content used for term similarity, passed to hpo3
+            method (str): Term similarity method, passed to hpo3
+            term_similarity (np.ndarray): Optional precomputed term similarity matrix ordered like cohort.term_ids
+        """
+        from pyhpo import Ontology
+        engine = cls.__new__(cls)
+        terms = None if term_similarity is not None else [Ontology[int(x)] for x in cohort.term_codes]
+        engine._set_arrays(cohort.term_ids, terms, cohort.set_sizes, cohort.indices, kind, method, term_similarity)
+        return engine
+
+    @classmethod
+    def load(cls, path, cohort, kind="omim", method="graphic", mmap=True):
+        """
+        Load an engine of cohort from the arrays written by save
+
+        Args:
+            path (str): Directory written by save for the same cohort
+            cohort (hpo_cohort.hpo_cohort): Cohort of HPO sets
+            kind (str): Information content kind the arrays were computed with
+            method (str): Term similarity method the arrays were computed with
+            mmap (bool): Memory-map the arrays, so processes loading the same directory share one copy
+        """
+        mmap_mode = 'r' if mmap else None
+        engine = cls.__new__(cls)
+        term_similarity = np.load(os.path.join(path, 'term_similarity.npy'), mmap_mode=mmap_mode)
+        engine._set_arrays(cohort.term_ids, None, cohort.set_sizes, cohort.indices, kind, method, term_similarity)
+        engine._best = np.load(os.path.join(path, 'best_match.npy'), mmap_mode=mmap_mode)
+        return engine
+
+    def save(self, path, block_size=1024):
+        """
+        Write the term similarity and best match matrices to directory path as .npy files
+        The best match matrix is written in blocks of block_size sets without keeping it in memory
+
+        Args:
+            path (str): Directory, created if it does not exist
+            block_size (int): Number of sets reduced at once
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'term_similarity.npy'), self.term_similarity)
+        best = np.lib.format.open_memmap(
+            os.path.join(path, 'best_match.npy'), mode='w+',
+            dtype=self.term_similarity.dtype, shape=(self.n_sets, len(self.term_ids))
+        )
+        for start in range(0, self.n_sets, block_size):
+            rows = np.arange(start, min(start + block_size, self.n_sets))
+            best[rows[0]:rows[-1] + 1] = self._best[rows] if self._best is not None else self.best_match(rows)
+        best.flush()
+        del best
+
+    def _set_arrays(self, term_ids, terms, set_sizes, indices, kind, method, term_similarity):
+        self.kind = kind
+        self.method = method
+        self.term_ids = list(term_ids)
+        self.terms = terms
+        self.set_sizes = np.asarray(set_sizes, dtype=np.int64)
+        self.indptr = np.concatenate([[0], np.cumsum(self.set_sizes)])
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        if term_similarity is None:
+            term_similarity = self._term_similarity()
+        self.term_similarity = term_similarity
+        self._best = None
+
+    @property
+    def n_sets(self):
+        return len(self.set_sizes)
+
+    def _term_similarity(self, block_size=256):
+        """
+        Internal method computing the similarity between every pair of terms with hpo3
+        Pairs are sent to hpo3 in blocks of rows to bound the size of the tuple list
+
+        Returns:
+            np.ndarray: Symmetric term x term similarity matrix
+        """
+        n = len(self.terms)
+        mtx_sim = np.zeros((n, n))
+        for start in range(0, n, block_size):
+            rows = range(start, min(start + block_size, n))
+            pairs = [(i, j) for i in rows for j in range(i, n)]
+            if not pairs:
+                continue
+            sim = helper.batch_similarity(
+                [(self.terms[i], self.terms[j]) for i, j in pairs],
+                kind=self.kind,
+                method=self.method
+            )
+            i, j = np.array(pairs).T
+            mtx_sim[i, j] = sim
+            mtx_sim[j, i] = sim
+        return mtx_sim
+
+    def set_terms(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def best_match(self, rows=None, block_size=1024):
+        """
+        Return the best matching similarity of every term against sets
+
+        Args:
+            rows (np.ndarray): Indices of the sets to use. If None, the matrix for all
+                sets is computed in blocks of block_size sets and cached
+            block_size (int): Number of sets reduced at once when rows is None
+
+        Returns:
+            np.ndarray: len(rows) x n_terms array, the maximum similarity between each term
+            and any term of each set. Rows of empty sets are 0
+        """
+        if rows is None:
+            if self._best is None:
+                self._best = np.vstack([
+                    self.best_match(np.arange(start, min(start + block_size, self.n_sets)))
+                    for start in range(0, self.n_sets, block_size)
+                ] or [np.zeros((0, len(self.term_ids)), dtype=self.term_similarity.dtype)])
+            return self._best
+        rows = np.asarray(rows)
+        sizes = self.set_sizes[rows]
+        indices = np.concatenate([self.set_terms(i) for i in rows]) if len(rows) else np.zeros(0, dtype=np.int64)
+        best = np.zeros((len(rows), len(self.term_ids)), dtype=self.term_similarity.dtype)
+        nonempty = sizes > 0
+        if nonempty.any():
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[nonempty]
+            best[nonempty] = np.maximum.reduceat(self.term_similarity[indices], starts, axis=0)
+        return best
+
+    def _incidence(self, cols):
+        """
+        Internal method returning the sparse set x term incidence matrix of the sets in cols
+        """
+        from scipy.sparse import csr_matrix
+        cols = np.asarray(cols)
+        sizes = self.set_sizes[cols]
+        indptr = np.concatenate([[0], np.cumsum(sizes)])
+        indices = np.concatenate([self.set_terms(j) for j in cols]) if len(cols) else np.zeros(0, dtype=np.int64)
+        return csr_matrix(
+            (np.ones(len(indices), dtype=self.term_similarity.dtype), indices, indptr),
+            shape=(len(cols), len(self.term_ids))
+        )
+
+    def best_match_sums(self, rows, cols):
+        """
+        Best match sums between every set in rows and every set in cols, shared by all combine methods
+
+        Returns:
+            tuple: (sum_ab, sum_ba) len(rows) x len(cols) arrays, see combine_best_match
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        best = self.best_match()
+        # sum_ab[i, j] = sum over terms of set cols[j] of their best match in set rows[i]
+        sum_ab = (self._incidence(cols) @ best[rows].T).T
+        sum_ba = self._incidence(rows) @ best[cols].T
+        return sum_ab, sum_ba
+
+    def similarity_block(self, rows, cols, combine="funSimAvg"):
+        """
+        Similarity between every set in rows and every set in cols
+
+        Args:
+            rows (np.ndarray): Set indices of the block rows
+            cols (np.ndarray): Set indices of the block columns
+            combine (str): One of combine_methods
+
+        Returns:
+            np.ndarray: len(rows) x len(cols) similarity block
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        sum_ab, sum_ba = self.best_match_sums(rows, cols)
+        return combine_best_match(
+            sum_ab, sum_ba,
+            self.set_sizes[rows][:, None], self.set_sizes[cols][None, :],
+            combine
+        )
+
+    def distance_blocks(self, combines, block_size=1024):
+        """
+        Generate the distance matrix between all sets in row blocks for several combine methods at once
+        The best match sums of each block are computed once and shared by all combine methods
+
+        Args:
+            combines (list): Combine methods, each one of combine_methods
+            block_size (int): Number of rows computed at once
+
+        Yields:
+            tuple: (rows, dict of combine method to len(rows) x n_sets distance block)
+        """
+        n = self.n_sets
+        cols = np.arange(n)
+        for start in range(0, n, block_size):
+            rows = np.arange(start, min(start + block_size, n))
+            sum_ab, sum_ba = self.best_match_sums(rows, cols)
+            blocks = {}
+            for combine in combines:
+                block = 1 - combine_best_match(
+                    sum_ab, sum_ba, self.set_sizes[rows][:, None], self.set_sizes[None, :], combine
+                )
+                block[np.arange(len(rows)), rows] = 0
+                blocks[combine] = block
+            yield rows, blocks
+
+    def similarity(self, pairs, combine="funSimAvg"):
+        """
+        Similarity of explicit pairs of sets, in the order of pairs
+
+        Args:
+            pairs (np.ndarray): k x 2 array of set indices
+            combine (str): One of combine_methods
+
+        Returns:
+            np.ndarray: Similarity of each pair
+        """
+        pairs = np.asarray(pairs).reshape(-1, 2)
+        best = self.best_match()
+        a, b = pairs[:, 0], pairs[:, 1]
+        # Pad term indices of each set with -1 so all pairs are gathered at once
+        width = max(int(self.set_sizes.max(initial=0)), 1)
+        padded = np.full((self.n_sets, width), -1, dtype=np.int64)
+        positions = np.arange(len(self.indices)) - np.repeat(self.indptr[:-1], self.set_sizes)
+        padded[np.repeat(np.arange(self.n_sets), self.set_sizes), positions] = self.indices
+        terms_a, terms_b = padded[a], padded[b]
+        sum_ab = np.where(terms_b >= 0, best[a[:, None], terms_b], 0).sum(axis=1)
+        sum_ba = np.where(terms_a >= 0, best[b[:, None], terms_a], 0).sum(axis=1)
+        return combine_best_match(sum_ab, sum_ba, self.set_sizes[a], self.set_sizes[b], combine)
+
+    def distance_matrix(self, combine="funSimAvg", block_size=1024):
+        """
+        Distance matrix between all sets, computed in row blocks
+        Matches create_hpo_distance for the same kind, method and combine
+
+        Args:
+            combine (str): One of combine_methods
+            block_size (int): Number of rows computed at once
+
+        Returns:
+            np.ndarray: Square distance matrix with a zero diagonal
+        """
+        n = self.n_sets
+        mtx_dist = np.zeros((n, n))
+        for rows, blocks in self.distance_blocks([combine], block_size):
+            mtx_dist[rows] = blocks[combine]
+        return mtx_dist
+
+    def term_distance_matrix(self):
+        """
+        Distance matrix between all individual terms in term_ids order
+        Matches create_hpo_distance on single-term HPOSets
+        """
+        mtx_dist = 1 - self.term_similarity
+        np.fill_diagonal(mtx_dist, 0)
+        return mtx_dist
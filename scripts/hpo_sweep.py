@@ -0,0 +1,214 @@
+import itertools
+
+import numpy as np
+from pyhpo import Ontology
+from scipy.sparse import csr_matrix
+
+from hpo_h5 import _storage_kwargs, FORMAT_VERSION
+from hpo_similarity import set_similarity_engine, combine_methods
+
+ic_kinds = ['omim', 'orpha', 'gene']
+term_methods = ['resnik', 'lin', 'jc', 'rel', 'ic', 'graphic']
+
+
+def metric_name(kind, method, combine):
+    return f'{kind}_{method}_{combine}'
+
+
+def parse_metric_grid(kinds, methods, combines):
+    """
+    Validate a grid of metric configurations
+
+    Returns:
+        list: (kind, method, combine) of every combination
+    """
+    for values, allowed, name in [(kinds, ic_kinds, 'kind'), (methods, term_methods, 'method'), (combines, combine_methods, 'combine')]:
+        unknown = [x for x in values if x not in allowed]
+        if unknown:
+            raise ValueError(f'{name} must be in {allowed}, not {unknown}')
+    return list(itertools.product(kinds, methods, combines))
+
+
+class term_similarity_sweep:
+    """
+    Term x term similarities of several information content kinds and methods computed from
+    one pass over the ancestor closures of the cohort terms, matching hpo3's term similarity
+
+    For every pair of terms the information content of the most informative common ancestor
+    (MICA) is found once per kind from the same closure lookups. resnik, lin, jc, rel and ic
+    are closed-form functions of the MICA and the IC of both terms, and graphic is the IC of the
+    common ancestors over the IC of the union of the strict ancestors, two sparse products of the
+    closure matrix
+    """
+    def __init__(self, cohort, block_size=64, snapshot=None):
+        """
+        Args:
+            cohort (hpo_cohort.hpo_cohort): Cohort whose terms are compared
+            block_size (int): Number of terms whose MICA rows are computed at once
+            snapshot (hpo_ontology.ontology_snapshot): Ontology snapshot closures and IC are read from.
+                The HPO Ontology must be loaded if None
+        """
+        if cohort.closure_indptr is None:
+            cohort = cohort.with_closures(snapshot)
+        self.snapshot = snapshot
+        self.term_codes = cohort.term_codes
+        self.block_size = block_size
+        self.ancestor_codes = np.unique(cohort.closure_codes)
+        n, m = len(self.term_codes), len(self.ancestor_codes)
+
+        # Closure (ancestors and the term itself) and strict ancestor incidence matrices, n x m
+        columns = np.searchsorted(self.ancestor_codes, cohort.closure_codes)
+        self.closure = csr_matrix((np.ones(len(columns)), columns, cohort.closure_indptr), shape=(n, m))
+        is_self = cohort.closure_codes == np.repeat(self.term_codes, np.diff(cohort.closure_indptr))
+        self.parents = self._strict(columns, is_self, cohort.closure_indptr, n, m)
+        self._descendants = self.closure.T.tocsr().astype(bool).toarray()
+        self._term_columns = np.searchsorted(self.ancestor_codes, self.term_codes)
+        self._ic = {}
+
+    @staticmethod
+    def _strict(columns, is_self, indptr, n, m):
+        keep = ~is_self
+        rows = np.repeat(np.arange(n), np.diff(indptr))[keep]
+        return csr_matrix((np.ones(keep.sum()), (rows, columns[keep])), shape=(n, m))
+
+    def ancestor_ic(self, kind):
+        if kind not in self._ic:
+            if self.snapshot is not None:
+                self._ic[kind] = self.snapshot.information_content(self.ancestor_codes, kind)
+            else:
+                self._ic[kind] = np.array([Ontology[int(x)].information_content[kind] for x in self.ancestor_codes])
+        return self._ic[kind]
+
+    def mica(self, kind):
+        """
+        IC of the most informative common ancestor of every pair of terms
+
+        Returns:
+            np.ndarray: n x n matrix
+        """
+        return self.micas([kind])[kind]
+
+    def micas(self, kinds):
+        """
+        MICA matrices of several kinds sharing the closure gathers of each block of terms
+        """
+        n = len(self.term_codes)
+        ics = {kind: self.ancestor_ic(kind) for kind in kinds}
+        output = {kind: np.zeros((n, n)) for kind in kinds}
+        indptr, indices = self.closure.indptr, self.closure.indices
+        for start in range(0, n, self.block_size):
+            stop = min(start + self.block_size, n)
+            ancestors = indices[indptr[start]:indptr[stop]]
+            starts = indptr[start:stop] - indptr[start]
+            # Descendant indicators of every ancestor of the block, shared by all kinds
+            descendants = self._descendants[ancestors]
+            for kind in kinds:
+                output[kind][start:stop] = np.maximum.reduceat(ics[kind][ancestors][:, None] * descendants, starts, axis=0)
+        return output
+
+    def graphic(self, kind):
+        """
+        graphic similarity of every pair of terms, matching hpo3
+        """
+        ic = self.ancestor_ic(kind)
+        common = (self.closure.multiply(ic[None, :]) @ self.closure.T).toarray()
+        parent_ic = np.asarray(self.parents @ ic).ravel()
+        union = parent_ic[:, None] + parent_ic[None, :] - (self.parents.multiply(ic[None, :]) @ self.parents.T).toarray()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim = np.where(union > 0, common / union, 0.0)
+        np.fill_diagonal(sim, 1.0)
+        return sim
+
+    def similarity(self, kind, method, mica=None):
+        """
+        Term x term similarity matrix of one kind and method
+
+        Args:
+            kind (str): Information content kind
+            method (str): One of term_methods
+            mica (np.ndarray): MICA matrix of kind, computed if not given
+        """
+        if method == 'graphic':
+            return self.graphic(kind)
+        if mica is None:
+            mica = self.mica(kind)
+        term_ic = self.ancestor_ic(kind)[self._term_columns]
+        ic_a, ic_b = term_ic[:, None], term_ic[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if method == 'resnik':
+                return mica.copy()
+            lin = np.where(ic_a + ic_b > 0, 2 * mica / (ic_a + ic_b), 0.0)
+            if method == 'lin':
+                return lin
+            if method == 'rel':
+                return lin * (1 - np.exp(-mica))
+            if method == 'ic':
+                return lin * (1 - 1 / (1 + mica))
+            if method == 'jc':
+                sim = np.where((ic_a > 0) & (ic_b > 0), 1 / (1 + ic_a + ic_b - 2 * mica), 0.0)
+                np.fill_diagonal(sim, 1.0)
+                return sim
+        raise ValueError(f'method must be one of {term_methods}, not {method}')
+
+
+class similarity_sweep:
+    """
+    Proband distance matrices of a grid of (kind, method, combine) metric configurations
+    computed in one pass. MICA lookups are shared by all methods of a kind, and the best match
+    sums of each block of probands are shared by all combine methods of a (kind, method), so a
+    sweep costs about one term similarity pass per kind plus one set pass per (kind, method)
+    """
+    def __init__(self, cohort, configs, block_size=1024, snapshot=None):
+        """
+        Args:
+            cohort (hpo_cohort.hpo_cohort): Cohort of proband HPO sets
+            configs (list): (kind, method, combine) tuples, see parse_metric_grid
+            block_size (int): Number of proband rows computed at once
+            snapshot (hpo_ontology.ontology_snapshot): Optional Ontology snapshot, see term_similarity_sweep
+        """
+        self.cohort = cohort
+        self.snapshot = snapshot
+        self.configs = list(configs)
+        self.block_size = block_size
+        self.shape = (len(cohort), len(cohort))
+
+    def _groups(self):
+        """
+        Internal method grouping the configurations by kind and method
+        """
+        groups = {}
+        for kind, method, combine in self.configs:
+            groups.setdefault(kind, {}).setdefault(method, []).append(combine)
+        return groups
+
+    def write(self, f, group='metrics', format_version=FORMAT_VERSION, dtype='f4', layout='chunked', chunk_rows=64):
+        """
+        Write one distance dataset per configuration to group of an open HDF5 file
+        Each dataset is named kind_method_combine and stores its configuration as attributes
+
+        Args:
+            f (h5py.File): File opened for writing
+            group (str): Name of the group, replaced if it exists
+        """
+        if group in f:
+            del f[group]
+        metrics = f.create_group(group)
+        storage = _storage_kwargs(self.shape, format_version, dtype, layout, chunk_rows)
+        terms = term_similarity_sweep(self.cohort, snapshot=self.snapshot)
+        for kind, methods in self._groups().items():
+            # One MICA matrix per kind is shared by all of its methods
+            mica = terms.mica(kind) if set(methods) - {'graphic'} else None
+            for method, combines in methods.items():
+                engine = set_similarity_engine.from_cohort(
+                    self.cohort, kind, method, term_similarity=terms.similarity(kind, method, mica)
+                )
+                datasets = {}
+                for combine in combines:
+                    dataset = metrics.create_dataset(metric_name(kind, method, combine), shape=self.shape, **storage)
+                    dataset.attrs['kind'] = kind
+                    dataset.attrs['method'] = method
+                    dataset.attrs['combine'] = combine
+                    datasets[combine] = dataset
+                for rows, blocks in engine.distance_blocks(combines, self.block_size):
+                    for combine, block in blocks.items():
+                        datasets[combine][rows[0]:rows[-1] + 1] = block
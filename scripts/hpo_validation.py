@@ -0,0 +1,149 @@
+import sys
+from collections import namedtuple
+import pandas as pd
+from pyhpo import Ontology, HPOSet
+
+# Term of an Ontology snapshot with the HPOTerm attributes used for validation
+snapshot_term = namedtuple('snapshot_term', ['id', 'name', 'is_obsolete', 'replaced_by'])
+
+
+def read_obo_alt_ids(obo_path):
+    """
+    Read the alt_id to primary ID mapping of an HPO obo file, e.g. data/hp_[date].obo
+    hpo3 does not expose alternative IDs, so they are taken from the obo file when available
+
+    Args:
+        obo_path (str): Path of the obo file
+
+    Returns:
+        dict: Alternative HPO ID to primary HPO ID
+    """
+    alt_ids = {}
+    primary_id = None
+    with open(obo_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                primary_id = None
+            elif line.startswith('id:'):
+                primary_id = line[3:].strip()
+            elif line.startswith('alt_id:') and primary_id is not None:
+                alt_ids[line[7:].strip()] = primary_id
+    return alt_ids
+
+
+def _hpo_id(code):
+    return f'HP:{int(code):07d}'
+
+
+class hpo_term_index:
+    """
+    In-memory ID index of the loaded HPO Ontology or an Ontology snapshot used to validate HPO IDs in bulk
+    Every distinct ID is resolved once and memoized. Obsolete terms are remapped to their
+    replacement and alternative IDs to their primary term, so later steps can reuse the
+    resolved HPOTerm objects instead of rebuilding HPOSets from strings
+
+    Resolution status of an ID is one of:
+        - valid: current term
+        - alt_id: alternative ID remapped to its primary term
+        - replaced: obsolete term remapped to its replacement
+        - obsolete: obsolete term without replacement, dropped
+        - unknown: not an HPO term of the loaded Ontology, dropped
+    """
+    def __init__(self, obo_path=None, snapshot=None):
+        """
+        Args:
+            obo_path (str): Optional HPO obo file used to resolve alternative IDs
+            snapshot (hpo_ontology.ontology_snapshot): Optional Ontology snapshot the terms are read
+                from instead of the HPO Ontology, which must be loaded if None. Terms are then
+                snapshot_term tuples and hpo_set can not be used
+        """
+        if snapshot is not None:
+            self.terms = {
+                _hpo_id(code): snapshot_term(_hpo_id(code), str(name), bool(obsolete), _hpo_id(replaced) if replaced >= 0 else '')
+                for code, name, obsolete, replaced in zip(
+                    snapshot.term_codes, snapshot.names, snapshot.obsolete, snapshot.replaced_by
+                )
+            }
+        else:
+            self.terms = {term.id: term for term in Ontology}
+        self.alt_ids = read_obo_alt_ids(obo_path) if obo_path else {}
+        self._resolved = {}
+
+    def resolve(self, hpo_id):
+        """
+        Resolve a single HPO ID
+
+        Returns:
+            tuple: (HPOTerm or None, status)
+        """
+        if hpo_id not in self._resolved:
+            self._resolved[hpo_id] = self._resolve(hpo_id)
+        return self._resolved[hpo_id]
+
+    def _resolve(self, hpo_id):
+        status = 'valid'
+        term = self.terms.get(hpo_id) if isinstance(hpo_id, str) else None
+        if term is None and hpo_id in self.alt_ids:
+            term = self.terms.get(self.alt_ids[hpo_id])
+            status = 'alt_id'
+        if term is None:
+            return None, 'unknown'
+        # Follow replacements, guarding against cycles
+        seen = set()
+        while term.is_obsolete:
+            replacement = term.replaced_by
+            if not replacement or replacement in seen or replacement not in self.terms:
+                return None, 'obsolete'
+            seen.add(replacement)
+            term = self.terms[replacement]
+            status = 'replaced'
+        return term, status
+
+    def validate(self, df, column='HPO_ID'):
+        """
+        Validate a column of HPO IDs, resolving each distinct ID once
+        Rows with missing IDs or IDs that can not be resolved are dropped and remapped IDs are replaced
+        with the ID of their current term
+
+        Args:
+            df (pd.DataFrame): Table with a column of HPO IDs
+            column (str): Name of the HPO ID column
+
+        Returns:
+            tuple: (validated table, report) where report has one row per distinct ID that
+            was remapped or dropped with columns hpo_id, resolved_id, status and n_rows
+        """
+        unique_ids = pd.unique(df[column].dropna())
+        resolved = [self.resolve(x) for x in unique_ids]
+        df_resolved = pd.DataFrame({
+            'hpo_id': unique_ids,
+            'resolved_id': [term.id if term is not None else None for term, _ in resolved],
+            'status': [status for _, status in resolved]
+        })
+
+        counts = df[column].value_counts()
+        report = df_resolved[df_resolved['status'] != 'valid'].copy()
+        report['n_rows'] = report['hpo_id'].map(counts).fillna(0).astype(int)
+        report = report.reset_index(drop=True)
+
+        id_map = dict(zip(df_resolved['hpo_id'], df_resolved['resolved_id']))
+        df = df.copy()
+        df[column] = df[column].map(id_map)
+        df = df.dropna(subset=[column])
+        return df, report
+
+    def hpo_set(self, hpo_ids):
+        """
+        Build an HPOSet from already resolved HPO IDs without re-parsing query strings
+        Requires an index of the loaded HPO Ontology
+        """
+        return HPOSet([self.terms[x] for x in hpo_ids])
+
+
+def print_validation_report(report, file=sys.stderr):
+    """
+    Print a one line summary per status of a validation report
+    """
+    for status, df in report.groupby('status'):
+        print(f'HPO validation: {len(df)} {status} IDs in {df["n_rows"].sum()} rows', file=file)
@@ -0,0 +1,158 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+statuses = ['pending', 'running', 'done', 'failed']
+
+
+class scrape_manifest:
+    """
+    Durable SQLite manifest of a scrape job with one record per HGNC ID
+    Each record keeps the status of the gene, the number of attempts, the class and message
+    of the last error, timing and the paths of the written output files. Every state change
+    is committed immediately, so a crashed or interrupted run can be resumed from the manifest
+    and only genes that are pending or failed are scraped again
+
+    Status of a gene is one of:
+        - pending: not scraped yet, or interrupted while running
+        - running: currently being scraped
+        - done: scraped and saved
+        - failed: last attempt raised an error
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the SQLite manifest file, created if it does not exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # One connection shared by the scrape threads, serialized by self._lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS genes (
+                    hgnc_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    valid_entry INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error_class TEXT,
+                    error_message TEXT,
+                    started_at REAL,
+                    finished_at REAL,
+                    duration REAL,
+                    outputs TEXT
+                )
+            """)
+            # Genes left running by a crashed or interrupted run are scraped again
+            self._connection.execute("UPDATE genes SET status = 'pending' WHERE status = 'running'")
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, params).fetchall()
+
+    def add(self, hgnc_ids):
+        """
+        Add HGNC IDs as pending, keeping the records of IDs already in the manifest
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO genes (hgnc_id) VALUES (?)",
+                [(x,) for x in hgnc_ids]
+            )
+
+    def todo(self, hgnc_ids=None, max_attempts=None):
+        """
+        Return the HGNC IDs that still need work: pending genes and failed genes with
+        fewer than max_attempts attempts
+
+        Args:
+            hgnc_ids (list): Only consider these IDs, in this order. All IDs of the manifest if None
+            max_attempts (int): Maximum number of attempts of a failed gene. Unlimited if None
+
+        Returns:
+            list: HGNC IDs to scrape
+        """
+        rows = self._execute("SELECT hgnc_id, status, attempts FROM genes")
+        needs_work = {
+            hgnc_id for hgnc_id, status, attempts in rows
+            if status == 'pending' or (status == 'failed' and (max_attempts is None or attempts < max_attempts))
+        }
+        if hgnc_ids is None:
+            hgnc_ids = [x[0] for x in rows]
+        return [x for x in hgnc_ids if x in needs_work]
+
+    def start(self, hgnc_id):
+        self._execute(
+            "UPDATE genes SET status = 'running', attempts = attempts + 1, started_at = ? WHERE hgnc_id = ?",
+            (time.time(), hgnc_id)
+        )
+
+    def finish(self, hgnc_id, valid_entry, outputs):
+        """
+        Record a successful scrape
+
+        Args:
+            hgnc_id (str): Scraped HGNC ID
+            valid_entry (bool): Whether the gene had a valid ClinGen entry
+            outputs (list): Paths of the written output files
+        """
+        now = time.time()
+        self._execute(
+            """UPDATE genes SET status = 'done', valid_entry = ?, error_class = NULL, error_message = NULL,
+               finished_at = ?, duration = ? - started_at, outputs = ? WHERE hgnc_id = ?""",
+            (int(valid_entry), now, now, json.dumps(outputs), hgnc_id)
+        )
+
+    def fail(self, hgnc_id, error):
+        """
+        Record a failed scrape attempt and the error it raised
+        """
+        now = time.time()
+        self._execute(
+            """UPDATE genes SET status = 'failed', error_class = ?, error_message = ?,
+               finished_at = ?, duration = ? - started_at WHERE hgnc_id = ?""",
+            (type(error).__name__, str(error), now, now, hgnc_id)
+        )
+
+    def reset(self, hgnc_ids):
+        """
+        Mark genes as pending again, e.g. genes interrupted by Ctrl-C
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE genes SET status = 'pending' WHERE hgnc_id = ? AND status = 'running'",
+                [(x,) for x in hgnc_ids]
+            )
+
+    def table(self):
+        """
+        Return the manifest as a DataFrame with one row per HGNC ID
+        """
+        with self._lock:
+            return pd.read_sql_query("SELECT * FROM genes ORDER BY hgnc_id", self._connection)
+
+    def summary(self):
+        """
+        Return the number of genes per status
+        """
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM genes GROUP BY status"))
+        return {x: counts.get(x, 0) for x in statuses}
+
+    def failures(self):
+        """
+        Return the failure ledger, the failed genes with their attempts and last error
+        """
+        df = self.table()
+        return df.loc[df['status'] == 'failed', ['hgnc_id', 'attempts', 'error_class', 'error_message']]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,185 @@
+"""
+Bulk parsing of the phenotype strings of scraped ClinGen proband tables
+Whole phenotype columns are parsed at once with pandas string extractions instead of per-row
+Python calls, so the HPO table of one gene or of the consolidated table of all genes is built
+in one pass. Strings are backed by Arrow when pyarrow is installed, which runs the extractions
+in compiled code. Phenotype cells follow either order of
+    "HPO terms(s): HPO term (HPO_ID), HPO term (HPO_ID) Free text: Free text"
+    "Free text: Free text HPO terms(s): HPO term (HPO_ID), HPO term (HPO_ID)"
+By default the output is the same as the original per-row parsing of gcep_scrape, so items after
+the first keep their leading separator and cells with the free text first have an empty HPO terms
+section. With clean=True separators are stripped and sections are found in either order
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+HPO_TERMS_START = 'HPO terms(s):'
+FREE_TEXT_START = 'Free text:'
+# HPO terms sections are split at every ")" and each piece matched as one "HPO term (HPO_ID" item,
+# which finds the items of re.findall(r"[^()]+?\(HP:\d+\)") without a Python call per match
+HPO_PIECE_PATTERN = r'(?P<item>(?P<HPO_term>[^()]+?)\s*\((?P<HPO_ID>HP:\d+))$'
+# A single "HPO term (HPO_ID)" item of an HPO terms list, as matched by re.match(r"(.+?)\s*\((HP:\d+)\)")
+HPO_ITEM_PATTERN = r'^(?P<HPO_term>.+?)\s*\((?P<HPO_ID>HP:\d+)\)'
+# Patterns of clean=True, leaving separators between items out of the item
+CLEAN_HPO_PIECE_PATTERN = r'[\s,;]*(?P<item>(?P<HPO_term>[^()]+?)\s*\((?P<HPO_ID>HP:\d+))$'
+CLEAN_HPO_ITEM_PATTERN = r'^[\s,;]*(?P<HPO_term>.+?)\s*\((?P<HPO_ID>HP:\d+)\)'
+phenotype_column = 'Proband Phenotypes'
+key_columns = ['Gene', 'Disease', 'MONDO', 'label']
+
+
+def _text_column(values):
+    """
+    Internal function returning values as a string Series, Arrow backed if pyarrow is installed.
+    Missing values stay missing and other values that are not strings are converted in one cast.
+    Their text has no section markers or items, so they parse the same as missing values
+    """
+    values = pd.Series(values, copy=False).astype('string')
+    if pyarrow is not None:
+        return values.astype(pd.ArrowDtype(pyarrow.string()))
+    return values
+
+
+def _to_object(values):
+    """
+    Internal function returning a string Series as Python strings with None for missing values
+    """
+    return values.astype(object).where(values.notna(), None)
+
+
+def _split(text, marker):
+    """
+    Internal function splitting text at the first marker with a literal split
+
+    Returns:
+        tuple: (text before the marker or all text, text after the marker or missing)
+    """
+    missing = pd.Series(pd.NA, index=text.index, dtype=text.dtype)
+    if not text.notna().any():
+        return missing, missing
+    parts = text.str.split(marker, n=1, regex=False, expand=True)
+    # Without any marker there is no column for the text after it
+    return parts[0], parts.get(1, missing)
+
+
+def _sections(phenotypes, clean=False):
+    """
+    Internal function returning the stripped HPO terms and free text sections of phenotype cells
+    The HPO terms section runs from its marker to the free text marker or the end of the cell and
+    is empty if the free text comes first. The free text section runs to the end of the cell.
+    With clean, each section runs from its marker to the marker of the other section or the end
+    of the cell
+    """
+    phenotypes = _text_column(phenotypes)
+    before_hpo, after_hpo = _split(phenotypes, HPO_TERMS_START)
+    hpo_text, _ = _split(after_hpo, FREE_TEXT_START)
+    _, free_text = _split(phenotypes, FREE_TEXT_START)
+    if clean:
+        free_text, _ = _split(free_text, HPO_TERMS_START)
+    else:
+        free_first = before_hpo.str.contains(FREE_TEXT_START, regex=False, na=False).astype(bool)
+        hpo_text = hpo_text.where(~free_first | hpo_text.isna(), '')
+    return hpo_text.str.strip(), free_text.str.strip()
+
+
+def _items(hpo_text, clean=False):
+    """
+    Internal function extracting the items of HPO terms sections, without separators with clean
+
+    Returns:
+        pd.DataFrame: item, the item text without its closing parenthesis, HPO_term and HPO_ID of every
+        item in section order, indexed by the position of its section
+    """
+    hpo_text = _text_column(hpo_text).reset_index(drop=True)
+    # Text after the last ")" can not end an item
+    pieces = hpo_text.str.replace(r'[^)]*$', '', regex=True).str.split(')').explode()
+    items = pieces.str.extract(CLEAN_HPO_PIECE_PATTERN if clean else HPO_PIECE_PATTERN)
+    return items[items['HPO_ID'].notna()]
+
+
+def split_phenotypes(phenotypes, clean=False):
+    """
+    Split phenotype cells into their HPO terms section and free text section
+
+    Args:
+        phenotypes (pd.Series): Phenotype cells, non-string cells have neither section
+        clean (bool): Find the sections in either order instead of as the original parsing
+
+    Returns:
+        pd.DataFrame: Columns hpo_text and free_text with the stripped text of each section,
+        None where a cell has no such section, with the index of phenotypes
+    """
+    hpo_text, free_text = _sections(phenotypes, clean)
+    return pd.DataFrame({'hpo_text': _to_object(hpo_text), 'free_text': _to_object(free_text)}, index=hpo_text.index)
+
+
+def extract_hpo_terms(hpo_text, clean=False):
+    """
+    Extract every "HPO term (HPO_ID)" item of HPO terms sections
+
+    Args:
+        hpo_text (pd.Series): HPO terms sections, e.g. hpo_text of split_phenotypes
+        clean (bool): Strip separators from the start of HPO terms
+
+    Returns:
+        pd.DataFrame: Columns row, the position of the section in hpo_text, HPO_ID and HPO_term,
+        one row per item in section order
+    """
+    items = _items(hpo_text, clean)
+    return pd.DataFrame({
+        'row': items.index.to_numpy(dtype=np.int64),
+        'HPO_ID': _to_object(items['HPO_ID']).to_numpy(),
+        'HPO_term': _to_object(items['HPO_term']).to_numpy()
+    })
+
+
+def parse_phenotypes(phenotypes, clean=False):
+    """
+    Parse phenotype cells into the HPO terms and HPO free text columns of gcep_scrape tables
+
+    Args:
+        phenotypes (pd.Series): Phenotype cells
+        clean (bool): Strip separators from the HPO terms and find the sections in either order,
+            which changes the output of cells the original parsing got wrong
+
+    Returns:
+        pd.DataFrame: Columns "HPO terms", the list of "HPO term (HPO_ID)" items of a cell, empty if its
+        HPO terms section has none and None if it has no section, and "HPO free text", None if a cell
+        has no free text section, with the index of phenotypes
+    """
+    hpo_text, free_text = _sections(phenotypes, clean)
+    terms = _items(hpo_text, clean)
+    items = _to_object(terms['item'] + ')').tolist()
+    # Items are in row order, so the items of each row are one slice
+    rows = terms.index.to_numpy(dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(hpo_text)))]).tolist()
+    has_hpo = hpo_text.notna().to_numpy().tolist()
+    return pd.DataFrame({
+        'HPO terms': [items[start:stop] if has else None for start, stop, has in zip(offsets[:-1], offsets[1:], has_hpo)],
+        'HPO free text': _to_object(free_text)
+    }, index=hpo_text.index)
+
+
+def hpo_table(df, columns=key_columns, clean=False):
+    """
+    One row per HPO term of every proband of a proband table, built in one pass over all probands
+
+    Args:
+        df (pd.DataFrame): Proband table of gcep_scrape objects, of one or many genes, or the
+            probands table of the scrape store, with "HPO terms" lists
+        columns (list): Proband columns kept in the HPO table
+        clean (bool): Strip separators from the start of HPO terms
+
+    Returns:
+        pd.DataFrame: columns, HPO_ID and HPO_term. Probands without HPO terms have no rows. The index
+        is the position in the table with one row per list item, as with DataFrame.explode
+    """
+    output = df[columns + ['HPO terms']].explode('HPO terms', ignore_index=True)
+    terms = _text_column(output.pop('HPO terms')).str.extract(CLEAN_HPO_ITEM_PATTERN if clean else HPO_ITEM_PATTERN)
+    output['HPO_ID'] = _to_object(terms['HPO_ID'])
+    output['HPO_term'] = _to_object(terms['HPO_term'])
+    return output.dropna(subset=['HPO_ID'])
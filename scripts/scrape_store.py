@@ -0,0 +1,336 @@
+import argparse
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from scrape_phenotypes import hpo_table
+
+hpo_columns = ['Gene', 'HGNC', 'Disease', 'MONDO', 'GCEP', 'label', 'HPO_ID', 'HPO_term']
+tables = ['probands', 'hpo']
+
+logger = logging.getLogger(__name__)
+
+
+# Arrow types of the known proband columns of gcep_scrape. Other columns of the ClinGen proband table are stored as strings
+proband_schema = {
+    'Gene': pa.string(),
+    'HGNC': pa.string(),
+    'Disease': pa.string(),
+    'MONDO': pa.string(),
+    'Inheritance': pa.string(),
+    'GCEP': pa.string(),
+    'Classification': pa.string(),
+    'label': pa.string(),
+    'Proband Sex': pa.string(),
+    'Proband Age': pa.float64(),
+    'Proband Points': pa.float64(),
+    'HPO terms': pa.list_(pa.string()),
+    'HPO free text': pa.string(),
+}
+
+
+def _typed_proband_table(df):
+    """
+    Give a gcep_scrape proband table a stable Arrow schema
+    Known columns get their type of proband_schema and the remaining proband columns, which come
+    straight from the ClinGen page, are stored as strings, so files of different genes can always be
+    read together. Values of numeric columns that are not numbers, e.g. an age of '20s', become
+    missing and the scraped text of each numeric column is kept in '<column> text'
+    """
+    df = df.copy()
+    fields, text_fields = [], []
+    for col in list(df.columns):
+        dtype = proband_schema.get(col, pa.string())
+        if col == 'HPO terms':
+            df[col] = [list(x) if isinstance(x, list) else None for x in df[col]]
+        elif pa.types.is_floating(dtype):
+            text = df[col].astype('string')
+            df[col] = pd.to_numeric(text.str.strip().replace('', pd.NA), errors='coerce').astype('float64')
+            invalid = df[col].isna() & text.str.strip().fillna('').ne('')
+            if invalid.any():
+                genes = df.loc[invalid, 'HGNC'].astype(str).unique() if 'HGNC' in df else []
+                logger.warning('%d values of %s are not numbers and stored as missing, genes: %s', invalid.sum(), col, ', '.join(genes))
+            df[f'{col} text'] = text
+            text_fields.append(pa.field(f'{col} text', pa.string()))
+        else:
+            df[col] = df[col].astype('string')
+        fields.append(pa.field(col, dtype))
+    fields += text_fields
+    return pa.Table.from_pandas(df[[x.name for x in fields]], schema=pa.schema(fields), preserve_index=False)
+
+
+def _typed_hpo_table(df_hpo, df_proband):
+    """
+    Give a per-gene HPO table the columns of hpo_columns, taking HGNC and GCEP from the proband table
+    """
+    keys = ['Gene', 'Disease', 'MONDO']
+    df_meta = df_proband[keys + ['HGNC', 'GCEP']].drop_duplicates(subset=keys)
+    df = df_hpo.astype({col: 'string' for col in keys}).merge(
+        df_meta.astype('string'), on=keys, how='left'
+    )
+    df = df.reindex(columns=hpo_columns).astype('string')
+    return pa.Table.from_pandas(df, schema=pa.schema([(col, pa.string()) for col in hpo_columns]), preserve_index=False)
+
+
+def _file_id(pkl_path):
+    """
+    HGNC ID of a HGNC_xxx.pkl.gz file
+    """
+    return os.path.basename(pkl_path)[:-len('.pkl.gz')].replace('_', ':', 1)
+
+
+def _empty_genes_path(store_dir):
+    return os.path.join(store_dir, 'empty_genes.txt')
+
+
+def empty_genes(store_dir):
+    """
+    Return the HGNC IDs of consolidated files without probands, which are not in the store
+    """
+    path = _empty_genes_path(store_dir)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {x.strip() for x in f if x.strip()}
+
+
+def _write_empty_genes(store_dir, hgnc_ids):
+    os.makedirs(store_dir, exist_ok=True)
+    path = _empty_genes_path(store_dir)
+    with open(f'{path}.tmp', 'w') as f:
+        f.writelines(f'{x}\n' for x in sorted(hgnc_ids))
+    os.replace(f'{path}.tmp', path)
+
+
+def _write_partitioned(table, path, part_name):
+    ds.write_dataset(
+        table, path, format='parquet',
+        partitioning=['GCEP'], partitioning_flavor='hive',
+        basename_template=f'{part_name}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore'
+    )
+
+
+def _consolidate_chunk(pkl_paths, store_dir, part_name):
+    """
+    Read the output files of a chunk of genes and write them as one part per GCEP partition
+
+    Args:
+        pkl_paths (list): Paths of HGNC_xxx.pkl.gz files written by gcep_scrape_pipeline.py.
+            The HGNC_xxx_hpo.csv file next to each is read if it exists
+        store_dir (str): Root of the store
+        part_name (str): Unique base name of the written parquet files
+
+    Returns:
+        tuple: HGNC IDs written and HGNC IDs of files without probands
+    """
+    probands, hpos, empty = [], [], []
+    for pkl_path in pkl_paths:
+        with gzip.open(pkl_path, 'rb') as f:
+            df_proband = pd.read_pickle(f)
+        if df_proband is None or df_proband.empty:
+            empty.append(_file_id(pkl_path))
+            continue
+        probands.append(_typed_proband_table(df_proband))
+        hpo_path = pkl_path[:-len('.pkl.gz')] + '_hpo.csv'
+        if os.path.exists(hpo_path):
+            hpos.append(_typed_hpo_table(pd.read_csv(hpo_path, dtype=str), df_proband))
+    if not probands:
+        return [], empty
+    df_probands = pa.concat_tables(probands, promote_options='default')
+    _write_partitioned(df_probands, os.path.join(store_dir, 'probands'), part_name)
+    if hpos:
+        _write_partitioned(pa.concat_tables(hpos), os.path.join(store_dir, 'hpo'), part_name)
+    return pd.unique(df_probands.column('HGNC').to_pandas()).tolist(), empty
+
+
+def _dataset(store_dir, table):
+    path = os.path.join(store_dir, table)
+    files = glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True)
+    if not files:
+        return None
+    # Proband columns differ between genes, read all files with the union of their columns
+    partitioning = ds.partitioning(pa.schema([('GCEP', pa.string())]), flavor='hive')
+    schema = pa.unify_schemas([pq.read_schema(x) for x in files]).append(pa.field('GCEP', pa.string()))
+    return ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=path, schema=schema)
+
+
+def read_scrape_store(store_dir, table='probands', columns=None, gcep=None):
+    """
+    Read the consolidated scrape store, reading only the requested columns and partitions
+
+    Args:
+        store_dir (str): Root of the store
+        table (str): 'probands' or 'hpo'
+        columns (list): Columns to read, all if None
+        gcep (list): Names of the expert panels to read, all if None
+
+    Returns:
+        pd.DataFrame: Requested part of the table
+    """
+    if table not in tables:
+        raise ValueError(f'table must be one of {tables}, not {table}')
+    dataset = _dataset(store_dir, table)
+    if dataset is None:
+        return pd.DataFrame(columns=columns)
+    gcep_filter = ds.field('GCEP').isin(list(gcep)) if gcep is not None else None
+    return dataset.to_table(columns=columns, filter=gcep_filter).to_pandas()
+
+
+def stored_genes(store_dir):
+    """
+    Return the HGNC IDs present in the store
+    """
+    df = read_scrape_store(store_dir, columns=['HGNC'])
+    return set(df['HGNC'].dropna())
+
+
+def remove_genes(store_dir, hgnc_ids):
+    """
+    Remove genes from the store, rewriting only the files that contain them
+    """
+    hgnc_ids = set(hgnc_ids)
+    for table in tables:
+        path = os.path.join(store_dir, table)
+        for file_path in glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True):
+            if not hgnc_ids & set(pq.read_table(file_path, columns=['HGNC']).column('HGNC').to_pylist()):
+                continue
+            df = pq.read_table(file_path)
+            df = df.filter(pc.invert(pc.is_in(df.column('HGNC'), value_set=pa.array(list(hgnc_ids)))))
+            if df.num_rows:
+                pq.write_table(df, file_path)
+            else:
+                os.remove(file_path)
+
+
+def consolidate_scrape(scrape_dir, store_dir, workers=None, chunk_size=500, replace=False):
+    """
+    Merge per-gene scrape outputs into a Parquet store partitioned by expert panel
+    Genes are read and written in parallel chunks, each chunk adding one file per partition.
+    Genes already in the store are skipped, or replaced if replace is True, so new genes are
+    appended without rewriting the rest of the store. Genes whose file has no probands are
+    recorded in empty_genes.txt of the store and skipped in the same way
+
+    Store layout:
+        - probands/GCEP=<panel>/*.parquet: proband tables of gcep_scrape with gene-disease metadata
+        - hpo/GCEP=<panel>/*.parquet: one row per proband HPO term
+        - empty_genes.txt: HGNC IDs of consolidated files without probands
+
+    Args:
+        scrape_dir (str): Directory searched recursively for HGNC_xxx.pkl.gz files
+        store_dir (str): Root of the store, created if it does not exist
+        workers (int): Number of worker processes
+        chunk_size (int): Number of genes per worker task
+        replace (bool): Replace genes that are already in the store
+
+    Returns:
+        list: HGNC IDs written
+    """
+    pkl_paths = sorted(glob.glob(os.path.join(scrape_dir, '**', 'HGNC_*.pkl.gz'), recursive=True))
+    # Later iterations of the scrape override earlier files of the same gene
+    pkl_paths = list({os.path.basename(x): x for x in pkl_paths}.values())
+    existing = stored_genes(store_dir)
+    empty = empty_genes(store_dir)
+    file_ids = {x: _file_id(x) for x in pkl_paths}
+    if replace:
+        remove_genes(store_dir, existing & set(file_ids.values()))
+        empty -= set(file_ids.values())
+    else:
+        pkl_paths = [x for x in pkl_paths if file_ids[x] not in existing | empty]
+    print(f'Consolidating {len(pkl_paths)} genes into {store_dir}', file=sys.stderr)
+
+    batch = uuid.uuid4().hex[:8]
+    chunks = [pkl_paths[i:i + chunk_size] for i in range(0, len(pkl_paths), chunk_size)]
+    written, new_empty = [], []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(_consolidate_chunk, chunk, store_dir, f'part-{batch}-{i}')
+            for i, chunk in enumerate(chunks)
+        ]
+        for future in futures:
+            chunk_written, chunk_empty = future.result()
+            written += chunk_written
+            new_empty += chunk_empty
+    if new_empty or replace:
+        _write_empty_genes(store_dir, empty | set(new_empty))
+    return written
+
+
+def rederive_hpo(store_dir, clean=False):
+    """
+    Derive the HPO table of the store again from the HPO terms lists of the probands in one pass
+    over all genes and replace the stored HPO table, e.g. after a fix of the HPO term parsing
+
+    Args:
+        store_dir (str): Root of the store
+        clean (bool): Strip separators from the start of HPO terms, see scrape_phenotypes.hpo_table
+
+    Returns:
+        int: Number of HPO rows written
+    """
+    dataset = _dataset(store_dir, 'probands')
+    if dataset is None:
+        return 0
+    keys = [x for x in hpo_columns if x not in ['HPO_ID', 'HPO_term']]
+    df_probands = read_scrape_store(store_dir, columns=keys + ['HPO terms'])
+    df_hpo = hpo_table(df_probands, columns=keys, clean=clean)
+    table = pa.Table.from_pandas(
+        df_hpo[hpo_columns].astype('string'),
+        schema=pa.schema([(col, pa.string()) for col in hpo_columns]), preserve_index=False
+    )
+
+    # Write the new table next to the old one and swap them, so readers never see a partial table
+    # and the old table is only deleted once the new one is in place
+    hpo_path = os.path.join(store_dir, 'hpo')
+    batch = uuid.uuid4().hex[:8]
+    tmp_path = f'{hpo_path}.tmp-{batch}'
+    old_path = f'{hpo_path}.old-{batch}'
+    _write_partitioned(table, tmp_path, f'part-{batch}')
+    if os.path.exists(hpo_path):
+        os.rename(hpo_path, old_path)
+    os.rename(tmp_path, hpo_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return table.num_rows
+
+
+def gcep_key(store_dir):
+    """
+    Return the key of which genes are associated with which GCEP, as compiled in gcep_key.csv
+    """
+    df = read_scrape_store(store_dir, columns=['Gene', 'HGNC', 'Disease', 'MONDO', 'GCEP'])
+    return df.drop_duplicates().reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidate per-gene ClinGen scrape outputs into a partitioned Parquet store")
+    parser.add_argument('SCRAPE_DIR', type=str, help='Directory with HGNC_xxx.pkl.gz and HGNC_xxx_hpo.csv files')
+    parser.add_argument('STORE_DIR', type=str, help='Root directory of the Parquet store')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--chunk_size', type=int, default=500, help='Number of genes written per file and partition')
+    parser.add_argument('--replace', action='store_true', help='Replace genes already in the store')
+    parser.add_argument('--rederive_hpo', action='store_true',
+                        help='Derive the HPO table of the whole store again from the proband HPO terms after consolidating')
+    parser.add_argument('--clean_hpo_terms', action='store_true',
+                        help='Strip separators from the start of HPO terms with --rederive_hpo, which the original parsing kept')
+    args = parser.parse_args()
+
+    written = consolidate_scrape(args.SCRAPE_DIR, args.STORE_DIR, args.workers, args.chunk_size, args.replace)
+    print(f'Wrote {len(written)} genes', file=sys.stderr)
+    if args.rederive_hpo:
+        n_rows = rederive_hpo(args.STORE_DIR, clean=args.clean_hpo_terms)
+        print(f'Derived {n_rows} HPO rows', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
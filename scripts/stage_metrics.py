@@ -0,0 +1,231 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process so far in MB. ru_maxrss is in KB on Linux and bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def response_bytes(response):
+    """
+    Number of body bytes received for a requests.Response, also for streamed responses
+    whose content was decoded straight from the socket. Responses without a raw body,
+    e.g. from a response cache, count their content
+    """
+    if response.raw is None:
+        return len(response.content or b'')
+    if hasattr(response.raw, 'tell'):
+        try:
+            return response.raw.tell()
+        except (OSError, ValueError):
+            pass
+    return int(response.headers.get('Content-Length', 0))
+
+
+class stage_record:
+    """
+    Counters of one running stage, added to with add()
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.rows = 0
+        self.bytes = 0
+        self.pairs = 0
+
+    def add(self, rows=0, bytes=0, pairs=0, **fields):
+        self.rows += rows
+        self.bytes += bytes
+        self.pairs += pairs
+        self.fields.update(fields)
+
+
+class stage_recorder:
+    """
+    Records wall time, CPU time, rows, bytes, pairs per second and peak RSS of pipeline stages
+    as JSON lines. Stages are timed with the stage() context manager and can be nested and run
+    from several threads. A recorder without a sink or profile_dir records nothing, so
+    instrumented code costs next to nothing when metrics are off
+
+    Record fields:
+        - run_id, stage, started_at, wall_s, status ('ok' or the exception class)
+        - cpu_s: CPU time of the thread running the stage, work of thread pools and hpo3 is not included
+        - rows, bytes, pairs and rows_per_s, mb_per_s, pairs_per_s where they are non zero
+        - peak_rss_mb: peak RSS of the process when the stage ended
+        - thread, profile (path of the cProfile dump) and any extra fields of the stage
+    """
+    def __init__(self, sink=None, profile_dir=None, run_id=None):
+        """
+        Args:
+            sink (str or file): Path of a JSON lines file the records are appended to, or an open
+                text file, e.g. sys.stderr. Records are not written if None
+            profile_dir (str): Directory a cProfile dump of every stage is written to. Off if None
+            run_id (str): Identifier of the run added to every record, random if None
+        """
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._owns_sink = isinstance(sink, (str, os.PathLike))
+        self._sink = open(sink, 'a') if self._owns_sink else sink
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self._sink is not None or self.profile_dir is not None
+
+    def close(self):
+        if self._owns_sink and self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def _profile_path(self, name):
+        with self._lock:
+            n = self._counts[name] = self._counts.get(name, 0) + 1
+        return os.path.join(self.profile_dir, f'{self.run_id}_{name}_{n}.prof')
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the enclosed block as stage name
+
+        Args:
+            name (str): Stage name, e.g. 'scrape.fetch'
+            fields: Extra fields of the record, e.g. hgnc_id
+
+        Yields:
+            stage_record: Counters the block adds rows, bytes and pairs to
+        """
+        record = stage_record(name, fields)
+        if not self.enabled:
+            yield record
+            return
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler can be active at a time, nested or concurrent stages are not profiled
+                profiler = None
+        started_at = datetime.datetime.now().isoformat(timespec='milliseconds')
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        status = 'ok'
+        try:
+            yield record
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            profile_path = None
+            if profiler is not None:
+                profiler.disable()
+                profile_path = self._profile_path(name)
+                profiler.dump_stats(profile_path)
+            self.write(self._record(record, started_at, wall, cpu, status, profile_path))
+
+    def _record(self, record, started_at, wall, cpu, status, profile_path):
+        output = {
+            'run_id': self.run_id,
+            'stage': record.name,
+            'started_at': started_at,
+            'wall_s': round(wall, 6),
+            'cpu_s': round(cpu, 6),
+            'status': status,
+            'rows': record.rows,
+            'bytes': record.bytes,
+            'pairs': record.pairs
+        }
+        if wall > 0:
+            for key, rate, scale in [('rows', 'rows_per_s', 1), ('bytes', 'mb_per_s', 1e6), ('pairs', 'pairs_per_s', 1)]:
+                if output[key]:
+                    output[rate] = round(output[key] / scale / wall, 3)
+        output['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        output['thread'] = threading.current_thread().name
+        if profile_path is not None:
+            output['profile'] = profile_path
+        output.update(record.fields)
+        return output
+
+    def write(self, record):
+        if self._sink is None:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._sink.write(line + '\n')
+            self._sink.flush()
+
+
+# Recorder used by stage(), off until configure() is called
+_recorder = stage_recorder()
+
+
+def configure(sink=None, profile_dir=None, run_id=None):
+    """
+    Replace the recorder used by stage() by a new one, see stage_recorder
+
+    Returns:
+        stage_recorder: The new recorder
+    """
+    global _recorder
+    _recorder.close()
+    _recorder = stage_recorder(sink, profile_dir, run_id)
+    return _recorder
+
+
+def recorder():
+    return _recorder
+
+
+def stage(name, **fields):
+    """
+    Time a block as a stage of the configured recorder, see stage_recorder.stage
+    """
+    return _recorder.stage(name, **fields)
+
+
+def summarize(path):
+    """
+    Summarize a JSON lines metrics file by stage
+
+    Returns:
+        pd.DataFrame: Number of records, total and mean wall time, rows, bytes, pairs and maximum peak RSS per stage
+    """
+    import pandas as pd
+    df = pd.read_json(path, lines=True)
+    for col in ['rows', 'bytes', 'pairs']:
+        if col not in df.columns:
+            df[col] = 0
+    df_summary = df.groupby('stage').agg(
+        n=('wall_s', 'size'), wall_s=('wall_s', 'sum'), mean_wall_s=('wall_s', 'mean'),
+        rows=('rows', 'sum'), bytes=('bytes', 'sum'), pairs=('pairs', 'sum'), peak_rss_mb=('peak_rss_mb', 'max')
+    )
+    df_summary['pairs_per_s'] = df_summary['pairs'] / df_summary['wall_s']
+    return df_summary.sort_values('wall_s', ascending=False)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarize a JSON lines stage metrics file")
+    parser.add_argument('METRICS', type=str, help='File written with --metrics')
+    args = parser.parse_args()
+    print(summarize(args.METRICS).to_string())
+
+
+if __name__ == "__main__":
+    main()
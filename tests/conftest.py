@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The scripts import each other as top level modules
+sys.path.insert(0, os.path.join(repo_dir, 'scripts'))
+
+
+@pytest.fixture(scope='session')
+def fixture_dir():
+    """
+    ClinGen responses replayed by hpo_benchmark.fixture_server, the recorded fixtures of tests/fixtures/clingen
+    written by tests/fixtures/make_clingen_fixtures.py. Set HPO_BENCHMARK_FIXTURES to use pages recorded
+    from the live site with python scripts/hpo_benchmark.py record instead
+    """
+    return os.environ.get('HPO_BENCHMARK_FIXTURES', os.path.join(repo_dir, 'tests', 'fixtures', 'clingen'))
+
+
+@pytest.fixture(scope='session')
+def synthetic_cohort():
+    """
+    Small deterministic cohort sampled from the Ontology, validated and keyed as in hpo_benchmark
+    """
+    from pyhpo import Ontology
+    Ontology()
+    from hpo_benchmark import synthetic_hpo_table
+    from hpo_cohort import hpo_cohort
+    from hpo_validation import hpo_term_index
+    df = hpo_term_index().validate(synthetic_hpo_table(40, seed=0))[0]
+    df['ID'] = df['Gene'] + '__' + df['Disease'] + '__' + df['label']
+    df_probands = df.drop_duplicates(subset=['Gene', 'Disease', 'label']).sort_values(['Gene', 'Disease', 'label'])
+    df_probands = df_probands[['Gene', 'Disease', 'label', 'ID']].reset_index(drop=True)
+    cohort = hpo_cohort.from_table(df, key_column='ID', term_column='HPO_ID', keys=df_probands['ID'])
+    df_probands['hpo_ids'] = cohort.hpo_id_strings()
+    return cohort, df_probands
+
+
+@pytest.fixture(scope='session')
+def hpo_snapshot(tmp_path_factory):
+    """
+    Ontology snapshot of the Ontology bundled with hpo3, written by hpo_ontology.build_snapshot
+    """
+    from pyhpo import Ontology
+    Ontology()
+    from hpo_ontology import build_snapshot, ontology_snapshot
+    return ontology_snapshot(build_snapshot(str(tmp_path_factory.mktemp('ontology'))))
@@ -0,0 +1,138 @@
+"""
+Write the ClinGen fixtures of the offline tests to tests/fixtures/clingen
+
+The gene pages, disease pages and /snapshots response are built in the layout of the ClinGen
+website and GCEP API and recorded with hpo_benchmark.record_fixtures from a local server, so the
+tests and benchmarks run without network access. Real pages recorded with
+python scripts/hpo_benchmark.py record can be used instead through HPO_BENCHMARK_FIXTURES
+"""
+import json
+import os
+import shutil
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+fixtures_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(fixtures_dir)), 'scripts'))
+import clingen_html
+from hpo_benchmark import fixture_hgnc_ids, record_fixtures
+
+# Symbol and curations of each gene of fixture_hgnc_ids, a curation is (MONDO ID, number of probands, with HPO terms)
+genes = {
+    'HGNC:11936': ('TNFRSF13B', [('MONDO:0000001', 6, True)]),
+    'HGNC:11364': ('STAT3', [('MONDO:0000002', 5, True), ('MONDO:0000003', 4, True)]),
+    'HGNC:5': ('A1BG', []),
+    'HGNC:23336': ('NFKB2', [('MONDO:0000004', 3, False)]),
+    'HGNC:20': ('AARS1', [('MONDO:0000005', 2, True)]),
+}
+phenotypes = [
+    'HPO terms(s): Recurrent sinopulmonary infections (HP:0005425), Hypogammaglobulinemia (HP:0004313) Free text: onset in childhood',
+    'HPO terms(s): Autoimmune hemolytic anemia (HP:0001890), Splenomegaly (HP:0001744), Lymphadenopathy (HP:0002716)',
+    'Free text: recurrent otitis media HPO terms(s): Recurrent otitis media (HP:0000403)',
+    'HPO terms(s): Eczema (HP:0000964) , Eosinophilia (HP:0001880); Elevated circulating IgE level (HP:0003212) Free text:',
+    '',
+]
+ages = ['34', '2', '20s', '', 'unknown']
+snapshot_query = {
+    'api_key': '', 'status': 'approved', 'affiliation': '40001', 'start': '2024-12-01', 'end': '2025-01-31'
+}
+
+
+def disease_page(symbol, disease, mondo, n_probands, with_hpo):
+    rows = []
+    for i in range(n_probands):
+        phenotype = phenotypes[i % len(phenotypes)] if with_hpo else f'Free text: proband {i} without HPO terms'
+        rows.append(
+            f'<tr><td>P{i + 1}</td><td>SEQUENCING_VARIANT</td><td>NM_000000.1:c.{100 + i}G&gt;A</td>'
+            f'<td>{"Male" if i % 2 else "Female"}</td><td>{ages[i % len(ages)]}</td><td>{phenotype}</td></tr>'
+        )
+    return f'''<html><body>
+<div class="container"><h1>{symbol}</h1>
+<dl class="dl-horizontal">
+<dt>Gene:</dt><dd>{symbol}</dd>
+<dt>Disease:</dt><dd>{disease}</dd>
+<dt>Mode of Inheritance:</dt><dd>Autosomal dominant inheritance (HP:0000006)</dd>
+<dt>Expert Panel:</dt><dd>Antibody Deficiencies GCEP</dd>
+</dl>
+<div>{mondo}</div>
+<a href="{clingen_html.CLASSIFICATION_HREF}"> Definitive </a>
+<table id="{clingen_html.PROBAND_TABLE_ID}" class="table">
+<thead><tr><th>Proband Label</th><th>Variant Type</th><th>Variant</th><th>Proband Sex</th><th>Proband Age</th><th>Proband Phenotypes</th></tr></thead>
+<tbody>{''.join(rows)}</tbody>
+</table></div></body></html>'''
+
+
+def gene_page(hgnc_id):
+    if hgnc_id not in genes:
+        return f'<html><body><h1>{clingen_html.GENE_ERROR_HEADER}</h1></body></html>'
+    symbol, curations = genes[hgnc_id]
+    links = ''.join(
+        f'<a class="{clingen_html.DISEASE_LINK_CLASS}" href="{clingen_html.DISEASE_LINK_PREFIX}_{symbol}_{mondo}">Report</a>'
+        for mondo, _, _ in curations
+    )
+    return f'<html><body><div class="container"><h1>{symbol}</h1>{links}</div></body></html>'
+
+
+def snapshots():
+    records = []
+    for symbol, curations in genes.values():
+        for k, (mondo, n_probands, with_hpo) in enumerate(curations):
+            records.append({
+                'Gene': symbol,
+                'Disease': f'{symbol} related disease {k + 1}',
+                'probands': [
+                    {'label': f'P{i + 1}', 'HPO terms': ['Eczema (HP:0000964)', 'Eosinophilia (HP:0001880)'][:i % 3] if with_hpo else []}
+                    for i in range(n_probands)
+                ]
+            })
+    return records
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        content_type = 'text/html; charset=utf-8'
+        if path.startswith('/kb/genes/'):
+            body = gene_page(path.rsplit('/', 1)[-1])
+        elif path.startswith(clingen_html.DISEASE_LINK_PREFIX):
+            symbol, mondo = path[len(clingen_html.DISEASE_LINK_PREFIX) + 1:].split('_')
+            k, (_, n_probands, with_hpo) = next(
+                (k, x) for k, x in enumerate(genes[next(h for h, g in genes.items() if g[0] == symbol)][1]) if x[0] == mondo
+            )
+            body = disease_page(symbol, f'{symbol} related disease {k + 1}', mondo, n_probands, with_hpo)
+        elif path == '/api/snapshots':
+            body, content_type = json.dumps(snapshots()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    fixture_dir = os.path.join(fixtures_dir, 'clingen')
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        n = record_fixtures(
+            fixture_dir, fixture_hgnc_ids, [dict(snapshot_query, gcep_url=f'{url}/api')], rate_limit=None, base_url=url
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f'{n} responses recorded in {fixture_dir}', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
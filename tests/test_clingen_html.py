@@ -0,0 +1,44 @@
+import pytest
+
+import clingen_html
+from hpo_benchmark import fixture_server
+
+pytest.importorskip('lxml')
+pytest.importorskip('bs4')
+
+
+@pytest.fixture(scope='module')
+def server(fixture_dir):
+    with fixture_server(fixture_dir) as server:
+        yield server
+
+
+def test_gene_pages_parse_the_same_with_both_backends(server):
+    pages = server.pages('/kb/genes/')
+    assert pages
+    for path, _, response in pages:
+        assert clingen_html.parse_gene_page(response.text, 'lxml') == clingen_html.parse_gene_page(response.text, 'bs4'), path
+
+
+def test_disease_pages_parse_the_same_with_both_backends(server):
+    pages = server.pages(clingen_html.DISEASE_LINK_PREFIX)
+    assert pages
+    for path, _, response in pages:
+        lxml_page = clingen_html.parse_disease_page(response.text, 'lxml')
+        bs4_page = clingen_html.parse_disease_page(response.text, 'bs4')
+        assert lxml_page == bs4_page, path
+        if lxml_page['proband_rows'] is not None:
+            assert clingen_html.rows_to_frame(lxml_page['proband_rows']).equals(
+                clingen_html.rows_to_frame(bs4_page['proband_rows'])
+            ), path
+
+
+def test_gcep_scrape_tables_are_the_same_with_both_backends(server):
+    from gcep_scrape import gcep_scrape
+    for hgnc_id in server.gene_ids():
+        lxml_query = gcep_scrape(hgnc_id, parser='lxml', base_url=server.url)
+        bs4_query = gcep_scrape(hgnc_id, parser='bs4', base_url=server.url)
+        assert lxml_query.valid_entry == bs4_query.valid_entry, hgnc_id
+        if lxml_query.valid_entry:
+            assert lxml_query.table.equals(bs4_query.table), hgnc_id
+            assert lxml_query.hpo_table().equals(bs4_query.hpo_table()), hgnc_id
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import pytest
+
+from gcep import gcep
+from gcep_http import clingen_session, response_cache
+from hpo_benchmark import fixture_server
+
+
+def _query(server):
+    prefix, query = server.snapshot_queries()[0]
+    return dict(
+        api_key='', gcep_url=f'{server.url}{prefix}',
+        **{k: query[k] for k in ['status', 'affiliation', 'start', 'end']}
+    )
+
+
+def test_recorded_snapshots_through_the_cache(fixture_dir, tmp_path):
+    with fixture_server(fixture_dir) as server:
+        query = _query(server)
+        cache_dir = str(tmp_path / 'cache')
+        live = gcep(session=clingen_session(cache=response_cache(cache_dir)), **query)
+        assert len(live.json) == 5
+        assert len(live.hpo_table()) > 0
+        assert set(live.proband_table()['Gene']) == set(live.genes)
+
+    # The streamed body was written to the cache while it was decoded
+    replay = gcep(session=clingen_session(cache=response_cache(cache_dir, replay=True)), **query)
+    assert replay.json == live.json
+    assert replay.hpo_table().equals(live.hpo_table())
+
+
+@pytest.fixture
+def gcep_api():
+    """
+    Local GCEP API answering /snapshots with the records of snapshots approved between start and end
+    """
+    snapshots = []
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = dict(parse_qsl(urlsplit(self.path).query))
+            records = [x for x in snapshots if params['start'] <= x['Approval Date'][:10] <= params['end']]
+            body = json.dumps([{k: v for k, v in x.items() if v is not None} for x in records]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', snapshots
+    server.shutdown()
+    server.server_close()
+
+
+def _snapshot(gene, date, version):
+    return {'Gene': gene, 'Disease': 'D', 'Approval Date': date, 'version': version, 'probands': []}
+
+
+def test_incremental_fetch_merges_by_date(gcep_api, tmp_path):
+    url, snapshots = gcep_api
+    snapshots += [_snapshot('A', '2024-01-05', 1), _snapshot('B', '2024-01-20', 1)]
+    kwargs = dict(api_key='', gcep_url=url, status='approved', affiliation='aff',
+                  snapshot_dir=str(tmp_path), incremental=True)
+    assert len(gcep(start='2024-01-01', end='2024-01-31', window_days=7, **kwargs).json) == 2
+
+    # A is approved again, B gets a snapshot approved on the watermark day
+    snapshots += [_snapshot('A', '2024-02-03', 2), _snapshot('B', '2024-01-31', 2)]
+    records = gcep(start='2024-01-10', end='2024-02-10', **kwargs).json
+    assert sorted((x['Gene'], x['version']) for x in records) == [('A', 2), ('B', 2)]
+
+    # Without incremental fetching every snapshot of the range is returned
+    assert len(gcep(api_key='', gcep_url=url, status='approved', affiliation='aff',
+                    start='2024-01-01', end='2024-02-10', window_days=5).json) == 4
+
+
+def test_incremental_fetch_requires_the_date_field(gcep_api, tmp_path):
+    url, snapshots = gcep_api
+    snapshots += [_snapshot('A', '2024-01-05', 1)]
+    query = gcep(api_key='', gcep_url=url, status='approved', affiliation='aff', start='2024-01-01',
+                 end='2024-01-31', snapshot_dir=str(tmp_path), incremental=True, date_field='Date')
+    with pytest.raises(ValueError, match="'Date'"):
+        query.json
+    assert not os.path.exists(tmp_path / 'watermarks.json')
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from gcep_http import CacheMissError, clingen_session, response_cache
+
+
+@pytest.fixture
+def origin():
+    """
+    Local server answering /<status> with that status and counting the requests of every path
+    """
+    hits = {}
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits[self.path] = hits.get(self.path, 0) + 1
+            body = json.dumps([self.path, hits[self.path]]).encode()
+            self.send_response(int(self.path.strip('/')))
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', hits
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('status, cached', [(200, True), (404, True), (401, False), (403, False), (400, False)])
+def test_only_successful_and_not_found_responses_are_cached(tmp_path, origin, status, cached):
+    url, hits = origin
+    session = clingen_session(retries=0, cache=response_cache(str(tmp_path)))
+    first = session.get(f'{url}/{status}')
+    second = session.get(f'{url}/{status}')
+    assert first.status_code == second.status_code == status
+    assert hits[f'/{status}'] == (1 if cached else 2)
+    replay = clingen_session(cache=response_cache(str(tmp_path), replay=True))
+    if cached:
+        assert replay.get(f'{url}/{status}').text == first.text
+    else:
+        with pytest.raises(CacheMissError):
+            replay.get(f'{url}/{status}')
+
+
+@pytest.mark.parametrize('read', ['ijson', 'iter_content'])
+def test_streamed_responses_are_cached_while_read(tmp_path, origin, read):
+    url, hits = origin
+    session = clingen_session(cache=response_cache(str(tmp_path)))
+    response = session.get(f'{url}/200', stream=True)
+    if read == 'ijson':
+        ijson = pytest.importorskip('ijson')
+        body = list(ijson.items(response.raw, 'item'))
+    else:
+        body = json.loads(b''.join(response.iter_content(4)))
+    response.close()
+    assert body == ['/200', 1]
+    replay = clingen_session(cache=response_cache(str(tmp_path), replay=True))
+    assert replay.get(f'{url}/200').json() == body
+
+
+def test_partly_read_streamed_responses_are_not_cached(tmp_path, origin):
+    url, hits = origin
+    session = clingen_session(cache=response_cache(str(tmp_path)))
+    response = session.get(f'{url}/200', stream=True)
+    response.raw.read(3)
+    response.close()
+    replay = clingen_session(cache=response_cache(str(tmp_path), replay=True))
+    with pytest.raises(CacheMissError):
+        replay.get(f'{url}/200')
+    assert not [x for _, _, files in os.walk(tmp_path) for x in files]
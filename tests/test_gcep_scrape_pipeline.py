@@ -0,0 +1,73 @@
+import pytest
+import requests
+
+from gcep_scrape_pipeline import run_batch
+from hpo_benchmark import fixture_server
+from scrape_manifest import scrape_manifest
+
+live_url = 'https://search.clinicalgenome.org'
+
+
+class outage_session:
+    """
+    Replays the recorded fixtures for requests to the live site, answering the gene pages of
+    genes that are down with 503 once and 404 for gene pages that were not recorded
+    """
+    def __init__(self, server, down=()):
+        self.server = server
+        self.down = set(down)
+
+    def get(self, url, **kwargs):
+        path = url[len(live_url):]
+        hgnc_id = path.rsplit('/', 1)[-1]
+        status_code = None
+        if path.startswith('/kb/genes/') and hgnc_id in self.down:
+            self.down.discard(hgnc_id)
+            status_code = 503
+        elif path.startswith('/kb/genes/') and hgnc_id not in self.server.gene_ids():
+            status_code = 404
+        if status_code is None:
+            return requests.get(f'{self.server.url}{path}', **kwargs)
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = url
+        response._content = b''
+        return response
+
+
+@pytest.fixture(scope='module')
+def server(fixture_dir):
+    with fixture_server(fixture_dir) as server:
+        yield server
+
+
+def _status(manifest):
+    return manifest.table().set_index('hgnc_id')[['status', 'valid_entry', 'error_class']].to_dict('index')
+
+
+def test_unavailable_gene_page_fails_and_is_retried(server, tmp_path):
+    session = outage_session(server, down=['HGNC:11936'])
+    hgnc_ids = ['HGNC:11936', 'HGNC:5']
+    with scrape_manifest(str(tmp_path / 'manifest.sqlite')) as manifest:
+        manifest.add(hgnc_ids)
+        assert run_batch(hgnc_ids, str(tmp_path), session, 1, manifest) == ['HGNC:11936']
+        status = _status(manifest)
+        assert status['HGNC:11936']['status'] == 'failed'
+        assert status['HGNC:11936']['error_class'] == 'HTTPError'
+        assert status['HGNC:5']['status'] == 'done'
+        assert manifest.todo(hgnc_ids, max_attempts=3) == ['HGNC:11936']
+
+        assert run_batch(manifest.todo(hgnc_ids, max_attempts=3), str(tmp_path), session, 1, manifest) == []
+        status = _status(manifest)
+        assert status['HGNC:11936']['status'] == 'done'
+        assert status['HGNC:11936']['valid_entry']
+        assert (tmp_path / 'HGNC_11936.pkl.gz').exists()
+
+
+def test_gene_page_not_found_is_done_without_entry(server, tmp_path):
+    with scrape_manifest(str(tmp_path / 'manifest.sqlite')) as manifest:
+        manifest.add(['HGNC:999999'])
+        assert run_batch(['HGNC:999999'], str(tmp_path), outage_session(server), 1, manifest) == []
+        status = _status(manifest)['HGNC:999999']
+        assert status['status'] == 'done'
+        assert not status['valid_entry']
@@ -0,0 +1,24 @@
+import pytest
+
+from gcep_http import response_cache
+from hpo_benchmark import benchmark_suite, fixture_hgnc_ids, fixture_server
+
+
+def test_fixture_server_fails_on_missing_gene_pages(tmp_path):
+    response_cache(str(tmp_path))
+    with pytest.raises(ValueError, match='not recorded'):
+        fixture_server(str(tmp_path))
+
+
+def test_fixture_server_covers_expected_genes(fixture_dir):
+    with fixture_server(fixture_dir) as server:
+        assert set(fixture_hgnc_ids) <= set(server.gene_ids())
+
+
+def test_fixture_benchmarks_run_offline(fixture_dir, tmp_path):
+    names = ['parse', 'scrape', 'hpo_table']
+    results = benchmark_suite(sizes=[], fixture_dir=fixture_dir, repeat=1, work_dir=str(tmp_path)).run(names)
+    assert [x['benchmark'] for x in results['results']] == names
+    for result in results['results']:
+        assert result['status'] == 'ok', result
+        assert result['rows'] > 0
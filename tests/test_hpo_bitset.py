@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+
+import stage_metrics
+from hpo_bitset import closure_bitset_engine, screened_set_similarity
+
+
+def test_screen_scores_match_dense_closures(synthetic_cohort, hpo_snapshot):
+    cohort, _ = synthetic_cohort
+    engine = closure_bitset_engine(cohort, weighting='jaccard', snapshot=hpo_snapshot)
+    closures = cohort.with_closures(hpo_snapshot)
+
+    def closure(t):
+        return closures.closure_codes[closures.closure_indptr[t]:closures.closure_indptr[t + 1]].tolist()
+
+    sets = [
+        set().union(*(closure(t) for t in cohort.indices[cohort.indptr[i]:cohort.indptr[i + 1]]))
+        for i in range(len(cohort))
+    ]
+    expected = np.array([[len(a & b) / len(a | b) if a | b else 0 for b in sets] for a in sets])
+    np.fill_diagonal(expected, 1)
+    np.testing.assert_allclose(engine.score_matrix(block_size=16), expected, atol=1e-6)
+
+
+def test_snapshot_exact_similarities_match_hpo3(synthetic_cohort, hpo_snapshot, tmp_path):
+    cohort, _ = synthetic_cohort
+    metrics_path = tmp_path / 'metrics.jsonl'
+    stage_metrics.configure(str(metrics_path))
+    try:
+        snapshot_mtx = screened_set_similarity(cohort, 0.1, block_size=16, snapshot=hpo_snapshot)
+    finally:
+        stage_metrics.configure()
+    hpo3_mtx = screened_set_similarity(cohort, 0.1, block_size=16)
+
+    assert snapshot_mtx.nnz > 0
+    np.testing.assert_array_equal(snapshot_mtx.indices, hpo3_mtx.indices)
+    np.testing.assert_allclose(snapshot_mtx.data, hpo3_mtx.data, atol=1e-5)
+    stages = [json.loads(x) for x in metrics_path.read_text().splitlines()]
+    assert [x['stage'] for x in stages] == ['bitset.screen', 'bitset.exact']
+    assert stages[1]['pairs'] == snapshot_mtx.nnz // 2
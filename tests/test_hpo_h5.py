@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hpo_h5 import hpo_distance_file, read_hpo_h5, write_hpo_h5
+
+storages = [
+    {'format_version': 1},
+    {'format_version': 2, 'dtype': 'f4', 'layout': 'chunked', 'chunk_rows': 8},
+    {'format_version': 2, 'dtype': 'f4', 'layout': 'contiguous'},
+    {'format_version': 2, 'dtype': 'f2', 'layout': 'chunked'},
+]
+
+
+def _distances(rng, n):
+    mtx = rng.random((n, n))
+    mtx = (mtx + mtx.T) / 2
+    np.fill_diagonal(mtx, 0)
+    return mtx
+
+
+@pytest.mark.parametrize('storage', storages, ids=lambda x: '-'.join(str(v) for v in x.values()))
+def test_round_trip(tmp_path, synthetic_cohort, storage):
+    cohort, df_probands = synthetic_cohort
+    rng = np.random.default_rng(0)
+    mtx_proband = _distances(rng, len(df_probands))
+    mtx_hpo = _distances(rng, len(cohort.term_ids))
+    df_hpo_meta = pd.DataFrame({'hpo_id': cohort.term_ids, 'hpo_name': cohort.term_ids})
+    metric = {'kind': 'omim', 'method': 'graphic', 'combine': 'funSimAvg'}
+    path = str(tmp_path / 'hpo.h5')
+    write_hpo_h5(path, mtx_hpo, df_hpo_meta, mtx_proband, df_probands, metric=metric, **storage)
+
+    atol = {1: 0, 2: 1e-3 if storage.get('dtype') == 'f2' else 1e-6}[storage['format_version']]
+    output = read_hpo_h5(path)
+    np.testing.assert_allclose(output['proband_distance'], mtx_proband, atol=atol)
+    np.testing.assert_allclose(output['hpo_distance'], mtx_hpo, atol=atol)
+    assert output['proband_key'] == df_probands['ID'].tolist()
+    assert output['hpo_id'] == list(cohort.term_ids)
+    assert output['proband_hpo_ids'] == df_probands['hpo_ids'].tolist()
+    assert output['metric'] == metric
+
+    keys = df_probands['ID'].tolist()
+    with hpo_distance_file(path) as hf:
+        assert hf.format_version == storage['format_version']
+        np.testing.assert_allclose(hf.row(keys[3]), mtx_proband[3], atol=atol)
+        np.testing.assert_allclose(hf.submatrix(keys[5:1:-1]), mtx_proband[np.ix_([5, 4, 3, 2], [5, 4, 3, 2])], atol=atol)
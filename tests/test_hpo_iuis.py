@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from hpo_iuis import iuis_index, iuis_stratification
+
+
+def test_permutation_summary_counts_are_integers():
+    df_iuis = pd.DataFrame({
+        'gene': ['A', 'B', 'C', 'D'], 'table': [1, 1, 2, 2],
+        'table_description': ['one', 'one', 'two', 'two'], 'subtable': [1, 1, 1, 1], 'subtable_description': 'None'
+    })
+    genes = ['A', 'A', 'B', 'C', 'C', 'D', 'E']
+    rng = np.random.default_rng(0)
+    mtx = rng.random((len(genes), len(genes)))
+    mtx = (mtx + mtx.T) / 2
+    np.fill_diagonal(mtx, 0)
+
+    strata = iuis_stratification(mtx, genes, iuis_index(df_iuis), bins=10, chunk_rows=3)
+    df = strata.permutation_test(n_permutations=20).set_index('category')
+
+    count_columns = ['n_genes', 'n_probands', 'within_pairs', 'between_pairs']
+    assert (df[count_columns].dtypes == np.int64).all()
+    assert strata.uncategorized_genes == ['E']
+    # Ordered pairs of the 6 categorized probands, split by whether their genes share a category
+    assert df.loc['all', 'within_pairs'] + df.loc['all', 'between_pairs'] == 6 * 5
+    assert df.loc['1', ['n_genes', 'n_probands', 'within_pairs']].tolist() == [2, 3, 6]
+    shared = np.array([[g in 'AB' and h in 'AB' or g in 'CD' and h in 'CD' for h in genes[:6]] for g in genes[:6]])
+    np.fill_diagonal(shared, False)
+    assert np.isclose(df.loc['all', 'within_mean'], mtx[:6, :6][shared].mean())
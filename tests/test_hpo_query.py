@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hpo_h5 import write_hpo_h5
+from hpo_query import proband_index
+
+
+@pytest.fixture
+def distance_h5(tmp_path, synthetic_cohort):
+    cohort, df_probands = synthetic_cohort
+    df_hpo_meta = pd.DataFrame({'hpo_id': cohort.term_ids, 'hpo_name': cohort.term_ids})
+    path = str(tmp_path / 'hpo.h5')
+    write_hpo_h5(
+        path, np.zeros((len(cohort.term_ids),) * 2), df_hpo_meta, np.zeros((len(df_probands),) * 2), df_probands,
+        metric={'kind': 'orpha', 'method': 'resnik', 'combine': 'BMA'}
+    )
+    return path
+
+
+def test_build_uses_metric_of_distance_file(distance_h5):
+    index = proband_index.from_distance_h5(distance_h5)
+    assert (index.kind, index.method, index.combine) == ('orpha', 'resnik', 'BMA')
+    index = proband_index.from_distance_h5(distance_h5, kind='orpha', combine='BMA')
+    assert (index.kind, index.method, index.combine) == ('orpha', 'resnik', 'BMA')
+
+
+def test_build_rejects_other_metric(distance_h5):
+    with pytest.raises(ValueError, match='method graphic'):
+        proband_index.from_distance_h5(distance_h5, method='graphic')
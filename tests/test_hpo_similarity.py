@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from hpo_distance import create_hpo_distance
+from hpo_similarity import combine_methods, set_similarity_engine
+
+
+@pytest.mark.parametrize('kind, method', [('omim', 'graphic'), ('orpha', 'resnik')])
+def test_engine_matches_hpo3(synthetic_cohort, kind, method):
+    hpo_sets = synthetic_cohort[0].hpo_sets()
+    engine = set_similarity_engine(hpo_sets, kind=kind, method=method)
+    for combine in combine_methods:
+        expected = create_hpo_distance(hpo_sets, kind=kind, method=method, combine=combine)
+        np.testing.assert_allclose(engine.distance_matrix(combine=combine), expected, atol=1e-6, err_msg=combine)
+
+
+def test_engine_from_cohort_matches_engine_from_sets(synthetic_cohort):
+    cohort = synthetic_cohort[0]
+    np.testing.assert_allclose(
+        set_similarity_engine.from_cohort(cohort).distance_matrix(),
+        set_similarity_engine(cohort.hpo_sets()).distance_matrix()
+    )
@@ -0,0 +1,26 @@
+from pyhpo import Ontology
+
+from hpo_benchmark import synthetic_hpo_table
+from hpo_validation import hpo_term_index
+
+
+def test_snapshot_index_matches_ontology_index(hpo_snapshot):
+    Ontology()
+    df = synthetic_hpo_table(40, seed=0)
+    df_ontology, report_ontology = hpo_term_index().validate(df)
+    df_snapshot, report_snapshot = hpo_term_index(snapshot=hpo_snapshot).validate(df)
+    assert df_snapshot.equals(df_ontology)
+    assert report_snapshot.equals(report_ontology)
+
+
+def test_snapshot_index_resolves_obsolete_terms(hpo_snapshot):
+    index, snapshot_index = hpo_term_index(), hpo_term_index(snapshot=hpo_snapshot)
+    hpo_ids = [term.id for term in Ontology if term.is_obsolete][:200] + ['HP:0000118', 'HP:9999999']
+    for hpo_id in hpo_ids:
+        term, status = index.resolve(hpo_id)
+        snapshot_term, snapshot_status = snapshot_index.resolve(hpo_id)
+        assert snapshot_status == status
+        if term is None:
+            assert snapshot_term is None
+        else:
+            assert (snapshot_term.id, snapshot_term.name) == (term.id, term.name)
@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+import scrape_phenotypes
+
+
+@pytest.fixture(params=[True, False], ids=['arrow', 'python'])
+def backend(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(scrape_phenotypes, 'pyarrow', None)
+
+
+def _parse(cells, clean=False):
+    return scrape_phenotypes.parse_phenotypes(pd.Series(cells, dtype=object), clean=clean).to_dict('list')
+
+
+def test_parse_phenotypes(backend):
+    cells = [
+        'HPO terms(s): Eczema (HP:0000964), Eosinophilia (HP:0001880) Free text: onset at 2',
+        'Free text: otitis HPO terms(s): Recurrent otitis media (HP:0000403)',
+        'HPO terms(s): no items',
+        None,
+        12.5,
+    ]
+    assert _parse(cells) == {
+        'HPO terms': [['Eczema (HP:0000964)', ', Eosinophilia (HP:0001880)'], [], [], None, None],
+        'HPO free text': ['onset at 2', 'otitis HPO terms(s): Recurrent otitis media (HP:0000403)', None, None, None],
+    }
+    assert _parse(cells, clean=True) == {
+        'HPO terms': [['Eczema (HP:0000964)', 'Eosinophilia (HP:0001880)'], ['Recurrent otitis media (HP:0000403)'], [], None, None],
+        'HPO free text': ['onset at 2', 'otitis', None, None, None],
+    }
+
+
+@pytest.mark.parametrize('cells', [['Free text: a', 'Free text: b'], [None, None], []])
+def test_parse_phenotypes_without_hpo_sections(backend, cells):
+    expected_free_text = [x[len('Free text: '):] if x else None for x in cells]
+    for clean in [False, True]:
+        assert _parse(cells, clean) == {'HPO terms': [None] * len(cells), 'HPO free text': expected_free_text}
+
+
+def test_hpo_table(backend):
+    df = pd.DataFrame({
+        'Gene': 'G', 'Disease': 'D', 'MONDO': 'M', 'label': ['P1', 'P2', 'P3'],
+        'HPO terms': [['Eczema (HP:0000964)', ', Eosinophilia (HP:0001880)'], None, []],
+    })
+    output = scrape_phenotypes.hpo_table(df)
+    assert output['HPO_ID'].tolist() == ['HP:0000964', 'HP:0001880']
+    assert output['HPO_term'].tolist() == ['Eczema', ', Eosinophilia']
+    assert scrape_phenotypes.hpo_table(df, clean=True)['HPO_term'].tolist() == ['Eczema', 'Eosinophilia']
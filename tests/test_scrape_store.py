@@ -0,0 +1,34 @@
+import gzip
+
+import pandas as pd
+
+from scrape_store import consolidate_scrape, read_scrape_store
+
+
+def _write_gene(scrape_dir, hgnc_id, ages):
+    df = pd.DataFrame({
+        'Gene': hgnc_id, 'HGNC': hgnc_id, 'Disease': 'disease', 'MONDO': 'MONDO:0000001', 'GCEP': 'GCEP',
+        'label': [f'P{i + 1}' for i in range(len(ages))], 'Proband Age': ages,
+        'HPO terms': [['Eczema (HP:0000964)']] * len(ages),
+    })
+    with gzip.open(scrape_dir / f'{hgnc_id.replace(":", "_")}.pkl.gz', 'wb') as f:
+        df.to_pickle(f)
+
+
+def test_non_numeric_proband_age_keeps_text(tmp_path):
+    scrape_dir, store_dir = tmp_path / 'scrape', tmp_path / 'store'
+    scrape_dir.mkdir()
+    _write_gene(scrape_dir, 'HGNC:1', ['34', '20s', '', 'unknown'])
+    _write_gene(scrape_dir, 'HGNC:2', ['2', '5'])
+
+    written = consolidate_scrape(str(scrape_dir), str(store_dir), workers=1)
+    assert sorted(written) == ['HGNC:1', 'HGNC:2']
+
+    df = read_scrape_store(str(store_dir), columns=['HGNC', 'label', 'Proband Age', 'Proband Age text'])
+    df = df.set_index(['HGNC', 'label'])
+    assert df['Proband Age'].dtype == 'float64'
+    assert df.loc[('HGNC:1', 'P1'), 'Proband Age'] == 34
+    assert df.loc[('HGNC:2', 'P2'), 'Proband Age'] == 5
+    assert df.loc[('HGNC:1', 'P2'), 'Proband Age text'] == '20s'
+    assert pd.isna(df.loc[('HGNC:1', 'P2'), 'Proband Age'])
+    assert pd.isna(df.loc[('HGNC:1', 'P4'), 'Proband Age'])